@@ -0,0 +1,54 @@
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from swotann.QuantReg_Functions import evaluate_model
+from swotann.QuantReg_Models import cqrann
+from swotann.swot_ml import SWOT_ML
+
+'''Compares the training engines and optimizers of cqrann on each of the test CSVs (or the
+files given as arguments), with the model parameters of SWOT_ML: the wall
+time of fit and the calibration scores of evaluate_model on the training data.
+
+usage: python scripts/benchmark_cqrann_training.py [file.csv ...]'''
+
+ENGINES = {
+    "keras": {},
+    "compiled": {"engine": "compiled"},
+    "compiled, full batch": {"engine": "compiled", "batch_size": None},
+    "L-BFGS": {"optimizer": "L-BFGS"},
+}
+
+
+def main():
+    filenames = sys.argv[1:] or sorted(glob.glob(os.path.join(os.path.dirname(__file__), "..", "tests", "test*.csv")))
+    results = []
+    for filename in filenames:
+        net = SWOT_ML(seed=0)
+        net.import_data_from_csv(filename)
+        X = net.predictors_scaler.fit_transform(net.predictors)
+        y = net.targets_scaler.fit_transform(np.array(net.targets).reshape(-1, 1))
+        for name, params in ENGINES.items():
+            tf.random.set_seed(0)
+            model = cqrann(quantiles=net.quantiles, seed=0, **dict(net.model_params, **params))
+            start = time.perf_counter()
+            model.fit(X, y)
+            fit_time = time.perf_counter() - start
+
+            predictions = net.targets_scaler.inverse_transform(model.predict_array(X).reshape(-1, 1))
+            df = pd.DataFrame(predictions.reshape(len(X), -1), columns=[str(np.round(q, 4)) for q in net.quantiles])
+            df["observed"] = np.array(net.targets)
+            scores = evaluate_model(df, net.quantiles, "observed")
+            results.append(dict(file=os.path.basename(filename), engine=name, fit_time=fit_time, **scores))
+
+    with pd.option_context("display.width", 200, "display.max_columns", None, "display.precision", 4):
+        print(pd.DataFrame(results).set_index(["file", "engine"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import datetime
+import gc
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from xlrd.xldate import xldate_as_datetime
+
+from swotann.swot_ml import SWOT_ML
+
+'''Compares the vectorized date/time parsing in SWOT_ML.parse_dates with the
+row by row loop previously used by SWOT_ML.import_data_from_csv, on a copy of
+tests/test1.csv repeated to the requested number of rows.
+
+usage: python scripts/benchmark_date_parsing.py [rows]'''
+
+XL_DATEFORMAT = r"%Y-%m-%dT%H:%M"
+
+
+def legacy_parse(start_date, end_date):
+    durations = []
+    all_dates = []
+    collection_time = []
+
+    for i in range(len(start_date)):
+        try:
+            # excel type
+            start = float(start_date[i])
+            end = float(end_date[i])
+            start = xldate_as_datetime(start, datemode=0)
+            if start.hour > 12:
+                collection_time = np.append(collection_time, 1)
+            else:
+                collection_time = np.append(collection_time, 0)
+            end = xldate_as_datetime(end, datemode=0)
+
+        except ValueError:
+            # kobo type
+            start = start_date[i][:16].replace("/", "-")
+            end = end_date[i][:16].replace("/", "-")
+            start = datetime.datetime.strptime(start, XL_DATEFORMAT)
+            if start.hour > 12:
+                collection_time = np.append(collection_time, 1)
+            else:
+                collection_time = np.append(collection_time, 0)
+            end = datetime.datetime.strptime(end, XL_DATEFORMAT)
+        durations.append((end - start).total_seconds())
+        all_dates.append(datetime.datetime.strftime(start, XL_DATEFORMAT))
+    return np.array(durations), collection_time, all_dates
+
+
+def vectorized_parse(net, start_date, end_date):
+    ts_local, ts_utc = net.parse_dates(start_date)
+    hh_local, hh_utc = net.parse_dates(end_date)
+    durations = (hh_utc - ts_utc).dt.total_seconds().to_numpy()
+    collection_time = (ts_local.dt.hour > 12).to_numpy(dtype=float)
+    all_dates = np.datetime_as_string(ts_local.to_numpy(), unit="m")
+    return durations, collection_time, all_dates
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    source = pd.read_csv(os.path.join(os.path.dirname(__file__), "..", "tests", "test1.csv"))
+    df = pd.concat([source] * int(np.ceil(rows / len(source))), ignore_index=True).iloc[:rows]
+    net = SWOT_ML()
+    vectorized_parse(net, source["ts_datetime"], source["hh_datetime"])  # warm up pandas before timing
+    gc.disable()  # as in timeit, keep collections of the objects loaded with TensorFlow out of the timings
+
+    start = time.perf_counter()
+    legacy = legacy_parse(df["ts_datetime"], df["hh_datetime"])
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vectorized = vectorized_parse(net, df["ts_datetime"], df["hh_datetime"])
+    vectorized_time = time.perf_counter() - start
+
+    # test1.csv uses the same UTC offset for both columns, so the results must be identical
+    assert np.array_equal(legacy[0], vectorized[0])
+    assert np.array_equal(legacy[1], vectorized[1])
+    assert list(legacy[2]) == list(vectorized[2])
+
+    print(f"rows: {rows}")
+    print(f"legacy loop: {legacy_time:.3f} s")
+    print(f"vectorized: {vectorized_time:.3f} s")
+    print(f"speedup: {legacy_time / vectorized_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import os
+import sys
+import time
+
+import numpy as np
+
+from swotann.QuantReg_Functions import q_loss
+from swotann.QuantReg_Models import gbm
+from swotann.swot_ml import SWOT_ML
+
+'''Compares the fit time of the gbm quantile model fitted one quantile after
+the other with GradientBoostingRegressor (the previous behaviour), in a
+process pool, and with the HistGradientBoostingRegressor backend, on the data
+of tests/test1.csv repeated with noise to the requested number of rows.
+
+usage: python scripts/benchmark_gbm.py [rows] [n_jobs]'''
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    n_jobs = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    net = SWOT_ML()
+    net.import_data_from_csv(os.path.join(os.path.dirname(__file__), "..", "tests", "test1.csv"))
+    X = net.predictors_scaler.fit_transform(net.predictors)
+    y = net.targets_scaler.fit_transform(np.array(net.targets).reshape(-1, 1)).ravel()
+    rng = np.random.default_rng(0)
+    index = rng.integers(len(X), size=rows)
+    X = X[index] + rng.normal(0, 0.01, (rows, X.shape[1]))
+    y = y[index]
+
+    print(f"cores: {os.cpu_count()}, quantiles: {len(net.quantiles)}, samples: {rows}")
+    timings = {}
+    for name, params in [("exact", {}), (f"exact, n_jobs={n_jobs}", {"n_jobs": n_jobs}), ("hist", {"backend": "hist"})]:
+        model = gbm(quantiles=net.quantiles, max_depth=3, **params)
+        start = time.perf_counter()
+        model.fit(X, y)
+        timings[name] = time.perf_counter() - start
+        predictions = model.predict(X)
+        error = np.mean([q_loss(q, y, predictions[str(np.round(q, 4))]) for q in net.quantiles])
+        print(f"{name}: {timings[name]:.1f} s ({timings['exact'] / timings[name]:.1f}x), "
+              f"average quantile error {error:.5f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+'''Compares the "keras" and "numpy" backends of SWOT_ML, each in a fresh
+Python process: the time taken to import swotann.swot_ml, the wall time of
+training on each of the test CSVs (or the files given as arguments), the
+calibration scores of evaluate_model on the training data, and the peak
+resident memory of the process. The "numpy" process runs with TensorFlow
+made unimportable, as in a worker image without it.
+
+usage: python scripts/benchmark_numpy_backend.py [file.csv ...]'''
+
+BACKENDS = ["keras", "numpy"]
+
+
+def run_backend(backend, filenames):
+    import resource
+
+    if backend == "numpy":
+        sys.modules["tensorflow"] = None
+        sys.modules["keras"] = None
+    start = time.perf_counter()
+    from swotann.QuantReg_Functions import evaluate_model
+    from swotann.swot_ml import SWOT_ML
+    import_time = time.perf_counter() - start
+
+    results = []
+    for filename in filenames:
+        net = SWOT_ML(seed=0, backend=backend)
+        net.import_data_from_csv(filename)
+        net.set_up_model()
+        start = time.perf_counter()
+        net.train_ML_models(None)
+        fit_time = time.perf_counter() - start
+
+        df = net.calibration_predictions.to_frame()
+        df["observed"] = np.array(net.targets).flatten()
+        scores = evaluate_model(df, net.quantiles, "observed")
+        results.append(dict(file=os.path.basename(filename), fit_time=fit_time, **scores))
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {"import_time": import_time, "peak_rss_mb": peak_rss, "results": results}
+
+
+def main():
+    if sys.argv[1:2] == ["--backend"]:
+        print(json.dumps(run_backend(sys.argv[2], sys.argv[3:]), default=float))
+        return
+
+    filenames = sys.argv[1:] or sorted(glob.glob(os.path.join(os.path.dirname(__file__), "..", "tests", "test*.csv")))
+    summary = []
+    results = []
+    for backend in BACKENDS:
+        env = dict(os.environ, TF_CPP_MIN_LOG_LEVEL="3")
+        output = subprocess.run([sys.executable, __file__, "--backend", backend] + filenames, env=env,
+                                capture_output=True, text=True, check=True).stdout
+        report = json.loads(output.strip().splitlines()[-1])
+        summary.append(dict(backend=backend, import_time=report["import_time"], peak_rss_mb=report["peak_rss_mb"],
+                            total_fit_time=sum(result["fit_time"] for result in report["results"])))
+        results += [dict(result, backend=backend) for result in report["results"]]
+
+    with pd.option_context("display.width", 200, "display.max_columns", None, "display.precision", 4):
+        print(pd.DataFrame(summary).set_index("backend"))
+        print()
+        print(pd.DataFrame(results).set_index(["file", "backend"]).sort_index())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import gc
+import os
+import sys
+import time
+
+import numpy as np
+
+from swotann.QuantReg_Functions import q_loss
+from swotann.QuantReg_Models import qrann
+from swotann.swot_ml import SWOT_ML
+
+'''Compares the wall time of training a qrann (one network per quantile) one
+quantile after the other, with the quantiles in a process pool and with the
+stacked engine (all the quantiles in one Keras model), on the data of
+tests/test1.csv.
+
+usage: python scripts/benchmark_quantile_training.py [n_jobs]'''
+
+
+def main():
+    n_jobs = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+    net = SWOT_ML()
+    net.import_data_from_csv(os.path.join(os.path.dirname(__file__), "..", "tests", "test1.csv"))
+    net.set_up_model()
+    X = net.predictors_scaler.fit_transform(net.predictors)
+    y = net.targets_scaler.fit_transform(np.array(net.targets).reshape(-1, 1))
+    gc.disable()
+
+    timings = {}
+    losses = {}
+    for name, params in [("serial", {}), (f"n_jobs={n_jobs}", {"n_jobs": n_jobs}), ("stacked", {"engine": "stacked"})]:
+        model = qrann(quantiles=net.quantiles, n_hidden=1, hl_size=4, loss="smoothed", epsilon=10**-32, **params)
+        start = time.perf_counter()
+        model.fit(X, y)
+        timings[name] = time.perf_counter() - start
+        predictions = model.predict(X)
+        losses[name] = np.mean([q_loss(q, y, predictions[str(np.round(q, 4))]) for q in net.quantiles])
+
+    print(f"cores: {os.cpu_count()}, quantiles: {len(net.quantiles)}, samples: {len(X)}")
+    for name, timing in timings.items():
+        print(f"{name}: {timing:.1f} s ({timings['serial'] / timing:.1f}x), mean pinball loss {losses[name]:.5f}")
+
+
+if __name__ == "__main__":
+    main()
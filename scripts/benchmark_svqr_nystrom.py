@@ -0,0 +1,48 @@
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+
+from swotann.QuantReg_Functions import q_loss
+from swotann.QuantReg_Models import svqr
+from swotann.swot_ml import SWOT_ML
+
+'''Compares the approximate (Nystrom) svqr with the exact svqr on each of the
+test CSVs: fit time, average quantile error and the mean absolute difference
+between the predictions of the two models. The exact solver needs memory
+quadratic in the number of rows, so only the first max_rows rows are used.
+
+usage: python scripts/benchmark_svqr_nystrom.py [n_landmarks] [max_rows]'''
+
+
+def main():
+    n_landmarks = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    max_rows = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    for filename in sorted(glob.glob(os.path.join(os.path.dirname(__file__), "..", "tests", "test*.csv"))):
+        net = SWOT_ML()
+        net.import_data_from_csv(filename)
+        X = net.predictors_scaler.fit_transform(net.predictors)[:max_rows]
+        y = net.targets_scaler.fit_transform(np.array(net.targets).reshape(-1, 1)).ravel()[:max_rows]
+
+        results = {}
+        for name, params in [("exact", {}), ("nystrom", {"n_landmarks": n_landmarks, "random_state": 0})]:
+            model = svqr(quantiles=net.quantiles, kernel="rbf", **params)
+            start = time.perf_counter()
+            model.fit(X, y)
+            fit_time = time.perf_counter() - start
+            predictions = model.predict(X)
+            error = np.mean([q_loss(q, y, predictions[str(np.round(q, 4))]) for q in net.quantiles])
+            results[name] = (fit_time, error, predictions)
+
+        difference = np.mean([np.mean(np.abs(results["exact"][2][key] - results["nystrom"][2][key]))
+                              for key in results["exact"][2]])
+        print(f"{os.path.basename(filename)} ({len(X)} rows): "
+              f"exact {results['exact'][0]:.1f} s, error {results['exact'][1]:.5f}; "
+              f"nystrom {results['nystrom'][0]:.2f} s, error {results['nystrom'][1]:.5f}; "
+              f"mean abs difference {difference:.5f}")
+
+
+if __name__ == "__main__":
+    main()
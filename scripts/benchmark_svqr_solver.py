@@ -0,0 +1,43 @@
+import os
+import sys
+import time
+
+import numpy as np
+
+from swotann.QuantReg_Models import svqr
+from swotann.swot_ml import SWOT_ML
+
+'''Compares the fit time of svqr with the quadprog solver, which solves the
+dual problem of each quantile from scratch, and with the active set solver,
+which starts each quantile from the solution of the previous one, for an
+increasing number of quantiles, on the first max_rows rows of tests/test1.csv.
+
+usage: python scripts/benchmark_svqr_solver.py [max_rows]'''
+
+
+def main():
+    max_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    net = SWOT_ML()
+    net.import_data_from_csv(os.path.join(os.path.dirname(__file__), "..", "tests", "test1.csv"))
+    X = net.predictors_scaler.fit_transform(net.predictors)[:max_rows]
+    y = net.targets_scaler.fit_transform(np.array(net.targets).reshape(-1, 1)).ravel()[:max_rows]
+
+    print(f"samples: {len(X)}")
+    for quantiles in (net.quantiles[10:11], net.quantiles[::5], net.quantiles):
+        timings = {}
+        predictions = {}
+        for solver in ("quadprog", "active_set"):
+            model = svqr(quantiles=quantiles, kernel="rbf", solver=solver)
+            start = time.perf_counter()
+            model.fit(X, y)
+            timings[solver] = time.perf_counter() - start
+            predictions[solver] = model.predict(X)
+        difference = np.max([np.max(np.abs(predictions["quadprog"][key] - predictions["active_set"][key]))
+                             for key in predictions["quadprog"]])
+        print(f"{len(quantiles)} quantiles: quadprog {timings['quadprog']:.2f} s, "
+              f"active set {timings['active_set']:.2f} s ({timings['quadprog'] / timings['active_set']:.0f}x), "
+              f"max abs difference {difference:.1e}")
+
+
+if __name__ == "__main__":
+    main()
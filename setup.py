@@ -9,7 +9,8 @@ reqs = [
     "numpy==1.22.3",
     "matplotlib==3.5.2",
     "pandas==1.4.3",
-    "scikit-learn==1.0.2",
+    "scikit-learn==1.1.3",
+    "scipy==1.11.4",
     "xlrd==1.2.0",
     "yattag==1.14",
     "pillow==9.2.0",
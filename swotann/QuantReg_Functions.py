@@ -1,14 +1,22 @@
-import keras
-import keras.backend as K
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
-import tensorflow as tf
-from keras import activations
-from keras import constraints
-from keras import initializers
-from keras import regularizers
 from matplotlib import pyplot as plt
 
+try:
+    import keras
+    import keras.backend as K
+    import tensorflow as tf
+    from keras import activations
+    from keras import constraints
+    from keras import initializers
+    from keras import regularizers
+except ImportError:  # the Keras losses are only used to train with TensorFlow, see QuantReg_NumPy otherwise
+    keras = None
+
 
 def pinball_loss_keras(q):
     def loss(y_true,y_pred):
@@ -47,6 +55,76 @@ def simultaneous_loss_keras(quantiles,eps):
 
     return loss
 
+def mcqrnn_loss(eps):
+    def loss(y_true,y_pred):#y_true holds the target and the quantile level of each sample
+        q=y_true[:,1:2]
+        e=y_true[:,0:1]-y_pred
+        esq=K.square(e)/(2*eps)
+        elin=tf.subtract(K.abs(e),0.5*eps)
+        eesq=esq*K.cast(K.less(K.abs(e),eps),'float32')
+        eelin=elin*K.cast(K.greater_equal(K.abs(e),eps),'float32')
+        ee=eelin+eesq
+        return K.mean(tf.where(e>0,q*ee,(1-q)*ee))
+    return loss
+
+def stacked_pinball_keras(quantiles,eps):
+    def loss(y_true,y_pred):#y_pred has one column per quantile, returns the mean loss of each quantile
+        e=(y_true-y_pred)
+        esq = K.square(e) / (2 * eps)
+        elin = tf.subtract(K.abs(e), 0.5 * eps)
+        eesq = esq * K.cast(K.less(K.abs(e), eps), 'float32')
+        eelin = elin * K.cast(K.greater_equal(K.abs(e), eps), 'float32')
+        ee = eelin + eesq
+        q_e=tf.where(e>0,ee*quantiles,ee*(1-quantiles))
+        return K.mean(q_e,axis=0)
+    return loss
+
+if keras is not None:
+    class MonotoneHidden(keras.layers.Layer):
+        # Fully connected layer, like keras.layers.Dense, whose outputs are increasing in its first `monotone`
+        # inputs: as in the monotone composite quantile regression network of Cannon (2018), the weights of those
+        # inputs are the exponentials of the trained ones, and the activation must be increasing (e.g. tanh)
+        def __init__(self,units,activation=None,kernel_initializer='glorot_uniform',bias_initializer='zeros',
+                     kernel_regularizer=None,bias_regularizer=None,kernel_constraint=None,bias_constraint=None,
+                     monotone=1,**kwargs):
+            super().__init__(**kwargs)
+            self.units=units
+            self.activation=activations.get(activation)
+            self.kernel_initializer=initializers.get(kernel_initializer)
+            self.bias_initializer=initializers.get(bias_initializer)
+            self.kernel_regularizer=regularizers.get(kernel_regularizer)
+            self.bias_regularizer=regularizers.get(bias_regularizer)
+            self.kernel_constraint=constraints.get(kernel_constraint)
+            self.bias_constraint=constraints.get(bias_constraint)
+            self.monotone=monotone
+
+        def build(self,input_shape):
+            self.kernel=self.add_weight(name='kernel',shape=(int(input_shape[-1]),self.units),
+                                        initializer=self.kernel_initializer,regularizer=self.kernel_regularizer,
+                                        constraint=self.kernel_constraint)
+            self.bias=self.add_weight(name='bias',shape=(self.units,),initializer=self.bias_initializer,
+                                      regularizer=self.bias_regularizer,constraint=self.bias_constraint)
+            super().build(input_shape)
+
+        def call(self,inputs):
+            kernel=tf.concat([tf.exp(self.kernel[:self.monotone]),self.kernel[self.monotone:]],axis=0)
+            return self.activation(tf.matmul(inputs,kernel)+self.bias)
+
+        def get_config(self):
+            config=super().get_config()
+            config.update({
+                'units':self.units,
+                'activation':activations.serialize(self.activation),
+                'kernel_initializer':initializers.serialize(self.kernel_initializer),
+                'bias_initializer':initializers.serialize(self.bias_initializer),
+                'kernel_regularizer':regularizers.serialize(self.kernel_regularizer),
+                'bias_regularizer':regularizers.serialize(self.bias_regularizer),
+                'kernel_constraint':constraints.serialize(self.kernel_constraint),
+                'bias_constraint':constraints.serialize(self.bias_constraint),
+                'monotone':self.monotone,
+            })
+            return config
+
 def quantile_loss(q,y_true,y_pred):
     if len(q)==1:
         e=y_true-y_pred
@@ -64,42 +142,154 @@ def q_loss(q,y_true,y_pred):
     loss=np.mean(np.maximum(q*e,(q-1)*e))
     return loss
 
-def evaluate_model(df,quantiles,y_col,save_path=None,save=False,name=None):
-
-    q_score = []
-    for q in quantiles:
-        q_score = np.append(q_score, q_loss(q, df[y_col], df[str(np.round(q, decimals=4))]))
-    Y_test = df[y_col]
-    # Percent Capture
-    cap = np.sum(
-        np.less_equal(df[y_col], df['0.9999']) * np.greater_equal(df[y_col], df['0.0001']) * 1) / len(
-        df[y_col])
-    pw=np.mean(df['0.9999']-df['0.0001'])
-    for i in np.arange(0.1,1,0.1):
-        upper=str(np.round(1-i/2,2))
-        lower = str(np.round(i / 2, 2))
-        cap=np.append(cap,np.sum(np.less_equal(df[y_col], df[upper]) * np.greater_equal(df[y_col], df[lower]) * 1) / len(
-        df[y_col]))
-        pw=np.append(pw,np.mean(df[upper]-df[lower]))
-
-    ACE = np.mean(np.abs(cap-np.flip(np.arange(0.1, 1.05, 0.1))))
-    capture_all_02 = np.sum(
-        np.less_equal(df[y_col], df['0.9999']) * np.greater_equal(df[y_col], df['0.0001']) * np.less(df[y_col],
-                                                                                                     0.2) * 1) / np.sum(
-        np.less(df[y_col], 0.2) * 1)
-
-    R = np.max(df[y_col]) - np.min(df[y_col])
-    PINAW = np.array(pw) / (len(y_col) * R)
-
-    average_PINAW = np.mean(PINAW)
-
-    scores = {'Percent Capture': cap[0], 'Percent Capture (HH FRC < 0.2 mg/L)': capture_all_02,
-              'Average Coverage Error': ACE, "Average Prediction Interval Normalized Average Width": average_PINAW,
-              'Average Quantile Error':np.mean(q_score)}
+class QuantilePredictions:
+    # Predictions of all the quantiles as one contiguous array of shape (N, number of quantiles), with the quantile
+    # of each column, converted to the {str(np.round(q,4)): array} dictionaries returned by the models' predict
+    # methods, or to a DataFrame with the same column names, only when they are exported
+    def __init__(self,values,quantiles):
+        self.values=np.ascontiguousarray(values,dtype=np.float64)
+        self.quantiles=np.asarray(quantiles)
+
+    @classmethod
+    def from_dict(cls,preds,quantiles):
+        return cls(np.column_stack([np.ravel(preds[str(np.round(q,decimals=4))]) for q in quantiles]),quantiles)
+
+    @classmethod
+    def from_model(cls,model,X):
+        # Models with a predict_array method predict all the quantiles at once, the others return a dictionary
+        if hasattr(model,'predict_array'):
+            return cls(model.predict_array(X),model.quantiles)
+        return cls.from_dict(model.predict(X),model.quantiles)
+
+    def unscale(self,scaler,lower=0):
+        # Inverse scales all the predictions with a single call to the targets scaler, then sets those that are not
+        # above lower to lower (as DataFrame.where(df>lower,lower) would, including NaN), in place
+        self.values=scaler.inverse_transform(self.values.reshape(-1,1)).reshape(self.values.shape)
+        if lower is not None:
+            np.copyto(self.values,lower,where=~(self.values>lower))
+        return self
+
+    def columns(self):
+        return [str(np.round(q,decimals=4)) for q in self.quantiles]
+
+    def to_dict(self):
+        return dict(zip(self.columns(),self.values.T))
+
+    def to_frame(self,index=None):
+        return pd.DataFrame(self.values,columns=self.columns(),index=index)
+
+def exceedance_probabilities(predictions,quantiles,thresholds,interpolate=False):
+    # Returns an array of shape (N, len(thresholds)) with 1 minus the quantile level whose prediction is closest to
+    # each threshold (or, with interpolate=True, the level linearly interpolated between the two predictions around
+    # the threshold). predictions has one row per sample and one column per quantile, in the order of quantiles,
+    # which must be increasing. Each row is sorted first, so crossing quantiles are rearranged to be monotone.
+    predictions=np.sort(np.asarray(predictions,dtype=np.float64),axis=1)
+    quantiles=np.asarray(quantiles,dtype=np.float64)
+    thresholds=np.asarray(thresholds,dtype=np.float64)
+    N,Nq=predictions.shape
+
+    # Shift every row into its own interval of width span, so that the thresholds of all the rows are located
+    # with a single searchsorted on the flattened predictions
+    low=min(predictions.min(),thresholds.min())
+    span=max(predictions.max(),thresholds.max())-low+1
+    offsets=np.arange(N)[:,None]*span
+    flat=(predictions-low+offsets).ravel()
+    row_start=np.arange(N)[:,None]*Nq
+
+    def locate(values):
+        return np.searchsorted(flat,(values-low+offsets).ravel(),side='left').reshape(values.shape)-row_start
+
+    # predictions[upper-1] < threshold <= predictions[upper]
+    upper=locate(np.broadcast_to(thresholds,(N,len(thresholds))))
+    rows=np.arange(N)[:,None]
+    below=predictions[rows,np.maximum(upper-1,0)]
+    above=predictions[rows,np.minimum(upper,Nq-1)]
+
+    if interpolate:
+        width=np.where(above>below,above-below,1)
+        fraction=np.clip((thresholds-below)/width,0,1)
+        levels=quantiles[np.maximum(upper-1,0)]+fraction*(quantiles[np.minimum(upper,Nq-1)]-quantiles[np.maximum(upper-1,0)])
+        levels=np.where(upper==0,quantiles[0],np.where(upper==Nq,quantiles[-1],levels))
+    else:
+        # As with np.argmin over the unsorted distances, ties go to the lowest quantile
+        use_below=(upper==Nq)|((upper>0)&(thresholds-below<=above-thresholds))
+        nearest=np.where(use_below,below,above)
+        levels=quantiles[locate(nearest)]
+    return 1-levels
+
+def quantile_scores(predictions,y,quantiles):
+    # Vectorized scores of evaluate_model. predictions has shape (..., N, number of quantiles) and y shape (..., N),
+    # so that a batch of bootstrap samples is scored at once; each score has the shape of the leading dimensions.
+    names=[str(np.round(q,decimals=4)) for q in quantiles]
+    q=np.asarray(quantiles)
+    e=y[...,None]-predictions
+    q_score=np.mean(np.maximum(q*e,(q-1)*e),axis=-2)
+
+    # Intervals from the outermost quantiles, then with nominal coverages from 90% down to 10%
+    levels=np.arange(0.1,1,0.1)
+    lower=predictions[...,[names.index('0.0001')]+[names.index(str(np.round(i/2,2))) for i in levels]]
+    upper=predictions[...,[names.index('0.9999')]+[names.index(str(np.round(1-i/2,2))) for i in levels]]
+    inside=np.less_equal(y[...,None],upper)&np.greater_equal(y[...,None],lower)
+    cap=np.mean(inside,axis=-2)
+    pw=np.mean(upper-lower,axis=-2)
+
+    ACE=np.mean(np.abs(cap-np.flip(np.arange(0.1,1.05,0.1))),axis=-1)
+    low=np.less(y,0.2)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        capture_all_02=np.sum(inside[...,0]&low,axis=-1)/np.sum(low,axis=-1)
+
+    R=np.max(y,axis=-1)-np.min(y,axis=-1)
+    PINAW=pw/R[...,None]
+
+    return {'Percent Capture': cap[...,0], 'Percent Capture (HH FRC < 0.2 mg/L)': capture_all_02,
+            'Average Coverage Error': ACE, "Average Prediction Interval Normalized Average Width": np.mean(PINAW,axis=-1),
+            'Average Quantile Error':np.mean(q_score,axis=-1)}
+
+def bootstrap_quantile_scores(predictions,y,quantiles,n,seed):
+    # Scores n bootstrap resamplings of the samples at once
+    idx=np.random.default_rng(seed).integers(0,len(y),(n,len(y)))
+    return quantile_scores(predictions[idx],y[idx],quantiles)
+
+def legacy_pinaw(scores,y_col):
+    # evaluate_model has always divided the PINAW by the length of the name of the observed column as well as by
+    # the range of the observations. The reported scores keep that factor so they can still be compared with
+    # earlier reports, while quantile_scores returns the PINAW itself
+    key="Average Prediction Interval Normalized Average Width"
+    return dict(scores,**{key:scores[key]/len(y_col)})
+
+def evaluate_model(df,quantiles,y_col,save_path=None,save=False,name=None,n_bootstrap=0,confidence=0.95,
+                   batch_size=100,n_jobs=1,seed=None):
+    # Scores the predictions of every quantile (columns named str(np.round(q,4))) against the observations in
+    # y_col. With n_bootstrap > 0, each score also gets the bounds of its bootstrap confidence interval, from
+    # resamplings scored batch_size at a time, in n_jobs processes (-1 for one per core). The scores are returned
+    # and, with save=True, written to save_path+"_calibration_scores.csv".
+    predictions=df[[str(np.round(q,decimals=4)) for q in quantiles]].to_numpy(dtype=np.float64)
+    y=df[y_col].to_numpy(dtype=np.float64)
+    scores={key:float(value) for key,value in legacy_pinaw(quantile_scores(predictions,y,quantiles),y_col).items()}
+
+    if n_bootstrap>0:
+        sizes=[batch_size]*(n_bootstrap//batch_size)+([n_bootstrap%batch_size] if n_bootstrap%batch_size else [])
+        # Each batch has its own seed, so the intervals do not depend on n_jobs
+        seeds=np.random.SeedSequence(seed).spawn(len(sizes))
+        jobs=[(predictions,y,quantiles,size,batch_seed) for size,batch_seed in zip(sizes,seeds)]
+        if n_jobs==1:
+            batches=[bootstrap_quantile_scores(*job) for job in jobs]
+        else:
+            n_jobs=n_jobs if n_jobs>0 else os.cpu_count()
+            with ProcessPoolExecutor(max_workers=min(n_jobs,len(jobs)),
+                                     mp_context=multiprocessing.get_context('spawn')) as executor:
+                batches=list(executor.map(bootstrap_quantile_scores,*zip(*jobs)))
+        batches=[legacy_pinaw(batch,y_col) for batch in batches]
+        for key in list(scores.keys()):
+            samples=np.concatenate([batch[key] for batch in batches])
+            low,high=np.nanpercentile(samples,[50*(1-confidence),50*(1+confidence)])
+            scores[key+' (CI low)']=low
+            scores[key+' (CI high)']=high
+
     if save==True:
         scores_df=pd.Series(data=scores.values(),index=scores.keys())
         scores_df.to_csv(save_path+"_calibration_scores.csv")
-    return
+    return scores
 
 def CI_fig(CI,CI_02):
     x=np.arange(0.1,1.05,0.1)
@@ -1,11 +1,19 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
 import cvxopt
 import keras
 import numpy as np
 import quadprog
 import tensorflow as tf
-from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
+from scipy.optimize import minimize
+from scipy.sparse import csr_matrix
+from sklearn.ensemble import GradientBoostingRegressor, HistGradientBoostingRegressor, RandomForestRegressor
 from sklearn.model_selection import KFold
 from swotann import QuantReg_Functions
+from swotann.QuantReg_NumPy import NUMPY_ACTIVATIONS
 
 # from quadprog import solve_qp
 cvxopt.solvers.options['maxiters'] = 100
@@ -13,11 +21,209 @@ cvxopt.solvers.options['feastol'] = 1e-7
 cvxopt.solvers.options['reltol'] = 1e-6
 cvxopt.solvers.options['abstol'] = 1e-7
 
+# tf.keras.backend.clear_session resets global Keras state (e.g. the counters used to name layers), so models are
+# built while holding this lock to allow several models to be trained at the same time in one process
+KERAS_LOCK = threading.Lock()
+
+def keras_optimizer(optimizer):
+    # 'L-BFGS' is not a Keras optimizer: models trained with fit_lbfgs are still compiled, with an optimizer that is
+    # never used
+    return 'Nadam' if optimizer == 'L-BFGS' else optimizer
+
+
+class LBFGSEarlyStop(Exception):
+    '''Raised by the callback of fit_lbfgs to stop scipy's minimize, which only handles StopIteration itself since
+    scipy 1.11.'''
+
+
+def fit_lbfgs(model, loss, X, y, validation_percent, max_iter=1000, min_delta=0.00000001, patience=200):
+    '''Trains a Keras model by minimizing the loss over all the training data at once with L-BFGS (scipy's
+    L-BFGS-B), which takes far fewer evaluations of the loss than minibatch optimizers for networks as small as the
+    ones in this module. As with validation_split, the end of X is held out for validation, and training stops
+    early, with the best weights restored, once the validation loss has not improved for patience iterations.
+
+    :return: Number of evaluations of the loss and its gradient
+    '''
+    split_at = int(np.floor(len(X) * (1 - validation_percent)))
+    X = tf.constant(X, dtype=tf.float32)
+    y = tf.constant(np.reshape(y, (len(y), -1)), dtype=tf.float32)
+    X_train, y_train, X_val, y_val = X[:split_at], y[:split_at], X[split_at:], y[split_at:]
+    model.build((None, X.shape[1]))
+    variables = model.trainable_variables
+    sizes = [int(np.prod(variable.shape)) for variable in variables]
+
+    def assign(weights):
+        for variable, value in zip(variables, tf.split(tf.cast(weights, tf.float32), sizes)):
+            variable.assign(tf.reshape(value, variable.shape))
+
+    @tf.function
+    def loss_and_gradient(weights):
+        assign(weights)
+        with tf.GradientTape() as tape:
+            value = loss(y_train, model(X_train, training=True))
+        gradients = tape.gradient(value, variables)
+        return value, tf.concat([tf.reshape(gradient, [-1]) for gradient in gradients], axis=0)
+
+    @tf.function
+    def validation_loss(weights):
+        assign(weights)
+        return loss(y_val, model(X_val, training=False))
+
+    best = {'loss': np.inf, 'weights': None, 'wait': 0, 'evaluations': 0}
+
+    def objective(weights):
+        best['evaluations'] += 1
+        value, gradient = loss_and_gradient(tf.constant(weights))
+        return float(value), gradient.numpy().astype(np.float64)
+
+    def callback(weights):
+        val_loss = float(validation_loss(tf.constant(weights)))
+        best['wait'] += 1
+        if val_loss - min_delta < best['loss']:
+            best.update({'loss': val_loss, 'weights': np.copy(weights), 'wait': 0})
+        elif best['wait'] >= patience:
+            raise LBFGSEarlyStop
+
+    start = np.concatenate([variable.numpy().ravel() for variable in variables]).astype(np.float64)
+    try:
+        result = minimize(objective, start, jac=True, method='L-BFGS-B', callback=callback,
+                          options={'maxiter': max_iter, 'ftol': 0, 'gtol': 0})
+        final_weights = result.x
+    except LBFGSEarlyStop:
+        final_weights = None
+    assign(best['weights'] if best['weights'] is not None else final_weights)
+    return best['evaluations']
+
+
+def init_quantile_worker(threads):
+    # Called in each new worker process before TensorFlow starts, so that the workers do not compete for cores
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def fit_quantile_weights(model_class, quantiles, params, q, X, y):
+    model = model_class(quantiles=quantiles, **params)
+    model.build_model()
+    return model.fit_quantile(q, X, y).get_weights()
+
+
+def fit_estimator(estimator, X, y):
+    return estimator.fit(X, y)
+
+
+def fit_quantiles_in_pool(estimator, X, y):
+    '''Fits the network of every quantile of a qrann or mqrann in its own process, with the cores split between
+    estimator.n_jobs workers, and returns the weights of the networks in the order of estimator.quantiles.'''
+    n_jobs = estimator.n_jobs if estimator.n_jobs > 0 else os.cpu_count()
+    n_jobs = min(n_jobs, len(estimator.quantiles))
+    params = dict(estimator.get_params(), n_jobs=1)
+    # TensorFlow is not fork-safe, so the workers are started with spawn
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_quantile_worker,
+                             initargs=(max(1, os.cpu_count() // n_jobs),)) as executor:
+        futures = [executor.submit(fit_quantile_weights, type(estimator), estimator.quantiles, params, q, X, y)
+                   for q in estimator.quantiles]
+        return [future.result() for future in futures]
+
+
+class StackedEarlyStopping(tf.keras.callbacks.Callback):
+    '''Early stopping of each quantile of a stacked model, with the same rules as
+    tf.keras.callbacks.EarlyStopping(monitor='val_loss', restore_best_weights=True) for a model of a single quantile.
+    Once a quantile stops, its best weights are restored, its loss is masked out and its optimizer slots are zeroed
+    so that only the remaining quantiles are trained, and training stops once every quantile has stopped.'''
+
+    def __init__(self, branches, mask, loss, X_val, y_val, min_delta=0.00000001, patience=100):
+        super().__init__()
+        self.branches = branches
+        self.mask = mask
+        self.loss = loss
+        self.X_val = X_val
+        self.y_val = y_val
+        self.min_delta = min_delta
+        self.patience = patience
+        self.best = np.full(len(branches), np.inf)
+        self.best_weights = [None] * len(branches)
+        self.wait = np.zeros(len(branches), dtype=int)
+        self.stopped = np.zeros(len(branches), dtype=bool)
+
+    def on_epoch_end(self, epoch, logs=None):
+        val_loss = self.loss(self.y_val, self.model(self.X_val, training=False)).numpy()
+        for i, branch in enumerate(self.branches):
+            if self.stopped[i]:
+                continue
+            if self.best_weights[i] is None:
+                self.best_weights[i] = branch.get_weights()
+            self.wait[i] += 1
+            if val_loss[i] - self.min_delta < self.best[i]:
+                self.best[i] = val_loss[i]
+                self.best_weights[i] = branch.get_weights()
+                self.wait[i] = 0
+            elif self.wait[i] >= self.patience and epoch > 0:
+                self.stopped[i] = True
+                branch.set_weights(self.best_weights[i])
+                self.freeze(branch)
+        self.mask.assign(np.float32(~self.stopped))
+        if self.stopped.all():
+            self.model.stop_training = True
+
+    def freeze(self, branch):
+        # With a masked loss the gradients of the branch are zero, but Adam-type optimizers would keep moving its
+        # weights with their momentum. With zeroed slots, their updates are zero.
+        optimizer = self.model.optimizer
+        if not hasattr(optimizer, 'get_slot_names'):
+            return
+        for variable in branch.trainable_variables:
+            for name in optimizer.get_slot_names():
+                slot = optimizer.get_slot(variable, name)
+                slot.assign(tf.zeros_like(slot))
+
+    def on_train_end(self, logs=None):
+        # Restore the best weights of the stopped quantiles again, in case the optimizer still moved them
+        for i, branch in enumerate(self.branches):
+            if self.stopped[i]:
+                branch.set_weights(self.best_weights[i])
+
+
+def fit_stacked_quantiles(estimator, X, y):
+    '''Fits the networks of all the quantiles of a qrann or mqrann as a single Keras model, with the networks side by
+    side and the sum of their losses minimized, so that each batch takes one optimizer step for every quantile.
+    The networks are independent, so each one is trained as if it was fitted on its own. The validation data is the
+    end of X, as with validation_split in Keras.
+
+    :return: List of the trained networks, in the order of estimator.quantiles
+    '''
+    eps = estimator.epsilon if estimator.loss == 'smoothed' else 0.000000000000000000000000001
+    y = np.reshape(y, (-1, 1))
+    split_at = int(np.floor(len(X) * (1 - estimator.val)))
+    with KERAS_LOCK:
+        tf.keras.backend.clear_session()
+        inputs = tf.keras.Input(shape=(np.shape(X)[1],))
+        # Rename the networks, since the layers of a Keras model must have unique names
+        branches = [tf.keras.models.Sequential(estimator.make_branch().layers, name='quantile_' + str(i))
+                    for i in range(len(estimator.quantiles))]
+        outputs = tf.keras.layers.Concatenate()([branch(inputs) for branch in branches])
+        model = tf.keras.Model(inputs=inputs, outputs=outputs)
+
+        mask = tf.Variable(np.ones(len(estimator.quantiles), dtype=np.float32), trainable=False)
+        quantile_loss = QuantReg_Functions.stacked_pinball_keras(
+            tf.constant(estimator.quantiles, dtype=tf.float32), eps)
+        model.compile(optimizer=keras_optimizer(estimator.optimizer),
+                      loss=lambda y_true, y_pred: tf.reduce_sum(mask * quantile_loss(y_true, y_pred)))
+    if estimator.optimizer == 'L-BFGS':
+        # The networks are independent, so minimizing the sum of their losses minimizes each of them
+        fit_lbfgs(model, lambda y_true, y_pred: tf.reduce_sum(quantile_loss(y_true, y_pred)), X, y, estimator.val)
+        return branches
+    early_stopping_monitor = StackedEarlyStopping(branches, mask, quantile_loss,
+                                                  tf.constant(X[split_at:], dtype=tf.float32),
+                                                  tf.constant(y[split_at:], dtype=tf.float32))
+    model.fit(X[:split_at], y[:split_at], epochs=500, callbacks=[early_stopping_monitor], verbose=False)
+    return branches
+
 
 class qrann:
     def __init__(self, quantiles, hidden_activation='tanh', kernel_initializer='GlorotNormal',
                  output_activation='linear', loss='pinball', n_hidden=2, hl_size=4, optimizer='Nadam',
-                 validation_percent=0.1, epsilon=10, left_censor=None):
+                 validation_percent=0.1, epsilon=10, left_censor=None, n_jobs=1, engine='separate'):
         self.quantiles = quantiles
         self.No = 1
 
@@ -42,9 +248,20 @@ class qrann:
         self.left_censor = left_censor
         self.Ni = None
         self.val = validation_percent
+        self.n_jobs = n_jobs
+        if engine not in ('separate', 'stacked'):
+            raise ValueError("Acceptable engines are 'separate' or 'stacked'")
+        self.engine = engine
         self.models = {}
         return
 
+    def get_params(self):
+        return {'hidden_activation': self.hidden_activation, 'kernel_initializer': self.kernel_initializer,
+                'output_activation': self.output_activation, 'loss': self.loss, 'n_hidden': self.n_hidden,
+                'hl_size': self.Nh, 'optimizer': self.optimizer, 'validation_percent': self.val,
+                'epsilon': getattr(self, 'epsilon', 10), 'left_censor': self.left_censor, 'n_jobs': self.n_jobs,
+                'engine': self.engine}
+
     def build_model(self):
         model = tf.keras.models.Sequential()
         for i in range(self.n_hidden):
@@ -56,19 +273,13 @@ class qrann:
                                         activation=self.output_activation))
         if self.left_censor is not None:
             model.add(tf.keras.layers.ThresholdedReLU(theta=self.left_censor))
-        model.compile(optimizer=self.optimizer, loss=self.loss, loss_weights=None)
+        model.compile(optimizer=keras_optimizer(self.optimizer), loss=self.loss, loss_weights=None)
         self.build_status = 1
         self.base_model = model
         return
 
-    def fit(self, X, y):
-        if self.build_status == 0:
-            self.build_model()
-
-        early_stopping_monitor = tf.keras.callbacks.EarlyStopping(monitor='val_loss', min_delta=0.00000001,
-                                                                  patience=100,
-                                                                  restore_best_weights=True)
-        for q in self.quantiles:
+    def make_model(self, q):
+        with KERAS_LOCK:
             tf.keras.backend.clear_session()
             model = tf.keras.models.clone_model(self.base_model)
 
@@ -80,9 +291,41 @@ class qrann:
                 # model.cost=QuantReg_Functions.pinball_loss_keras(q)
                 model.cost = QuantReg_Functions.smoothed_pinball_keras(q, 0.000000000000000000000000001)
 
-            model.compile(optimizer=self.optimizer, loss=model.cost)
-            model.fit(X, y, validation_split=self.val, epochs=500, callbacks=[early_stopping_monitor], verbose=False)
-            self.models.update({str(q): model})
+            model.compile(optimizer=keras_optimizer(self.optimizer), loss=model.cost)
+        return model
+
+    def make_branch(self):
+        return tf.keras.models.clone_model(self.base_model)
+
+    def fit_quantile(self, q, X, y):
+        early_stopping_monitor = tf.keras.callbacks.EarlyStopping(monitor='val_loss', min_delta=0.00000001,
+                                                                  patience=100,
+                                                                  restore_best_weights=True)
+        model = self.make_model(q)
+        if self.optimizer == 'L-BFGS':
+            fit_lbfgs(model, model.cost, X, y, self.val)
+        else:
+            model.fit(X, y, validation_split=self.val, epochs=500, callbacks=[early_stopping_monitor],
+                      verbose=False)
+        return model
+
+    def fit(self, X, y):
+        with KERAS_LOCK:
+            if self.build_status == 0:
+                self.build_model()
+
+        if self.engine == 'stacked':
+            for q, model in zip(self.quantiles, fit_stacked_quantiles(self, X, y)):
+                self.models.update({str(q): model})
+        elif self.n_jobs == 1:
+            for q in self.quantiles:
+                self.models.update({str(q): self.fit_quantile(q, X, y)})
+        else:
+            for q, weights in zip(self.quantiles, fit_quantiles_in_pool(self, X, y)):
+                model = self.make_model(q)
+                model.build((None, X.shape[1]))
+                model.set_weights(weights)
+                self.models.update({str(q): model})
         self.train_status = 1
         return
 
@@ -99,7 +342,15 @@ class qrann:
 class cqrann:
     def __init__(self, quantiles, hidden_activation='tanh', kernel_initializer='GlorotUniform',
                  output_activation='linear', loss='pinball',
-                 epsilon=0, n_hidden=1, hl_size=4, optimizer='Nadam', validation_percent=0.1, left_censor=None):
+                 epsilon=0, n_hidden=1, hl_size=4, optimizer='Nadam', validation_percent=0.1, left_censor=None,
+                 seed=None, engine='keras', batch_size=32, epochs_per_call=10, jit_compile=True):
+        """
+        :param optimizer: Keras optimizer, or 'L-BFGS' to train with fit_lbfgs
+        :param engine: 'keras' trains with model.fit, 'compiled' with fit_compiled
+        :param batch_size: Batch size of the compiled engine, None for full batch training
+        :param epochs_per_call: Number of epochs run by each call of the compiled training function
+        :param jit_compile: Compile the training function of the compiled engine with XLA
+        """
         self.quantiles = quantiles
         self.No = len(quantiles)
 
@@ -120,48 +371,233 @@ class cqrann:
         self.left_censor = None
         if left_censor is not None:
             self.left_censor = left_censor
+        self.seed = seed
+        if engine not in ('keras', 'compiled'):
+            raise ValueError("Acceptable engines are 'keras' or 'compiled'")
+        self.engine = engine
+        self.batch_size = batch_size
+        self.epochs_per_call = epochs_per_call
+        self.jit_compile = jit_compile
         self.build_status = 0
         self.train_status = 0
 
         self.Ni = None
         self.val = validation_percent
         self.models = {}
+        self.epochs_trained = None
         return
 
+    def layer_initializer(self, layer):
+        # Each layer needs its own seed, otherwise layers of the same shape start with identical weights
+        seed = None if self.seed is None else self.seed + layer
+        if self.optimizer == 'L-BFGS':
+            # Unlike Adam-type optimizers, L-BFGS does not rescale the tiny gradients of the deeper layers that the
+            # small "uniform" weights give, and stops at the unconditional quantiles
+            return tf.keras.initializers.get({'class_name': self.kernel_initializer, 'config': {'seed': seed}})
+        if self.seed is None:
+            return "uniform"
+        return tf.keras.initializers.RandomUniform(seed=seed)
+
     def build_model(self):
         model = tf.keras.models.Sequential()
         for i in range(self.n_hidden):
-            model.add(tf.keras.layers.Dense(self.Nh, activation=self.hidden_activation, kernel_initializer="uniform",
-                                            bias_initializer="zeros"))
-        model.add(tf.keras.layers.Dense(self.No, kernel_initializer="uniform", bias_initializer="zeros",
-                                        activation=self.output_activation))
+            model.add(tf.keras.layers.Dense(self.Nh, activation=self.hidden_activation,
+                                            kernel_initializer=self.layer_initializer(i), bias_initializer="zeros"))
+        model.add(tf.keras.layers.Dense(self.No, kernel_initializer=self.layer_initializer(self.n_hidden),
+                                        bias_initializer="zeros", activation=self.output_activation))
         if self.left_censor is not None:
             model.add(tf.keras.layers.ThresholdedReLU(theta=self.left_censor))
-        model.compile(optimizer=self.optimizer, loss=self.loss, loss_weights=None)
+        model.compile(optimizer=keras_optimizer(self.optimizer), loss=self.loss, loss_weights=None)
         self.build_status = 1
         self.base_model = model
         return
 
-    def fit(self, X, y):
-        if self.build_status == 0:
-            self.build_model()
-
+    def fit(self, X, y, epochs=500):
+        """
+        :param epochs: Maximum number of epochs, which training stops before once early stopping is triggered. The
+            number of epochs run is kept in self.epochs_trained (None when training with L-BFGS)
+        """
         early_stopping_monitor = tf.keras.callbacks.EarlyStopping(monitor='val_loss', min_delta=0.00000001,
                                                                   patience=100,
                                                                   restore_best_weights=True)
 
-        tf.keras.backend.clear_session()
-        model = tf.keras.models.clone_model(self.base_model)
+        with KERAS_LOCK:
+            if self.build_status == 0:
+                self.build_model()
 
-        if self.loss == 'smoothed':
-            model.cost = QuantReg_Functions.simultaneous_loss_keras(self.quantiles, self.epsilon)
-        else:
-            # model.cost=QuantReg_Functions.pinball_loss_keras(self.quantiles)
-            model.cost = QuantReg_Functions.simultaneous_loss_keras(self.quantiles, 0.0000000000000000000000000000001)
+            tf.keras.backend.clear_session()
+            model = tf.keras.models.clone_model(self.base_model)
+            # The weights are created here rather than when fit first calls the model. clear_session has just reset
+            # the random streams of the seeded initializers, which concurrent jobs with overlapping seeds would
+            # otherwise draw from in whatever order they run
+            model.build((None, np.shape(X)[1]))
 
-        model.compile(optimizer=self.optimizer, loss=model.cost)
-        model.fit(X, y, validation_split=self.val, epochs=500, callbacks=[early_stopping_monitor], verbose=False)
+            if self.loss == 'smoothed':
+                model.cost = QuantReg_Functions.simultaneous_loss_keras(self.quantiles, self.epsilon)
+            else:
+                # model.cost=QuantReg_Functions.pinball_loss_keras(self.quantiles)
+                model.cost = QuantReg_Functions.simultaneous_loss_keras(self.quantiles, 0.0000000000000000000000000000001)
+
+            model.compile(optimizer=keras_optimizer(self.optimizer), loss=model.cost)
+        if self.optimizer == 'L-BFGS':
+            fit_lbfgs(model, model.cost, X, y, self.val)
+            self.epochs_trained = None
+        elif self.engine == 'compiled':
+            self.epochs_trained = self.fit_compiled(model, X, y, epochs=epochs)
+        else:
+            history = model.fit(X, y, validation_split=self.val, epochs=epochs, callbacks=[early_stopping_monitor],
+                                verbose=False)
+            self.epochs_trained = len(history.history['loss'])
         self.model = model
+        self.extract_weights()
+        self.train_status = 1
+        return
+
+    def fit_compiled(self, model, X, y, epochs=500, min_delta=0.00000001, patience=100):
+        """
+        Trains the compiled model like model.fit with validation_split=self.val and the EarlyStopping callback of fit,
+        but with the data kept as tensors and a training function compiled with tf.function (and XLA if
+        self.jit_compile) that runs self.epochs_per_call epochs per call, including the early stopping, so that
+        Python and Keras only run once every few epochs instead of at every batch.
+
+        :param model: Model compiled with its optimizer and loss (model.cost)
+        :return: Number of epochs run
+        """
+        split_at = int(np.floor(len(X) * (1 - self.val)))
+        X = tf.constant(X, dtype=tf.float32)
+        y = tf.constant(np.reshape(y, (len(y), -1)), dtype=tf.float32)
+        X_train, y_train, X_val, y_val = X[:split_at], y[:split_at], X[split_at:], y[split_at:]
+        batch_size = split_at if self.batch_size is None else min(self.batch_size, split_at)
+        n_batches, remainder = divmod(split_at, batch_size)
+
+        model.build((None, X.shape[1]))
+        variables = model.trainable_variables
+        optimizer = model.optimizer
+        # The slots must exist before tracing train_epochs. The legacy OptimizerV2 of TensorFlow < 2.11 has no build,
+        # but creates them with _create_all_weights without applying any update
+        if hasattr(optimizer, 'build'):
+            optimizer.build(variables)
+        else:
+            optimizer._create_all_weights(variables)
+        best_weights = [tf.Variable(variable) for variable in variables]
+        best_loss = tf.Variable(np.inf, dtype=tf.float32)
+        wait = tf.Variable(0)
+        epoch = tf.Variable(0)
+        stopped = tf.Variable(False)
+        # XLA ignores the seeds of stateful random ops, so the shuffling uses a stateless op seeded with the epoch
+        shuffle_seed = self.seed if self.seed is not None else np.random.randint(2 ** 31)
+
+        def train_step(index):
+            with tf.GradientTape() as tape:
+                loss = model.cost(tf.gather(y_train, index), model(tf.gather(X_train, index), training=True))
+            optimizer.apply_gradients(zip(tape.gradient(loss, variables), variables))
+
+        @tf.function(jit_compile=self.jit_compile)
+        def train_epochs():
+            for i in tf.range(self.epochs_per_call):
+                order = tf.argsort(tf.random.stateless_uniform([split_at], seed=tf.stack([shuffle_seed, epoch])))
+                for batch in tf.range(n_batches):
+                    train_step(tf.slice(order, [batch * batch_size], [batch_size]))
+                if remainder > 0:
+                    train_step(order[n_batches * batch_size:])
+
+                val_loss = model.cost(y_val, model(X_val, training=False))
+                wait.assign_add(1)
+                if val_loss - min_delta < best_loss:
+                    best_loss.assign(val_loss)
+                    wait.assign(0)
+                    for best, variable in zip(best_weights, variables):
+                        best.assign(variable)
+                elif wait >= patience and epoch > 0:
+                    stopped.assign(True)
+                epoch.assign_add(1)
+                if stopped or epoch >= epochs:
+                    break
+
+        while not stopped.numpy() and epoch.numpy() < epochs:
+            train_epochs()
+        # As with EarlyStopping, the best weights are only restored if training stopped early
+        if stopped.numpy():
+            for best, variable in zip(best_weights, variables):
+                variable.assign(best)
+        return int(epoch.numpy())
+
+    def extract_weights(self):
+        """
+        Copies the weights of the Dense layers of self.model (and the threshold of the ThresholdedReLU output, if the
+        model is left censored) to NumPy arrays, so that predictions can be made without calling Keras.
+        """
+        self.layers = []
+        self.censor_theta = None
+        for layer in self.model.layers:
+            if isinstance(layer, tf.keras.layers.Dense):
+                activation = layer.get_config()['activation']
+                if activation not in NUMPY_ACTIVATIONS:
+                    raise ValueError("Acceptable activations are " + ", ".join(NUMPY_ACTIVATIONS.keys()))
+                kernel, bias = layer.get_weights()
+                self.layers.append((kernel, bias, activation))
+            elif isinstance(layer, tf.keras.layers.ThresholdedReLU):
+                self.censor_theta = layer.get_config()['theta']
+        return
+
+    def predict_array(self, X):
+        """
+        Forward pass of the network in NumPy, giving the same results as self.model.predict(X) without the
+        overhead of calling Keras. Computations are in float32, as in Keras.
+
+        :param X: Array of scaled inputs, of shape (N, Ni)
+        :return: Array of scaled predictions, of shape (N, number of quantiles)
+        """
+        if self.train_status == 0:
+            raise ValueError("Model must be trained before predicting")
+
+        out = np.asarray(X, dtype=np.float32)
+        for kernel, bias, activation in self.layers:
+            out = NUMPY_ACTIVATIONS[activation](out @ kernel + bias)
+        if self.censor_theta is not None:
+            out = out * (out > self.censor_theta)
+        return out
+
+    def get_params(self):
+        """
+        :return: Dictionary of the hyperparameters the model was created with, other than the quantiles
+        """
+        return {'hidden_activation': self.hidden_activation, 'kernel_initializer': self.kernel_initializer,
+                'output_activation': self.output_activation, 'loss': self.loss,
+                'epsilon': getattr(self, 'epsilon', 0), 'n_hidden': self.n_hidden, 'hl_size': self.Nh,
+                'optimizer': self.optimizer, 'validation_percent': self.val, 'left_censor': self.left_censor,
+                'seed': self.seed, 'engine': self.engine, 'batch_size': self.batch_size,
+                'epochs_per_call': self.epochs_per_call, 'jit_compile': self.jit_compile}
+
+    def save_weights(self, filename):
+        """
+        Saves the weights extracted from the trained model to a NumPy .npz file, which can be loaded with
+        load_weights to make predictions without retraining (or calling Keras).
+
+        :param filename: String containing the filename of the .npz file
+        """
+        if self.train_status == 0:
+            raise ValueError("Model must be trained before saving")
+        arrays = {'activations': np.array([activation for kernel, bias, activation in self.layers])}
+        for i, (kernel, bias, activation) in enumerate(self.layers):
+            arrays['kernel' + str(i)] = kernel
+            arrays['bias' + str(i)] = bias
+        if self.censor_theta is not None:
+            arrays['censor_theta'] = np.array(self.censor_theta)
+        np.savez(filename, **arrays)
+        return
+
+    def load_weights(self, filename):
+        """
+        Loads weights saved with save_weights, after which the model can be used for predictions.
+
+        :param filename: String containing the filename of the .npz file
+        """
+        with np.load(filename) as arrays:
+            self.layers = [(arrays['kernel' + str(i)], arrays['bias' + str(i)], str(activation))
+                           for i, activation in enumerate(arrays['activations'])]
+            self.censor_theta = float(arrays['censor_theta']) if 'censor_theta' in arrays else None
+        self.model = None
         self.train_status = 1
         return
 
@@ -169,7 +605,7 @@ class cqrann:
         if self.train_status == 0:
             raise ValueError("Model must be trained before predicting")
 
-        predarray = self.model.predict(X)
+        predarray = self.predict_array(X)
         preds = {}
         for q in range(len(self.quantiles)):
             preds.update({str(np.round(self.quantiles[q], decimals=4)): predarray[:, q]})
@@ -179,7 +615,8 @@ class cqrann:
 class mqrann:
     def __init__(self, quantiles, hidden_activation='tanh', kernel_initializer='GlorotUniform',
                  output_activation='linear', loss='pinball', n_hidden=1, hl_size=4, optimizer='Nadam',
-                 validation_percent=0.1, epsilon=10, left_censor=None, monotone_indices=[0]):
+                 validation_percent=0.1, epsilon=10, left_censor=None, monotone_indices=[0], n_jobs=1,
+                 engine='separate'):
         self.quantiles = quantiles
         self.No = 1
 
@@ -205,9 +642,20 @@ class mqrann:
         self.left_censor = left_censor
         self.Ni = None
         self.val = validation_percent
+        self.n_jobs = n_jobs
+        if engine not in ('separate', 'stacked'):
+            raise ValueError("Acceptable engines are 'separate' or 'stacked'")
+        self.engine = engine
         self.models = {}
         return
 
+    def get_params(self):
+        return {'hidden_activation': self.hidden_activation, 'kernel_initializer': self.kernel_initializer,
+                'output_activation': self.output_activation, 'loss': self.loss, 'n_hidden': self.n_hidden,
+                'hl_size': self.Nh, 'optimizer': self.optimizer, 'validation_percent': self.val,
+                'epsilon': getattr(self, 'epsilon', 10), 'left_censor': self.left_censor,
+                'monotone_indices': self.monotone_indices, 'n_jobs': self.n_jobs, 'engine': self.engine}
+
     def build_model(self):
         if self.n_hidden <= 2:
             model = tf.keras.models.Sequential()
@@ -220,7 +668,7 @@ class mqrann:
                                             activation=self.output_activation))
             if self.left_censor is not None:
                 model.add(tf.keras.layers.ThresholdedReLU(theta=self.left_censor))
-            model.compile(optimizer=self.optimizer, loss=self.loss, loss_weights=None)
+            model.compile(optimizer=keras_optimizer(self.optimizer), loss=self.loss, loss_weights=None)
             self.build_status = 1
             # self.base_model = model
 
@@ -239,19 +687,47 @@ class mqrann:
                                             activation=self.output_activation))
             if self.left_censor is not None:
                 model.add(tf.keras.layers.ThresholdedReLU(theta=self.left_censor))
-            model.compile(optimizer=self.optimizer, loss=self.loss, loss_weights=None)
+            model.compile(optimizer=keras_optimizer(self.optimizer), loss=self.loss, loss_weights=None)
             self.build_status = 1
             # self.base_model = model
 
         return model
 
-    def fit(self, X, y):
-        if self.build_status == 0:
-            self.build_model()
+    def make_model(self, q):
+        with KERAS_LOCK:
+            tf.keras.backend.clear_session()
+            # model = tf.keras.models.clone_model(self.base_model)
+            model = self.build_model()
+
+            if self.loss == 'smoothed':
+                model.cost = QuantReg_Functions.smoothed_pinball_keras(q, self.epsilon)
+            else:
+                model.cost = QuantReg_Functions.smoothed_pinball_keras(q, 0.000000000000000000000000001)
+
+            model.compile(optimizer=keras_optimizer(self.optimizer), loss=model.cost)
+        return model
+
+    def make_branch(self):
+        return self.build_model()
 
+    def fit_quantile(self, q, X, y):
+        # X must already have the monotone inputs first, as in fit
         early_stopping_monitor = tf.keras.callbacks.EarlyStopping(monitor='val_loss', min_delta=0.00000001,
                                                                   patience=100,
                                                                   restore_best_weights=True)
+        model = self.make_model(q)
+        if self.optimizer == 'L-BFGS':
+            fit_lbfgs(model, model.cost, X, y, self.val)
+        else:
+            model.fit(X, y, validation_split=self.val, epochs=500, callbacks=[early_stopping_monitor],
+                      verbose=False)
+        return model
+
+    def fit(self, X, y):
+        with KERAS_LOCK:
+            if self.build_status == 0:
+                self.build_model()
+
         new_X = np.zeros(np.shape(X))
         non_monotone_indices = np.delete(np.arange(len(X[0, :])), self.monotone_indices)
 
@@ -262,20 +738,18 @@ class mqrann:
         custom_object = {'MonotoneHidden': QuantReg_Functions.MonotoneHidden}
         keras.utils.get_custom_objects().update(custom_object)
 
-        for q in self.quantiles:
-            tf.keras.backend.clear_session()
-            # model = tf.keras.models.clone_model(self.base_model)
-            model = self.build_model()
-
-            if self.loss == 'smoothed':
-                model.cost = QuantReg_Functions.smoothed_pinball_keras(q, self.epsilon)
-            else:
-                model.cost = QuantReg_Functions.smoothed_pinball_keras(q, 0.000000000000000000000000001)
-
-            model.compile(optimizer=self.optimizer, loss=model.cost)
-            model.fit(new_X, y, validation_split=self.val, epochs=500, callbacks=[early_stopping_monitor],
-                      verbose=False)
-            self.models.update({str(q): model})
+        if self.engine == 'stacked':
+            for q, model in zip(self.quantiles, fit_stacked_quantiles(self, new_X, y)):
+                self.models.update({str(q): model})
+        elif self.n_jobs == 1:
+            for q in self.quantiles:
+                self.models.update({str(q): self.fit_quantile(q, new_X, y)})
+        else:
+            for q, weights in zip(self.quantiles, fit_quantiles_in_pool(self, new_X, y)):
+                model = self.make_model(q)
+                model.build((None, new_X.shape[1]))
+                model.set_weights(weights)
+                self.models.update({str(q): model})
         self.train_status = 1
         return
 
@@ -368,8 +842,9 @@ class mcqrann:
         return
 
     def fit(self, X, y):
-        if self.build_status == 0:
-            self.build_model(in_shape=len(X[0, :]) + 1)
+        with KERAS_LOCK:
+            if self.build_status == 0:
+                self.build_model(in_shape=len(X[0, :]) + 1)
 
         new_X = np.zeros(np.shape(X))
         non_monotone_indices = np.delete(np.arange(len(X[0, :])), self.monotone_indices)
@@ -379,31 +854,27 @@ class mcqrann:
         for j in range(len(non_monotone_indices)):
             new_X[:, len(self.monotone_indices) + j] = X[:, non_monotone_indices[j]]
 
-        inp_quant = np.repeat(self.quantiles, len(y))
-        inp_rep = np.tile(new_X.T, len(self.quantiles))
-        X_use = np.vstack((inp_quant, inp_rep))
-        y_use = np.repeat(y, len(self.quantiles))
-
         early_stopping_monitor = keras.callbacks.EarlyStopping(monitor='val_loss', min_delta=0.00000001,
                                                                patience=100,
                                                                restore_best_weights=True)
         # x_train,x_val,y_train,y_val=train_test_split(X_use,y_use,test_size=self.val,shuffle=True)
 
-        tf.keras.backend.clear_session()
-        model = keras.models.clone_model(self.base_model)
+        with KERAS_LOCK:
+            tf.keras.backend.clear_session()
+            model = keras.models.clone_model(self.base_model)
 
-        if self.loss == 'smoothed':
-            model.cost = QuantReg_Functions.mcqrnn_loss(model.input, self.epsilon)
+            if self.loss == 'smoothed':
+                model.cost = QuantReg_Functions.mcqrnn_loss(self.epsilon)
 
 
-        else:
-            # model.cost=QuantReg_Functions.pinball_loss_keras(self.quantiles)
+            else:
+                # model.cost=QuantReg_Functions.pinball_loss_keras(self.quantiles)
 
-            model.cost = QuantReg_Functions.mcqrnn_loss(model.input, 0.0000000000000000000000000000001)
+                model.cost = QuantReg_Functions.mcqrnn_loss(0.0000000000000000000000000000001)
 
-        model.compile(optimizer=self.optimizer, loss=model.cost)
+            model.compile(optimizer=self.optimizer, loss=model.cost)
         # model.fit(X_use.T, y_use, validation_split=self.val, callbacks=[early_stopping_monitor], epochs=500, verbose=False)
-        model.fit(X_use.T, y_use, epochs=500, verbose=False)
+        model.fit(self.quantile_dataset(new_X, y, shuffle=True), epochs=500, verbose=False)
         self.model = model
         self.train_status = 1
         return
@@ -420,23 +891,73 @@ class mcqrann:
         for j in range(len(non_monotone_indices)):
             new_X[:, len(self.monotone_indices) + j] = X[:, non_monotone_indices[j]]
 
+        all_preds = self.model.predict(self.quantile_dataset(new_X, batch_size=1024), verbose=0)
+        all_preds = np.reshape(all_preds, (len(self.quantiles), len(X)))
         preds = {}
-        for q in self.quantiles:
-            inp_quant = np.array([q for i in range(len(X[:, 0]))])
-            X_use = np.vstack((inp_quant, new_X.T))
-            preds.update({str(np.round(q, decimals=4)): self.model.predict(X_use.T)})
+        for q, pred in zip(self.quantiles, all_preds):
+            preds.update({str(np.round(q, decimals=4)): pred.reshape(-1, 1)})
 
         return preds
 
+    def quantile_dataset(self, X, y=None, batch_size=32, shuffle=False, seed=None):
+        '''Dataset of the inputs of the network, the quantile level followed by X, for every pair of a sample and a
+        quantile, quantile by quantile. The pairs are built from their index as they are read, so the memory used
+        does not grow with the number of features or quantiles beyond one index per pair.
+
+        :param y: Targets, which are paired with their quantile level for QuantReg_Functions.mcqrnn_loss
+        :param shuffle: Shuffle all the pairs at each epoch, as model.fit does with arrays, from a new random
+            permutation of their indices
+        :param seed: Optional integer seeding the permutations
+        '''
+        n_samples = len(X)
+        n_pairs = n_samples * len(self.quantiles)
+        X = tf.constant(X, dtype=tf.float32)
+        quantiles = tf.constant(self.quantiles, dtype=tf.float32)
+        dataset = tf.data.Dataset.range(n_pairs)
+        if shuffle:
+            # A buffer holding every index gives a uniform permutation of all the pairs, drawn again at every epoch
+            dataset = dataset.shuffle(n_pairs, seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.batch(batch_size)
+
+        if y is None:
+            def pair(index):
+                q = tf.gather(quantiles, index // n_samples)
+                return tf.concat([q[:, None], tf.gather(X, index % n_samples)], axis=1)
+        else:
+            y = tf.constant(np.ravel(y), dtype=tf.float32)
+
+            def pair(index):
+                q = tf.gather(quantiles, index // n_samples)
+                return (tf.concat([q[:, None], tf.gather(X, index % n_samples)], axis=1),
+                        tf.stack([tf.gather(y, index % n_samples), q], axis=1))
+        return dataset.map(pair).prefetch(tf.data.AUTOTUNE)
+
 
 class svqr:
-    def __init__(self, quantiles, C=1, kernel='linear', degree=3, gamma='auto', c0=1):
+    def __init__(self, quantiles, C=1, kernel='linear', degree=3, gamma='auto', c0=1, chunk_size=1024,
+                 n_landmarks=None, epsilon=1e-4, random_state=None, solver='quadprog'):
+        '''
+        :param solver: Solver for the exact dual problem. 'quadprog' solves the problem of each quantile from scratch,
+        'active_set' starts each quantile from the solution of the previous one, see solve_active_set
+        :param n_landmarks: If set, fit an approximate model using the Nystrom approximation of the kernel with this
+        many landmarks sampled from the training data, with memory linear in the number of samples. Otherwise, solve
+        the exact dual problem, which uses memory quadratic in the number of samples.
+        :param epsilon: Width of the smoothing of the pinball loss used by the approximate model
+        :param random_state: Seed for sampling the landmarks
+        '''
         self.C = C
         self.kernel = kernel
         self.quantiles = quantiles
         self.gamma = gamma
         self.c0 = c0
         self.degree = degree
+        self.chunk_size = chunk_size
+        self.n_landmarks = n_landmarks
+        self.epsilon = epsilon
+        self.random_state = random_state
+        if solver not in ('quadprog', 'active_set'):
+            raise ValueError("Acceptable solvers are 'quadprog' or 'active_set'")
+        self.solver = solver
         self.train_status = 0
 
         self.kernel_dict = {
@@ -463,6 +984,8 @@ class svqr:
             self.gamma = 1 / (n_features * X.var())
         if self.gamma == 'auto':
             self.gamma = 1 / n_features
+        if self.n_landmarks is not None:
+            return self.fit_nystrom(X, y)
 
         kern = self.kernel_dict[self.kernel]
         K = kern(X, X)
@@ -475,12 +998,19 @@ class svqr:
         a = y
         C = np.vstack((np.eye(n_samples), -1 * np.eye(n_samples)))
         C = np.vstack((np.ones(n_samples), C))
+        alpha = None
+        previous_q = None
         for q in self.quantiles:
-            b0 = 0.0
-            b0 = np.append(b0, np.array([self.C * (q - 1) for i in range(n_samples)]))
-            b0 = np.append(b0, np.array([-1 * self.C * q for i in range(n_samples)]))
-            res = quadprog.solve_qp(G=G, a=a, C=C.T, b=b0, meq=1)
-            alpha = res[0]
+            if self.solver == 'active_set':
+                start = self.warm_start(G, np.ravel(y), q, alpha, previous_q)
+                alpha = self.solve_active_set(G, np.ravel(y), q, start)
+                previous_q = q
+            if self.solver == 'quadprog' or alpha is None:
+                b0 = 0.0
+                b0 = np.append(b0, np.array([self.C * (q - 1) for i in range(n_samples)]))
+                b0 = np.append(b0, np.array([-1 * self.C * q for i in range(n_samples)]))
+                res = quadprog.solve_qp(G=G, a=a, C=C.T, b=b0, meq=1)
+                alpha = res[0]
             f = np.matmul(alpha, K)
             offshift = np.argmin(
                 (np.round(alpha, 3) - (self.C * q)) ** 2 + (np.round(alpha, 3) - (self.C * (q - 1))) ** 2)
@@ -492,45 +1022,161 @@ class svqr:
         self.train_status = 1
         return
 
-    def linear_kernel_matrix(self, x_mat, y_mat):
-        n_samp_x = x_mat.shape[0]
-        n_samp_y = y_mat.shape[0]
+    def solve_active_set(self, G, y, q, alpha, max_iter=None):
+        '''Solves the dual problem of quantile q, minimize 1/2*alpha^T*G*alpha-alpha^T*y subject to sum(alpha)=0 and
+        C(q-1)<=alpha<=Cq, with the primal active set method (Nocedal and Wright, 2006, Algorithm 16.3). The alphas
+        at their bounds are held fixed and each step solves the equality constrained problem for the others, of which
+        there are few, so that each step only needs a small linear system and the columns of G of the free alphas.
+        Starting from the solution of the neighbouring quantile (see warm_start), only the alphas of the samples that
+        cross the quantile have to change, which takes a few steps each.
+
+        :param alpha: Feasible starting point
+        :return: alpha, or None if the method did not converge
+        '''
+        lower = self.C * (q - 1)
+        upper = self.C * q
+        if max_iter is None:
+            max_iter = 10 * len(y)
+        tol = 1e-9 * max(1, np.max(np.abs(y)))
+
+        fixed = (alpha <= lower) | (alpha >= upper)
+        grad = np.matmul(G, alpha) - y
+        at_minimum = False
+        for i in range(max_iter):
+            free = np.flatnonzero(~fixed)
+            n_free = len(free)
+            if n_free > 0 and not at_minimum:
+                kkt = np.ones((n_free + 1, n_free + 1))
+                kkt[:n_free, :n_free] = G[np.ix_(free, free)]
+                kkt[n_free, n_free] = 0
+                rhs = np.append(-grad[free], 0)
+                try:
+                    step = np.linalg.solve(kkt, rhs)[:n_free]
+                except np.linalg.LinAlgError:
+                    step = np.linalg.lstsq(kkt, rhs, rcond=None)[0][:n_free]
+
+                if np.max(np.abs(step)) > tol:
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        ratios = np.where(step > 0, (upper - alpha[free]) / step,
+                                          np.where(step < 0, (lower - alpha[free]) / step, np.inf))
+                    blocking = np.argmin(ratios)
+                    t = min(1.0, ratios[blocking])
+                    alpha[free] += t * step
+                    grad += t * np.matmul(G[:, free], step)
+                    if t < 1:
+                        index = free[blocking]
+                        alpha[index] = upper if step[blocking] > 0 else lower
+                        fixed[index] = True
+                    # After a full step, alpha minimizes the objective with the current alphas held at their bounds
+                    at_minimum = t == 1
+                    continue
+
+            # Multipliers of the bounds, which must all be >= 0 at the optimum
+            nu = -np.mean(grad[free]) if n_free > 0 else self.bound_multiplier(grad, alpha, lower, upper)
+            multipliers = np.where(alpha <= lower, grad + nu, -(grad + nu))
+            multipliers[~fixed] = np.inf
+            release = np.argmin(multipliers)
+            if multipliers[release] >= -tol:
+                return alpha
+            fixed[release] = False
+            at_minimum = False
+        return None
+
+    def warm_start(self, G, y, q, alpha=None, previous_q=None):
+        '''Starting point for solve_active_set. Shifting the solution of the previous quantile by the change in the
+        bounds keeps it inside the bounds, but its sum becomes n*C*(q-previous_q), so the samples that are closest to
+        moving from the upper to the lower bound (or the reverse, if q decreased) are moved until the sum is 0.
+        Without a previous solution, the samples above the q-quantile of y are put at the upper bound.'''
+        lower = self.C * (q - 1)
+        upper = self.C * q
+        if alpha is None:
+            alpha = np.where(y > np.quantile(y, q), upper, lower)
+            order = np.argsort(y)
+        else:
+            alpha = np.clip(alpha + self.C * (q - previous_q), lower, upper)
+            # Residuals y-f of the previous solution, up to a constant
+            order = np.argsort(y - np.matmul(G, alpha))
+        excess = np.sum(alpha)
+        # Samples closest to the lower bound first when lowering alphas, closest to the upper bound when raising
+        candidates = order if excess > 0 else order[::-1]
+        for index in candidates:
+            if abs(excess) <= 1e-12 * self.C:
+                break
+            target = np.clip(alpha[index] - excess, lower, upper)
+            excess -= alpha[index] - target
+            alpha[index] = target
+        return alpha
+
+    @staticmethod
+    def bound_multiplier(grad, alpha, lower, upper):
+        # Multiplier of sum(alpha)=0 when all alphas are at a bound, the middle of the interval that makes the
+        # multipliers of the bounds non-negative if there is one
+        nu = (np.max(-grad[alpha <= lower], initial=-np.inf) + np.min(-grad[alpha >= upper], initial=np.inf)) / 2
+        return nu if np.isfinite(nu) else 0.0
+
+    def fit_nystrom(self, X, y):
+        '''Approximates the kernel by K=Phi*Phi^T, with the features Phi=K_nm*K_mm^(-1/2) of the Nystrom method,
+        and minimizes the primal problem C*sum(rho_q(y-Phi*w-b))+1/2*w^T*w in the reduced feature space, with the
+        pinball loss rho_q smoothed over epsilon as in QuantReg_Functions.smoothed_pinball_keras. Each quantile is
+        started from the solution of the previous one.'''
+        n_samples = X.shape[0]
+        y = np.ravel(y)
+        rng = np.random.RandomState(self.random_state)
+        landmarks = X[rng.choice(n_samples, min(self.n_landmarks, n_samples), replace=False)]
 
-        kern_mat = np.zeros((n_samp_x, n_samp_y))
-        for i in range(n_samp_x):
-            for j in range(n_samp_y):
-                kern_mat[i, j] = np.dot(x_mat[i], y_mat[j])
+        kern = self.kernel_dict[self.kernel]
+        eigvals, eigvecs = np.linalg.eigh(kern(landmarks, landmarks))
+        keep = eigvals > 1e-10 * np.max(eigvals)
+        self.projection = eigvecs[:, keep] / np.sqrt(eigvals[keep])
+        phi = np.matmul(kern(X, landmarks), self.projection)
+        eps = self.epsilon
+
+        def objective(theta, q):
+            w, b = theta[:-1], theta[-1]
+            e = y - np.matmul(phi, w) - b
+            small = np.abs(e) < eps
+            weight = np.where(e > 0, q, 1 - q)
+            loss = weight * np.where(small, e ** 2 / (2 * eps), np.abs(e) - 0.5 * eps)
+            grad_e = self.C * weight * np.where(small, e / eps, np.sign(e))
+            value = self.C * np.sum(loss) + 0.5 * np.dot(w, w)
+            return value, np.append(w - np.matmul(grad_e, phi), -np.sum(grad_e))
+
+        theta = np.append(np.zeros(phi.shape[1]), np.median(y))
+        for q in self.quantiles:
+            theta = minimize(objective, theta, args=(q,), jac=True, method='L-BFGS-B').x
+            self.models.update({str(q): {'w': theta[:-1], 'b': theta[-1]}})
+        self.sv = landmarks
+        self.train_status = 1
+        return
+
+    def kernel_matrix(self, x_mat, y_mat, kernel_function):
+        '''Computes the kernel matrix chunk_size rows of x_mat at a time, so that the temporary arrays used by
+        kernel_function are at most chunk_size x len(y_mat)'''
+        kern_mat = np.empty((x_mat.shape[0], y_mat.shape[0]))
+        for i in range(0, x_mat.shape[0], self.chunk_size):
+            kern_mat[i:i + self.chunk_size] = kernel_function(x_mat[i:i + self.chunk_size])
         return kern_mat
 
+    def linear_kernel_matrix(self, x_mat, y_mat):
+        return self.kernel_matrix(x_mat, y_mat, lambda x_chunk: np.matmul(x_chunk, y_mat.T))
+
     def rbf_kernel_matrix(self, x_mat, y_mat):
-        n_samp_x = x_mat.shape[0]
-        n_samp_y = y_mat.shape[0]
+        y_sq = np.sum(y_mat ** 2, axis=1)
 
-        kern_mat = np.zeros((n_samp_x, n_samp_y))
-        for i in range(n_samp_x):
-            for j in range(n_samp_y):
-                kern_mat[i, j] = np.exp(-1 * self.gamma * (np.linalg.norm(x_mat[i, :] - y_mat[j, :]) ** 2))
-        return kern_mat
+        def rbf(x_chunk):
+            # |x-y|^2 = |x|^2 + |y|^2 - 2x.y, clipped at 0 since rounding can make it slightly negative
+            sq_dist = np.sum(x_chunk ** 2, axis=1)[:, None] + y_sq[None, :] - 2 * np.matmul(x_chunk, y_mat.T)
+            return np.exp(-1 * self.gamma * np.maximum(sq_dist, 0))
 
-    def sigmoid_kernel_matrix(self, x_mat, y_mat):
-        n_samp_x = x_mat.shape[0]
-        n_samp_y = y_mat.shape[0]
+        return self.kernel_matrix(x_mat, y_mat, rbf)
 
-        kern_mat = np.zeros((n_samp_x, n_samp_y))
-        for i in range(n_samp_x):
-            for j in range(n_samp_y):
-                kern_mat[i, j] = np.tanh(self.gamma * np.dot(x_mat[i], y_mat[j]) + self.c0)
-        return kern_mat
+    def sigmoid_kernel_matrix(self, x_mat, y_mat):
+        return self.kernel_matrix(x_mat, y_mat,
+                                  lambda x_chunk: np.tanh(self.gamma * np.matmul(x_chunk, y_mat.T) + self.c0))
 
     def polynomial_kernel_matrix(self, x_mat, y_mat):
-        n_samp_x = x_mat.shape[0]
-        n_samp_y = y_mat.shape[0]
-
-        kern_mat = np.zeros((n_samp_x, n_samp_y))
-        for i in range(n_samp_x):
-            for j in range(n_samp_y):
-                kern_mat[i, j] = (self.gamma * np.dot(x_mat[i], y_mat[j]) + self.c0) ** self.degree
-        return kern_mat
+        return self.kernel_matrix(x_mat, y_mat,
+                                  lambda x_chunk: (self.gamma * np.matmul(x_chunk, y_mat.T) + self.c0) ** self.degree)
 
     def predict(self, X):
         if self.train_status == 0:
@@ -540,6 +1186,12 @@ class svqr:
         x_proj = kern(X, self.sv)
 
         preds = {}
+        if self.n_landmarks is not None:
+            x_proj = np.matmul(x_proj, self.projection)
+            for q in self.quantiles:
+                model = self.models[str(q)]
+                preds.update({str(np.round(q, decimals=4)): np.dot(x_proj, model['w']) + model['b']})
+            return preds
         for q in self.quantiles:
             model = self.models[str(q)]
             preds.update({str(np.round(q, decimals=4)): np.dot(x_proj, model['alpha']) + model['b']})
@@ -547,66 +1199,180 @@ class svqr:
 
 
 class lm:
-    def __init__(self, quantiles, kernel=None, bw=None):
+    def __init__(self, quantiles, fit_intercept=True, tol=1e-5, max_iter=50):
+        '''
+        :param fit_intercept: Add an intercept to the inputs
+        :param tol: Duality gap at which the solver stops
+        :param max_iter: Maximum number of interior point iterations
+        '''
         self.quantiles = quantiles
-        if kernel is not None:
-            self.kernel = kernel
-        else:
-            self.kernel = 'epa'
-        if bw is not None:
-            self.bandwidth = bw
-        else:
-            self.bandwidth = 'hsheather'
+        self.fit_intercept = fit_intercept
+        self.tol = tol
+        self.max_iter = max_iter
         self.models = {}
         self.train_status = 0
 
+    def design_matrix(self, X):
+        X = np.asarray(X, dtype=float)
+        if self.fit_intercept:
+            X = np.hstack((np.ones((len(X), 1)), X))
+        return X
+
     def fit(self, X, y):
-        for q in self.quantiles:
-            model = sm.QuantReg(y, X, q=self.quantiles).fit(q=q, kernel=self.kernel, bandwidth=self.bandwidth)
-            self.models.update({str(q): model})
+        coefficients = self.frisch_newton(self.design_matrix(X), np.ravel(y))
+        for q, beta in zip(self.quantiles, coefficients):
+            self.models.update({str(q): beta})
         self.train_status = 1
 
         return
 
+    def frisch_newton(self, X, y):
+        '''Linear quantile regression of all quantiles at once with the Frisch-Newton interior point method of
+        Portnoy and Koenker (1997), as in rq.fit.fnb of the R package quantreg. The dual of the problem of quantile q
+        is to maximize y^T*d subject to X^T*d=(1-q)X^T*1 and 0<=d<=1, and the coefficients are the multipliers of the
+        equality constraints. The problems of all quantiles only differ in their right hand side, so every iteration
+        takes a step for each quantile with arrays that have a leading quantile axis, and the normal equations are
+        p x p systems solved together.
+
+        :return: Array of the coefficients, with one row per quantile
+        '''
+        beta_step = 0.9995
+        n_samples, n_features = X.shape
+        quantiles = np.asarray(self.quantiles, dtype=float)[:, None]
+        c = -y[None, :]
+        b = (1 - quantiles) * np.sum(X, axis=0)[None, :]
+
+        x = np.repeat(1 - quantiles, n_samples, axis=1)
+        s = 1 - x
+        dual = np.linalg.lstsq(X, -y, rcond=None)[0]
+        dual = np.repeat(dual[None, :], len(self.quantiles), axis=0)
+        r = c - np.matmul(dual, X.T)
+        r = r + 0.001 * (r == 0)
+        z = np.where(r > 0, r, 0)
+        w = z - r
+
+        def gap():
+            return np.sum(c * x, axis=1) - np.sum(dual * b, axis=1) + np.sum(w, axis=1)
+
+        def step_length(v, dv):
+            with np.errstate(divide='ignore'):
+                return np.min(np.where(dv < 0, -v / np.where(dv < 0, dv, -1), 1e20), axis=1)
+
+        active = gap() > self.tol
+        for i in range(self.max_iter):
+            if not np.any(active):
+                break
+            # Affine scaling step
+            q = 1 / (z / x + w / s)
+            r = z - w
+            normal = np.matmul(X.T[None, :, :] * q[:, None, :], X)
+            rhs = np.matmul(q * r, X)
+            dy = np.linalg.solve(normal, rhs[:, :, None])[:, :, 0]
+            dx = q * (np.matmul(dy, X.T) - r)
+            ds = -dx
+            dz = -z * (dx / x + 1)
+            dw = -w * (ds / s + 1)
+            fp = np.minimum(beta_step * np.minimum(step_length(x, dx), step_length(s, ds)), 1)
+            fd = np.minimum(beta_step * np.minimum(step_length(w, dw), step_length(z, dz)), 1)
+
+            # Mehrotra predictor-corrector step for the quantiles where the full affine step is not feasible
+            corrected = np.minimum(fp, fd) < 1
+            if np.any(corrected):
+                mu = np.sum(z * x + w * s, axis=1)
+                g = np.sum((z + fd[:, None] * dz) * (x + fp[:, None] * dx)
+                           + (w + fd[:, None] * dw) * (s + fp[:, None] * ds), axis=1)
+                mu = (mu * (g / mu) ** 3 / (2 * n_samples))[:, None]
+                dxdz = dx * dz
+                dsdw = ds * dw
+                xinv = 1 / x
+                sinv = 1 / s
+                xi = mu * (xinv - sinv)
+                rhs = rhs + np.matmul(q * (dxdz - dsdw - xi), X)
+                dy_c = np.linalg.solve(normal, rhs[:, :, None])[:, :, 0]
+                dx_c = q * (np.matmul(dy_c, X.T) + xi - r - dxdz + dsdw)
+                ds_c = -dx_c
+                dz_c = mu * xinv - z - xinv * z * dx_c - dxdz
+                dw_c = mu * sinv - w - sinv * w * ds_c - dsdw
+                fp_c = np.minimum(beta_step * np.minimum(step_length(x, dx_c), step_length(s, ds_c)), 1)
+                fd_c = np.minimum(beta_step * np.minimum(step_length(w, dw_c), step_length(z, dz_c)), 1)
+                dy, dx, ds, dz, dw = [np.where(corrected[:, None], corrected_step, step) for corrected_step, step in
+                                      zip((dy_c, dx_c, ds_c, dz_c, dw_c), (dy, dx, ds, dz, dw))]
+                fp = np.where(corrected, fp_c, fp)
+                fd = np.where(corrected, fd_c, fd)
+
+            # Quantiles that have already converged do not move
+            fp = np.where(active, fp, 0)[:, None]
+            fd = np.where(active, fd, 0)[:, None]
+            x = x + fp * dx
+            s = s + fp * ds
+            dual = dual + fd * dy
+            w = w + fd * dw
+            z = z + fd * dz
+            active = active & (gap() > self.tol)
+        return -dual
+
     def predict(self, X):
         if self.train_status == 0:
             raise ValueError("Model must be trained before predicting")
 
+        X = self.design_matrix(X)
         preds = {}
         for q in self.quantiles:
             model = self.models[str(q)]
-            preds.update({str(np.round(q, decimals=4)): model.predict(X)})
+            preds.update({str(np.round(q, decimals=4)): np.matmul(X, model)})
         return preds
 
 
 class gbm():
     def __init__(self, quantiles, learning_rate=0.1, trees=100, min_samples_split=2, min_samples_leaf=1,
-                 max_depth=None):
+                 max_depth=None, backend='exact', n_jobs=1):
+        '''
+        :param backend: 'exact' uses GradientBoostingRegressor, 'hist' uses HistGradientBoostingRegressor, which bins
+        the inputs and is much faster on large datasets (its quantile loss needs scikit-learn 1.1 or later).
+        min_samples_split only applies to 'exact'.
+        :param n_jobs: Number of processes fitting the models of the quantiles, -1 for one per core
+        '''
         self.quantiles = quantiles
         self.learning_rate = learning_rate
         self.n_estimators = trees
         self.min_samples_split = min_samples_split
         self.min_samples_leaf = min_samples_leaf
         self.max_depth = max_depth
+        if backend not in ('exact', 'hist'):
+            raise ValueError("Acceptable backends are 'exact' or 'hist'")
+        self.backend = backend
+        self.n_jobs = n_jobs
         self.models = {}
         self.train_status = 0
 
+    def make_model(self, q):
+        if self.backend == 'hist':
+            return HistGradientBoostingRegressor(loss='quantile',
+                                                 quantile=q,
+                                                 learning_rate=self.learning_rate,
+                                                 max_iter=self.n_estimators,
+                                                 min_samples_leaf=self.min_samples_leaf,
+                                                 max_depth=self.max_depth)
+        return GradientBoostingRegressor(loss='quantile',
+                                         learning_rate=self.learning_rate,
+                                         n_estimators=self.n_estimators,
+                                         min_samples_split=self.min_samples_split,
+                                         min_samples_leaf=self.min_samples_leaf,
+                                         max_depth=self.max_depth,
+                                         alpha=q)
+
     def fit(self, X, y):
-        base_model = GradientBoostingRegressor(loss='quantile',
-                                               learning_rate=self.learning_rate,
-                                               n_estimators=self.n_estimators,
-                                               min_samples_split=self.min_samples_split,
-                                               min_samples_leaf=self.min_samples_leaf,
-                                               max_depth=self.max_depth)
-        for q in self.quantiles:
-            model = GradientBoostingRegressor(loss='quantile',
-                                              learning_rate=self.learning_rate,
-                                              n_estimators=self.n_estimators,
-                                              min_samples_split=self.min_samples_split,
-                                              min_samples_leaf=self.min_samples_leaf,
-                                              max_depth=self.max_depth,
-                                              alpha=q)
-            model.fit(X, y)
+        y = np.ravel(y)
+        if self.n_jobs == 1:
+            models = [self.make_model(q).fit(X, y) for q in self.quantiles]
+        else:
+            n_jobs = self.n_jobs if self.n_jobs > 0 else os.cpu_count()
+            # Spawned like the workers of fit_quantiles_in_pool, since TensorFlow is loaded in this process
+            with ProcessPoolExecutor(max_workers=min(n_jobs, len(self.quantiles)),
+                                     mp_context=multiprocessing.get_context('spawn')) as executor:
+                futures = [executor.submit(fit_estimator, self.make_model(q), X, y) for q in self.quantiles]
+                models = [future.result() for future in futures]
+        for q, model in zip(self.quantiles, models):
             self.models.update({str(q): model})
         self.train_status = 1
         return
@@ -623,29 +1389,84 @@ class gbm():
 
 
 class rf():
-    def __init__(self, quantiles, trees=100, min_samples_split=2, min_samples_leaf=1, max_depth=None):
+    def __init__(self, quantiles, trees=100, min_samples_split=2, min_samples_leaf=1, max_depth=None,
+                 method='percentile', n_jobs=None):
+        '''
+        :param method: 'percentile' takes the percentiles of the predictions of the trees, 'qrf' is the quantile
+        regression forest of Meinshausen (2006), which takes the quantiles of the training targets weighted by how
+        often they share a leaf with the sample
+        :param n_jobs: Number of jobs for fitting the forest and finding the leaves of samples, as in scikit-learn
+        '''
 
         self.quantiles = quantiles
         self.n_estimators = trees
         self.min_samples_split = min_samples_split
         self.min_samples_leaf = min_samples_leaf
         self.max_depth = max_depth
+        if method not in ('percentile', 'qrf'):
+            raise ValueError("Acceptable methods are 'percentile' or 'qrf'")
+        self.method = method
+        self.n_jobs = n_jobs
         self.train_status = 0
 
     def fit(self, X, y):
         model = RandomForestRegressor(n_estimators=self.n_estimators,
                                       min_samples_split=self.min_samples_split,
                                       min_samples_leaf=self.min_samples_leaf,
-                                      max_depth=self.max_depth
+                                      max_depth=self.max_depth,
+                                      n_jobs=self.n_jobs
                                       )
 
         model.fit(X, y)
         self.models = model
+        if self.method == 'qrf':
+            self.fit_leaf_weights(X, y)
         self.train_status = 1
 
+    def fit_leaf_weights(self, X, y):
+        '''Precomputes the sparse matrix of the weights of the training samples in each leaf of the forest, 1/size of
+        the leaf, with the nodes of all the trees numbered one after the other and the samples sorted by target.'''
+        y = np.ravel(y)
+        order = np.argsort(y, kind='stable')
+        self.y_sorted = y[order]
+        node_counts = [estimator.tree_.node_count for estimator in self.models.estimators_]
+        self.node_offsets = np.append(0, np.cumsum(node_counts)[:-1])
+        leaves = (self.models.apply(X)[order] + self.node_offsets).ravel()
+        leaf_sizes = np.bincount(leaves, minlength=np.sum(node_counts))
+        samples = np.repeat(np.arange(len(y)), self.n_estimators)
+        self.leaf_weights = csr_matrix((1 / leaf_sizes[leaves], (leaves, samples)),
+                                       shape=(np.sum(node_counts), len(y)))
+
+    def predict_qrf(self, X):
+        '''The weight of each training sample is the average over the trees of its weight in the leaf of the sample
+        being predicted, so the weights of all samples are a sparse product. With the training samples sorted by
+        target, the weighted quantile q of each row is at the first cumulative weight >= q, found for all rows at
+        once by adding the row number to the cumulative weights, which makes them increase across rows.'''
+        leaves = self.models.apply(X) + self.node_offsets
+        n_samples = leaves.shape[0]
+        membership = csr_matrix((np.full(leaves.size, 1 / self.n_estimators), leaves.ravel(),
+                                 np.arange(0, leaves.size + 1, self.n_estimators)),
+                                shape=(n_samples, self.leaf_weights.shape[0]))
+        weights = membership @ self.leaf_weights
+        weights.sort_indices()
+
+        row_lengths = np.diff(weights.indptr)
+        rows = np.repeat(np.arange(n_samples), row_lengths)
+        cumulative = np.cumsum(weights.data)
+        cumulative = cumulative - np.append(0, cumulative)[weights.indptr[:-1]][rows]
+        keys = rows + cumulative
+        preds = {}
+        for q in self.quantiles:
+            index = np.searchsorted(keys, np.arange(n_samples) + q - 1e-9)
+            index = np.minimum(index, weights.indptr[1:] - 1)
+            preds.update({str(np.round(q, decimals=4)): self.y_sorted[weights.indices[index]]})
+        return preds
+
     def predict(self, X):
         if self.train_status == 0:
             raise ValueError("Model must be trained before predicting")
+        if self.method == 'qrf':
+            return self.predict_qrf(X)
 
         all_preds = []
         for estimator in self.models.estimators_:
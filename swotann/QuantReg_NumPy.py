@@ -0,0 +1,313 @@
+import numpy as np
+
+# NumPy versions of the Keras activations supported by cqrann, and their derivatives as functions of their outputs
+NUMPY_ACTIVATIONS = {
+    'linear': lambda x: x,
+    'tanh': np.tanh,
+    'relu': lambda x: np.maximum(x, 0),
+    'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+}
+ACTIVATION_GRADIENTS = {
+    'linear': lambda a: 1.0,
+    'tanh': lambda a: 1 - a * a,
+    'relu': lambda a: a > 0,
+    'sigmoid': lambda a: a * (1 - a),
+}
+
+
+def simultaneous_loss_numpy(quantiles, eps):
+    """
+    NumPy version of QuantReg_Functions.simultaneous_loss_keras, which also returns the gradient of the loss with
+    respect to the predictions.
+    """
+    quantiles = np.asarray(quantiles)
+
+    def loss(y_true, y_pred):
+        e = y_true - y_pred
+        abs_e = np.abs(e)
+        quadratic = abs_e < eps
+        ee = np.where(quadratic, e * e / (2 * eps), abs_e - 0.5 * eps)
+        weights = np.where(e > 0, quantiles, 1 - quantiles)
+        # The loss is the mean over all the samples and quantiles, and d(ee)/de is e/eps or sign(e)
+        gradient = -weights * np.where(quadratic, e / eps, np.sign(e)) / e.size
+        return np.mean(weights * ee), gradient
+
+    return loss
+
+
+class Adam:
+    """
+    NumPy version of the Keras Adam optimizer, updating a flat array of weights in place.
+    """
+
+    def __init__(self, size, learning_rate=0.001, beta_1=0.9, beta_2=0.999, epsilon=1e-7):
+        self.learning_rate = learning_rate
+        self.beta_1 = beta_1
+        self.beta_2 = beta_2
+        self.epsilon = epsilon
+        self.m = np.zeros(size)
+        self.v = np.zeros(size)
+        self.iterations = 0
+        return
+
+    def update_moments(self, gradient):
+        self.iterations += 1
+        self.m += (gradient - self.m) * (1 - self.beta_1)
+        self.v += (gradient * gradient - self.v) * (1 - self.beta_2)
+        return
+
+    def apply_gradients(self, gradient, weights):
+        self.update_moments(gradient)
+        alpha = (self.learning_rate * np.sqrt(1 - self.beta_2 ** self.iterations)
+                 / (1 - self.beta_1 ** self.iterations))
+        weights -= alpha * self.m / (np.sqrt(self.v) + self.epsilon)
+        return
+
+
+class Nadam(Adam):
+    """
+    NumPy version of the Keras Nadam optimizer of TensorFlow 2.9 (OptimizerV2), updating a flat array of weights in
+    place. Its momentum schedule decays with schedule_decay, while the learning rate is not decayed.
+    """
+
+    def __init__(self, size, learning_rate=0.001, beta_1=0.9, beta_2=0.999, epsilon=1e-7, schedule_decay=0.004):
+        super().__init__(size, learning_rate, beta_1, beta_2, epsilon)
+        self.schedule_decay = schedule_decay
+        self.u_product = 1.0
+        return
+
+    def apply_gradients(self, gradient, weights):
+        self.update_moments(gradient)
+        u_t = self.beta_1 * (1 - 0.5 * 0.96 ** (self.schedule_decay * self.iterations))
+        u_t_1 = self.beta_1 * (1 - 0.5 * 0.96 ** (self.schedule_decay * (self.iterations + 1)))
+        self.u_product *= u_t
+        m_hat = u_t_1 * self.m / (1 - self.u_product * u_t_1) + (1 - u_t) * gradient / (1 - self.u_product)
+        v_hat = self.v / (1 - self.beta_2 ** self.iterations)
+        weights -= self.learning_rate * m_hat / (np.sqrt(v_hat) + self.epsilon)
+        return
+
+
+class cqrann:
+    """
+    Same network, loss and training as QuantReg_Models.cqrann (with engine='keras'), implemented in NumPy with
+    analytic gradients so that models can be trained and used without TensorFlow. The weights saved with save_weights
+    can be loaded by either class.
+    """
+
+    def __init__(self, quantiles, hidden_activation='tanh', kernel_initializer='GlorotUniform',
+                 output_activation='linear', loss='pinball', epsilon=0, n_hidden=1, hl_size=4, optimizer='Nadam',
+                 validation_percent=0.1, left_censor=None, seed=None, batch_size=32):
+        """
+        :param kernel_initializer: Only kept for compatibility with QuantReg_Models.cqrann: as there, the weights
+            start uniform in [-0.05, 0.05] and the biases at zero
+        :param optimizer: 'Adam' or 'Nadam', with the default hyperparameters of Keras
+        :param seed: Optional integer used to seed the initial weights and the shuffling of the batches
+        :param batch_size: Number of samples in each batch
+        """
+        self.quantiles = quantiles
+        self.No = len(quantiles)
+
+        if loss == 'pinball':
+            self.loss = loss
+            # As in QuantReg_Models.cqrann, the pinball loss is the smoothed loss with a negligible epsilon
+            self.epsilon = 0.0000000000000000000000000000001
+        elif loss == 'smoothed':
+            self.loss = loss
+            self.epsilon = epsilon
+        else:
+            raise ValueError("Acceptable loss functions are 'pinball' or 'smoothed'")
+        for activation in (hidden_activation, output_activation):
+            if activation not in NUMPY_ACTIVATIONS:
+                raise ValueError("Acceptable activations are " + ", ".join(NUMPY_ACTIVATIONS.keys()))
+
+        self.n_hidden = n_hidden
+        self.Nh = hl_size
+        self.hidden_activation = hidden_activation
+        self.kernel_initializer = kernel_initializer
+        self.output_activation = output_activation
+        self.optimizer = optimizer
+        self.left_censor = left_censor
+        self.seed = seed
+        self.batch_size = batch_size
+        self.train_status = 0
+        self.epochs_trained = None
+
+        self.val = validation_percent
+        return
+
+    def build_model(self, Ni, rng):
+        """
+        Creates the weights of the network as views of a single flat array, so that the optimizer updates all of
+        them at once.
+
+        :return: Flat arrays of the weights and of their gradients
+        """
+        sizes = [Ni] + [self.Nh] * self.n_hidden + [self.No]
+        activations = [self.hidden_activation] * self.n_hidden + [self.output_activation]
+        shapes = []
+        for n_in, n_out in zip(sizes[:-1], sizes[1:]):
+            shapes += [(n_in, n_out), (n_out,)]
+        offsets = np.cumsum([0] + [int(np.prod(shape)) for shape in shapes])
+        weights = np.zeros(offsets[-1])
+        gradients = np.zeros(offsets[-1])
+
+        def views(flat):
+            return [flat[start:end].reshape(shape) for start, end, shape in zip(offsets[:-1], offsets[1:], shapes)]
+
+        weight_views = views(weights)
+        self.layers = list(zip(weight_views[0::2], weight_views[1::2], activations))
+        gradient_views = views(gradients)
+        self.gradients = list(zip(gradient_views[0::2], gradient_views[1::2]))
+        for kernel, bias, activation in self.layers:
+            kernel[...] = rng.uniform(-0.05, 0.05, kernel.shape)
+        self.censor_theta = self.left_censor
+        return weights, gradients
+
+    def forward(self, X):
+        """
+        :return: List of the inputs and of the outputs of every layer, before the left censoring
+        """
+        outputs = [X]
+        for kernel, bias, activation in self.layers:
+            outputs.append(NUMPY_ACTIVATIONS[activation](outputs[-1] @ kernel + bias))
+        return outputs
+
+    def backward(self, outputs, delta):
+        """
+        Backpropagates the gradient of the loss with respect to the (censored) predictions, filling self.gradients.
+        """
+        if self.censor_theta is not None:
+            delta = delta * (outputs[-1] > self.censor_theta)
+        for i in reversed(range(len(self.layers))):
+            kernel, bias, activation = self.layers[i]
+            kernel_gradient, bias_gradient = self.gradients[i]
+            delta = delta * ACTIVATION_GRADIENTS[activation](outputs[i + 1])
+            np.matmul(outputs[i].T, delta, out=kernel_gradient)
+            np.sum(delta, axis=0, out=bias_gradient)
+            if i > 0:
+                delta = delta @ kernel.T
+        return
+
+    def fit(self, X, y, epochs=500, min_delta=0.00000001, patience=100):
+        """
+        Trains the network like QuantReg_Models.cqrann.fit: the last validation_percent of the samples are held out,
+        the training samples are shuffled into batches every epoch, and training stops once the validation loss has
+        not improved by min_delta for patience epochs, restoring the best weights. The number of epochs run is kept in
+        self.epochs_trained.
+        """
+        if self.optimizer == 'Adam':
+            optimizer_class = Adam
+        elif self.optimizer == 'Nadam':
+            optimizer_class = Nadam
+        else:
+            raise ValueError("Acceptable optimizers are 'Adam' or 'Nadam'")
+
+        split_at = int(np.floor(len(X) * (1 - self.val)))
+        X = np.asarray(X, dtype=np.float64)
+        y = np.reshape(np.asarray(y, dtype=np.float64), (len(y), -1))
+        X_train, y_train, X_val, y_val = X[:split_at], y[:split_at], X[split_at:], y[split_at:]
+        self.Ni = X.shape[1]
+        cost = simultaneous_loss_numpy(self.quantiles, self.epsilon)
+
+        rng = np.random.default_rng(self.seed)
+        weights, gradients = self.build_model(self.Ni, rng)
+        optimizer = optimizer_class(len(weights))
+        best_weights = weights.copy()
+        best_loss = np.inf
+        wait = 0
+        stopped = False
+        for epoch in range(epochs):
+            order = rng.permutation(split_at)
+            for start in range(0, split_at, self.batch_size):
+                index = order[start:start + self.batch_size]
+                outputs = self.forward(X_train[index])
+                loss, delta = cost(y_train[index], self.censor(outputs[-1]))
+                self.backward(outputs, delta)
+                optimizer.apply_gradients(gradients, weights)
+
+            val_loss, delta = cost(y_val, self.censor(self.forward(X_val)[-1]))
+            wait += 1
+            if val_loss - min_delta < best_loss:
+                best_loss = val_loss
+                wait = 0
+                best_weights[:] = weights
+            elif wait >= patience and epoch > 0:
+                stopped = True
+                break
+        self.epochs_trained = epoch + 1
+        # As with the EarlyStopping callback of Keras, the best weights are only restored if training stopped early
+        if stopped:
+            weights[:] = best_weights
+
+        # Predictions are made in float32, as in Keras
+        self.layers = [(kernel.astype(np.float32), bias.astype(np.float32), activation)
+                       for kernel, bias, activation in self.layers]
+        self.gradients = None
+        self.train_status = 1
+        return
+
+    def censor(self, out):
+        if self.censor_theta is not None:
+            out = out * (out > self.censor_theta)
+        return out
+
+    def predict_array(self, X):
+        """
+        :param X: Array of scaled inputs, of shape (N, Ni)
+        :return: Array of scaled predictions, of shape (N, number of quantiles)
+        """
+        if self.train_status == 0:
+            raise ValueError("Model must be trained before predicting")
+
+        return self.censor(self.forward(np.asarray(X, dtype=np.float32))[-1])
+
+    def get_params(self):
+        """
+        :return: Dictionary of the hyperparameters the model was created with, other than the quantiles, which are
+            also accepted by QuantReg_Models.cqrann
+        """
+        return {'hidden_activation': self.hidden_activation, 'kernel_initializer': self.kernel_initializer,
+                'output_activation': self.output_activation, 'loss': self.loss,
+                'epsilon': self.epsilon if self.loss == 'smoothed' else 0, 'n_hidden': self.n_hidden,
+                'hl_size': self.Nh, 'optimizer': self.optimizer, 'validation_percent': self.val,
+                'left_censor': self.left_censor, 'seed': self.seed, 'batch_size': self.batch_size}
+
+    def save_weights(self, filename):
+        """
+        Saves the weights of the trained model to a NumPy .npz file, in the format of QuantReg_Models.cqrann.
+
+        :param filename: String containing the filename of the .npz file
+        """
+        if self.train_status == 0:
+            raise ValueError("Model must be trained before saving")
+        arrays = {'activations': np.array([activation for kernel, bias, activation in self.layers])}
+        for i, (kernel, bias, activation) in enumerate(self.layers):
+            arrays['kernel' + str(i)] = kernel
+            arrays['bias' + str(i)] = bias
+        if self.censor_theta is not None:
+            arrays['censor_theta'] = np.array(self.censor_theta)
+        np.savez(filename, **arrays)
+        return
+
+    def load_weights(self, filename):
+        """
+        Loads weights saved with save_weights by this class or QuantReg_Models.cqrann.
+
+        :param filename: String containing the filename of the .npz file
+        """
+        with np.load(filename) as arrays:
+            self.layers = [(arrays['kernel' + str(i)], arrays['bias' + str(i)], str(activation))
+                           for i, activation in enumerate(arrays['activations'])]
+            self.censor_theta = float(arrays['censor_theta']) if 'censor_theta' in arrays else None
+        self.train_status = 1
+        return
+
+    def predict(self, X):
+        if self.train_status == 0:
+            raise ValueError("Model must be trained before predicting")
+
+        predarray = self.predict_array(X)
+        preds = {}
+        for q in range(len(self.quantiles)):
+            preds.update({str(np.round(self.quantiles[q], decimals=4)): predarray[:, q]})
+        return preds
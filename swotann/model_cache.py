@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+import threading
+
+
+class ModelCache(object):
+    """
+    Directory of trained models saved by SWOT_ML.save_model, keyed by SWOT_ML.model_fingerprint, so that a dataset
+    that is uploaded again (e.g. with only a different storage target) does not need to be retrained.
+
+    Each model is saved to a subdirectory named after its key. The modification time of the subdirectory is updated
+    every time the model is used, and when the total size of the cache exceeds max_size the least recently used
+    models are deleted. The cache can be shared by several SWOT_ML instances, including from multiple threads.
+    """
+
+    def __init__(self, directory, max_size=100 * 2**20):
+        """
+        :param directory: Directory to store the models in, created if it does not exist
+        :param max_size: Maximum total size of the saved models, in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # Number of threads loading each model, which evict must not delete
+        self.pinned = {}
+        os.makedirs(directory, exist_ok=True)
+        return
+
+    def lookup(self, key):
+        """
+        :param key: Fingerprint of the model
+        :return: Directory of the saved model, or None if the model is not in the cache
+        """
+        path = os.path.join(self.directory, key)
+        with self.lock:
+            if os.path.isdir(path):
+                os.utime(path)
+                self.hits += 1
+                return path
+            self.misses += 1
+            return None
+
+    def load(self, key, net):
+        """
+        Loads a model from the cache into a SWOT_ML instance. The model cannot be evicted by other threads while it
+        is loaded. A model that was deleted before it could be loaded (e.g. by another process sharing the directory),
+        or that cannot be loaded because its files are corrupt or were saved by an incompatible version, counts as a
+        cache miss and is deleted, so that it is retrained and stored again.
+
+        :param key: Fingerprint of the model
+        :param net: SWOT_ML instance to load the model into, with load_model
+        :return: Directory of the loaded model, or None if the model is not in the cache
+        """
+        path = os.path.join(self.directory, key)
+        with self.lock:
+            if not os.path.isdir(path):
+                self.misses += 1
+                return None
+            self.pinned[path] = self.pinned.get(path, 0) + 1
+        loaded = False
+        invalid = False
+        try:
+            net.load_model(path)
+            loaded = True
+        except (ValueError, KeyError, OSError):
+            # Missing files raise FileNotFoundError (an OSError), corrupt manifests json.JSONDecodeError (a ValueError)
+            # or KeyError, and bundles of other versions ValueError. Any other error is raised after unpinning
+            invalid = True
+        finally:
+            with self.lock:
+                self.pinned[path] -= 1
+                if self.pinned[path] == 0:
+                    del self.pinned[path]
+                if loaded:
+                    os.utime(path)
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                    if invalid and path not in self.pinned:
+                        shutil.rmtree(path, ignore_errors=True)
+        return path if loaded else None
+
+    def store(self, key, net):
+        """
+        Saves the trained model of a SWOT_ML instance to the cache, then evicts models if the cache is too large.
+
+        :param key: Fingerprint of the model
+        :param net: SWOT_ML instance with a trained model
+        :return: Directory of the saved model
+        """
+        path = os.path.join(self.directory, key)
+        # Save to a temporary directory first so that other threads never load a partially saved model
+        tmp_path = tempfile.mkdtemp(prefix=".tmp_", dir=self.directory)
+        net.save_model(tmp_path)
+        with self.lock:
+            if os.path.isdir(path):
+                shutil.rmtree(tmp_path)
+            else:
+                os.rename(tmp_path, path)
+            self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        """
+        Deletes the least recently used models until the cache is no larger than max_size, except those being
+        loaded. Must be called with the lock held.
+
+        :param keep: Directory of a model that must not be deleted, e.g. the one that was just stored
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(".tmp_") or not os.path.isdir(path):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+            entries.append((os.stat(path).st_mtime, size, path))
+
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path == keep or path in self.pinned:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+        return
+
+    def stats(self):
+        """
+        :return: Dictionary with the numbers of cache hits and misses so far
+        """
+        with self.lock:
+            return {"cache_hits": self.hits, "cache_misses": self.misses}
@@ -1,22 +1,36 @@
 import base64
 import datetime
+import hashlib
+import inspect
 import io
+import itertools
+import json
+import multiprocessing
 import os
+import sys
 import tempfile
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
-from xlrd.xldate import xldate_as_datetime
 from yattag import Doc
 import logging
 from statsmodels.api import OLS
 import pandas as pd
-from sklearn.model_selection import train_test_split
+from sklearn.model_selection import KFold
 from sklearn.preprocessing import MinMaxScaler
-import keras
-import tensorflow as tf
 from swotann import QuantReg_Functions
-from swotann import QuantReg_Models
+from swotann import QuantReg_NumPy
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Version of the layout of the directories written by SWOT_ML.save_model, checked by SWOT_ML.load_model
+MODEL_BUNDLE_VERSION = 1
 
 plt.rcParams.update({"figure.autolayout": True})
 
@@ -26,20 +40,140 @@ TF_CPP_MIN_LOG_LEVEL:
 Defaults to 0, so all logs are shown. Set TF_CPP_MIN_LOG_LEVEL to 1 to filter out INFO logs, 2 to additionally filter out WARNING, 3 to additionally filter out ERROR.
 """
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
-from tensorflow import keras
+try:
+    from swotann import QuantReg_Models
+except ImportError:  # TensorFlow is not installed, only the "numpy" backend can be used
+    QuantReg_Models = None
+
+
+def fit_fold_predictions(model_class, quantiles, params, X_train, y_train, X_test):
+    # Trains a new model on one fold of SWOT_ML.full_performance_evaluation, in a worker process, and returns its
+    # scaled predictions of the holdout samples
+    model = model_class(quantiles=quantiles, **params)
+    model.fit(X_train, y_train)
+    return QuantReg_Functions.QuantilePredictions.from_model(model, X_test).values
+
+
+def current_rss():
+    """
+    :return: Current resident set size of the process in bytes, or None where /proc is not available (other than
+        Linux)
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class RSSSampler(object):
+    """
+    Samples the resident set size of the process in a background thread from its creation until stop, to measure
+    the memory used by one job: the peak RSS over the job minus the RSS when it started. Jobs running concurrently in
+    the same process are included in each other's measurements.
+    """
+
+    def __init__(self, interval=0.05):
+        self.start_rss = current_rss()
+        self.peak_rss = self.start_rss
+        self.stopped = threading.Event()
+        self.thread = None
+        if self.start_rss is not None:
+            self.thread = threading.Thread(target=self.sample, args=(interval,), daemon=True)
+            self.thread.start()
+        return
+
+    def sample(self, interval):
+        while not self.stopped.wait(interval):
+            self.peak_rss = max(self.peak_rss, current_rss())
+
+    def stop(self):
+        """
+        :return: Increase of the peak RSS over the RSS at the start in MB, or None where it cannot be measured
+        """
+        if self.thread is None:
+            return None
+        self.stopped.set()
+        self.thread.join()
+        self.peak_rss = max(self.peak_rss, current_rss())
+        return round((self.peak_rss - self.start_rss) / 2**20, 1)
+
+
+# Hyperparameters of cqrann searched by SWOT_ML.tune_model, on top of SWOT_ML.model_params
+TUNING_SPACE = {
+    "n_hidden": [1, 2, 3, 5],
+    "hl_size": [4, 8],
+    "epsilon": [10**-32, 0.01],
+    "optimizer": ["Adam", "Nadam"],
+}
+
+
+def fit_trial(model_class, quantiles, params, X, y, epochs):
+    # Trains one trial of SWOT_ML.tune_model for at most epochs epochs, in a worker process, and returns the mean
+    # pinball loss of all the quantiles on the validation samples held out by the model, with the number of epochs run
+    model = model_class(quantiles=quantiles, **params)
+    model.fit(X, y, epochs=epochs)
+    split_at = int(np.floor(len(X) * (1 - model.val)))
+    e = y[split_at:, None] - model.predict_array(X[split_at:])
+    q = np.asarray(quantiles)
+    return float(np.mean(np.maximum(q * e, (q - 1) * e))), model.epochs_trained
 
 
 class SWOT_ML(object):
-    def __init__(self):
+    def __init__(self, seed=None, model_cache=None, backend="keras"):
+        """
+        :param seed: Optional integer used to seed the initial weights of the model, making training repeatable
+            once the TensorFlow global seed has been set with tf.random.set_seed (or always, with the "numpy" backend)
+        :param model_cache: Optional ModelCache used by run_swot to reuse models trained on the same data
+        :param backend: "keras" to train the model with QuantReg_Models.cqrann, or "numpy" to train it with
+            QuantReg_NumPy.cqrann, which does not need TensorFlow
+        """
+        if backend not in ("keras", "numpy"):
+            raise ValueError("Acceptable backends are 'keras' or 'numpy'")
         logging.getLogger().setLevel(logging.INFO)
         self.xl_dateformat = r"%Y-%m-%dT%H:%M"
+        self.seed = seed
+        self.model_cache = model_cache
+        self.backend = backend
         self.model = None
+
+        quantiles = np.arange(0.05, 1, 0.05)
+        quantiles = np.append(0.0001, quantiles)
+        quantiles = np.append(quantiles, 0.9999)
+        self.quantiles = quantiles
+        # FRC thresholds (mg/L) of the probability columns added to the results by risk_eval, which must include
+        # 0.20 for the safety grids
+        self.risk_thresholds = [0.0, 0.20, 0.25, 0.30]
+        # Probabilities of household FRC below 0.20 mg/L separating the risk categories refined by risk_eval, and
+        # the FRC resolution (mg/L) of the refined risk tables, see set_inputs_for_table
+        self.risk_levels = [0.05, 0.10, 0.20, 0.50]
+        self.table_resolution = None
+        self.table_evaluations = 0
+        # Holdout evaluation of full_performance_evaluation, also run by run_swot when evaluation_splits is not 0:
+        # number of folds, "blocked" or "kfold" folds (see evaluation_folds) and number of processes training them
+        self.evaluation_splits = 0
+        self.evaluation_split = "blocked"
+        self.evaluation_jobs = 1
+        self.holdout_scores = None
+        self.tuning_results = None
+        # Hyperparameters of the cqrann model made by set_up_model
+        self.model_params = {
+            "loss": "smoothed",
+            "epsilon": 10**-32,
+            "hidden_activation": "tanh",
+            "kernel_initializer": "GlorotUniform",
+            "n_hidden": 5,
+            "hl_size": 4,
+            "left_censor": None,
+        }
         self.pretrained_networks = []
 
         self.software_version = "3.0.1"
         self.input_filename = None
         self.today = str(datetime.date.today())
         self.avg_time_elapsed = 0
+        self.parse_time = None
+        self.job_peak_rss = None
 
         self.predictors_scaler = MinMaxScaler(feature_range=(-1, 1))
         self.targets_scaler = MinMaxScaler(feature_range=(-1, 1))
@@ -47,6 +181,12 @@ class SWOT_ML(object):
         self.history = None
         self.file = None
 
+        # Names of the input/output columns for the input template, see set_template
+        self.frc_in = None
+        self.frc_out = None
+        self.wattemp = None
+        self.cond = None
+
         self.skipped_rows = []
         self.ruleset = []
 
@@ -61,6 +201,50 @@ class SWOT_ML(object):
         return
 
 
+    def set_template(self, columns):
+        """
+        Locates the fields used as inputs/predictors and outputs for the input template (se1_frc, ts_frc1 or
+        ts_frc) that matches the given column names.
+
+        :param columns: Column names of the input data, e.g. the header of the .csv file
+        """
+        # Support from 3 different input templates se1_frc, ts_frc, and ts frc1
+        if "se1_frc" in columns:
+            self.frc_in = "se1_frc"
+            self.wattemp = "se1_wattemp"
+            self.cond = "se1_cond"
+            self.frc_out = "se4_frc"
+        elif "ts_frc1" in columns:
+            self.frc_in = "ts_frc1"
+            self.wattemp = "ts_wattemp"
+            self.cond = "ts_cond"
+            self.frc_out = "hh_frc1"
+        elif "ts_frc" in columns:
+            self.frc_in = "ts_frc"
+            self.wattemp = "ts_wattemp"
+            self.cond = "ts_cond"
+            self.frc_out = "hh_frc"
+        return
+
+    def read_input_file(self, filename):
+        """
+        Reads a comma-separated values (CSV) file in a single pass.
+
+        The input template is detected from the header alone, after which only the columns used by the model are
+        read, with the FRC, water temperature and EC measurements parsed directly as floats and the date/times
+        kept as strings for parse_dates.
+
+        :param filename: String containing the filename of the .csv file containing the input data (e.g "input_data.csv")
+        :return: A Pandas DataFrame object with the columns used by the model
+        """
+        header = pd.read_csv(filename, nrows=0).columns
+        self.set_template(header)
+
+        dtypes = {"ts_datetime": str, "hh_datetime": str}
+        dtypes.update({column: "float64" for column in (self.frc_in, self.frc_out, self.wattemp, self.cond)})
+        dtypes = {column: dtype for column, dtype in dtypes.items() if column in header}
+        return pd.read_csv(filename, usecols=list(dtypes.keys()), dtype=dtypes)
+
     def import_data_from_csv(self, filename):
         """
         Imports data to the network by a comma-separated values (CSV) file.
@@ -71,102 +255,75 @@ class SWOT_ML(object):
 
         :param filename: String containing the filename of the .csv file containing the input data (e.g "input_data.csv")
         """
+        self.import_data(self.read_input_file(filename))
+        self.input_filename = filename
+        return
+
+    def import_data(self, df):
+        """
+        Imports data to the network from a Pandas DataFrame object, as returned by read_input_file.
+
+        The DataFrame is used as is rather than copied: rows that are skipped by the rules are dropped from a new
+        DataFrame so the original can still be used to report them.
 
-        df = pd.read_csv(filename)
-        self.file = df.copy()
-
-        global FRC_IN
-        global FRC_OUT
-        global WATTEMP
-        global COND
-
-        # Locate the fields used as inputs/predictors and outputs in the loaded file
-        # and split them
-
-        if "se1_frc" in self.file.columns:
-            FRC_IN = "se1_frc"
-            WATTEMP = "se1_wattemp"
-            COND = "se1_cond"
-            FRC_OUT = "se4_frc"
-        elif "ts_frc1" in self.file.columns:
-            FRC_IN = "ts_frc1"
-            WATTEMP = "ts_wattemp"
-            COND = "ts_cond"
-            FRC_OUT = "hh_frc1"
-        elif "ts_frc" in self.file.columns:
-            FRC_IN = "ts_frc"
-            WATTEMP = "ts_wattemp"
-            COND = "ts_cond"
-            FRC_OUT = "hh_frc"
+        :param df: Pandas DataFrame object containing the input data
+        """
+        self.set_template(df.columns)
+        self.file = df
 
         # Standardize the DataFrame by specifying rules
         # To add a new rule, call the method execute_rule with the parameters (description, affected_column, query)
-        self.execute_rule("Invalid tapstand FRC", FRC_IN, self.file[FRC_IN].isnull())
-        self.execute_rule("Invalid household FRC", FRC_OUT, self.file[FRC_OUT].isnull())
-        #self.execute_rule(
-        #    "Invalid tapstand date/time",
-        #    "ts_datetime",
-        #    self.valid_dates(self.file["ts_datetime"]),
-        #)
-        #self.execute_rule(
-        #    "Invalid household date/time",
-        #    "hh_datetime",
-        #    self.valid_dates(self.file["hh_datetime"]),
-        #)
+        self.execute_rule("Invalid tapstand FRC", self.frc_in, self.file[self.frc_in].isnull())
+        self.execute_rule("Invalid household FRC", self.frc_out, self.file[self.frc_out].isnull())
+
+        # Parse both date/time columns once, so the same results can be used to drop invalid dates
+        # and to calculate the elapsed time and time of collection below
+        # A date/time without a UTC offset (e.g. an Excel number) uses the offset of the other one in the same row,
+        # so that the elapsed time is not shifted when only one of them was recorded by Kobo
+        dates = pd.DataFrame(index=self.file.index)
+        ts_offset = self.utc_offsets(self.file["ts_datetime"])
+        hh_offset = self.utc_offsets(self.file["hh_datetime"])
+        dates["ts_local"], dates["ts_utc"] = self.parse_dates(self.file["ts_datetime"], default_offset=hh_offset)
+        dates["hh_local"], dates["hh_utc"] = self.parse_dates(self.file["hh_datetime"], default_offset=ts_offset)
+        self.execute_rule(
+            "Invalid tapstand date/time",
+            "ts_datetime",
+            dates.loc[self.file.index, "ts_utc"].isnull(),
+        )
+        self.execute_rule(
+            "Invalid household date/time",
+            "hh_datetime",
+            dates.loc[self.file.index, "hh_utc"].isnull(),
+        )
         self.skipped_rows = df.loc[df.index.difference(self.file.index)]
 
+        dates = dates.loc[self.file.index].reset_index(drop=True)
         self.file.reset_index(drop=True, inplace=True)  # fix dropped indices in pandas
 
         # Locate the rows of the missing data
 
-        drop_threshold = np.maximum(0.10 * len(self.file.loc[:, [FRC_IN]]),200)
-        nan_rows_watt = self.file.loc[self.file[WATTEMP].isnull()]
+        drop_threshold = np.maximum(0.10 * len(self.file),200)
+        nan_rows_watt = self.file.loc[self.file[self.wattemp].isnull()]
 
-        if len(self.file.loc[:, [FRC_IN]])-len(nan_rows_watt) > drop_threshold:
+        if len(self.file)-len(nan_rows_watt) > drop_threshold:
             self.execute_rule(
                 "Missing Water Temperature Measurement",
-                WATTEMP,
-                self.file[WATTEMP].isnull(),
+                self.wattemp,
+                self.file[self.wattemp].isnull(),
             )
 
-        nan_rows_cond = self.file.loc[self.file[COND].isnull()]
-        if len(self.file.loc[:, [FRC_IN]])-len(nan_rows_cond) > drop_threshold:
-            self.execute_rule("Missing EC Measurement", COND, self.file[COND].isnull())
+        nan_rows_cond = self.file.loc[self.file[self.cond].isnull()]
+        if len(self.file)-len(nan_rows_cond) > drop_threshold:
+            self.execute_rule("Missing EC Measurement", self.cond, self.file[self.cond].isnull())
         self.skipped_rows = df.loc[df.index.difference(self.file.index)]
 
+        dates = dates.loc[self.file.index].reset_index(drop=True)
         self.file.reset_index(drop=True, inplace=True)
 
-        start_date = self.file["ts_datetime"]
-        end_date = self.file["hh_datetime"]
-
-        durations = []
-        all_dates = []
-        collection_time = []
-
-        for i in range(len(start_date)):
-            try:
-                # excel type
-                start = float(start_date[i])
-                end = float(end_date[i])
-                start = xldate_as_datetime(start, datemode=0)
-                if start.hour > 12:
-                    collection_time = np.append(collection_time, 1)
-                else:
-                    collection_time = np.append(collection_time, 0)
-                end = xldate_as_datetime(end, datemode=0)
-
-            except ValueError:
-                # kobo type
-                start = start_date[i][:16].replace("/", "-")
-                end = end_date[i][:16].replace("/", "-")
-                start = datetime.datetime.strptime(start, self.xl_dateformat)
-                if start.hour > 12:
-                    collection_time = np.append(collection_time, 1)
-                else:
-                    collection_time = np.append(collection_time, 0)
-                end = datetime.datetime.strptime(end, self.xl_dateformat)
-            durations.append((end - start).total_seconds())
-            all_dates.append(datetime.datetime.strftime(start, self.xl_dateformat))
+        # Elapsed time is measured between the UTC times so that differing offsets are respected,
+        # while the time of collection uses the local time at the tapstand
+        durations = (dates["hh_utc"] - dates["ts_utc"]).dt.total_seconds().to_numpy()
+        collection_time = (dates["ts_local"].dt.hour > 12).to_numpy(dtype=float)
 
         self.durations = durations
         self.time_of_collection = collection_time
@@ -174,52 +331,51 @@ class SWOT_ML(object):
         self.avg_time_elapsed = np.mean(durations)
 
         # Extract the column of dates for all data and put them in YYYY-MM-DD format
-        self.file["formatted_date"] = all_dates
+        self.file["formatted_date"] = np.datetime_as_string(dates["ts_local"].to_numpy(), unit="m")
 
         predictors = {
-            FRC_IN: self.file[FRC_IN],
+            self.frc_in: self.file[self.frc_in],
             "elapsed time": (np.array(self.durations) / 3600),
             "time of collection (0=AM, 1=PM)": self.time_of_collection,
         }
-        self.targets = self.file.loc[:, FRC_OUT]
+        self.targets = self.file.loc[:, self.frc_out]
         self.var_names = [
             "Tapstand FRC (mg/L)",
             "Elapsed Time",
             "time of collection (0=AM, 1=PM)",
         ]
         self.predictors = pd.DataFrame(predictors)
-        if len(self.file.loc[:, [FRC_IN]])-len(nan_rows_watt) > drop_threshold:
-            self.predictors[WATTEMP] = self.file[WATTEMP]
+        if len(self.file)-len(nan_rows_watt) > drop_threshold:
+            self.predictors[self.wattemp] = self.file[self.wattemp]
             self.var_names.append("Water Temperature(" + r"$\degree$" + "C)")
-            self.average_case_wattemp = np.median(self.file[WATTEMP].dropna().to_numpy())
-            p = self.partial_corr(WATTEMP,  self.predictors.columns.drop([WATTEMP]))
+            self.average_case_wattemp = np.median(self.file[self.wattemp].dropna().to_numpy())
+            p = self.partial_corr(self.wattemp,  self.predictors.columns.drop([self.wattemp]))
             if p > 0:
                 self.worst_case_wattemp = np.percentile(
-                    self.file[WATTEMP].dropna().to_numpy(), 95
+                    self.file[self.wattemp].dropna().to_numpy(), 95
                 )
             elif p < 0:
                 self.worst_case_wattemp = np.percentile(
-                    self.file[WATTEMP].dropna().to_numpy(), 5
+                    self.file[self.wattemp].dropna().to_numpy(), 5
                 )
 
-        if len(self.file.loc[:, [FRC_IN]])-len(nan_rows_cond) > drop_threshold:
-            self.predictors[COND] = self.file[COND]
+        if len(self.file)-len(nan_rows_cond) > drop_threshold:
+            self.predictors[self.cond] = self.file[self.cond]
             self.var_names.append("EC (" + r"$\mu$" + "s/cm)")
-            self.average_case_cond = np.median(self.file[COND].dropna().to_numpy())
-            p = self.partial_corr(COND, self.predictors.columns.drop([COND]))
+            self.average_case_cond = np.median(self.file[self.cond].dropna().to_numpy())
+            p = self.partial_corr(self.cond, self.predictors.columns.drop([self.cond]))
             if p > 0:
                 self.worst_case_cond = np.percentile(
-                    self.file[COND].dropna().to_numpy(), 95
+                    self.file[self.cond].dropna().to_numpy(), 95
                 )
             elif p < 0:
                 self.worst_case_cond = np.percentile(
-                    self.file[COND].dropna().to_numpy(), 5
+                    self.file[self.cond].dropna().to_numpy(), 5
                 )
 
         self.targets = self.targets.values.reshape(-1, 1)
         self.datainputs = self.predictors
         self.dataoutputs = self.targets
-        self.input_filename = filename
         return
 
     def partial_corr(self, target_name, other_names):
@@ -239,35 +395,119 @@ class SWOT_ML(object):
         pc=np.corrcoef([residuals_y,residuals_x])[0,1]
         return pc
 
-    def set_up_model(self):
+    def set_up_model(self, backend=None):
         """"
-        Straightforward logic: if number of samples below DoF CQRNN, of if only available vars are FRC and Time, use
-        SVQR. Otherwise, use CQRNN, with hyperparameters as selected
-        Also, initialize the quantiles and scalers
+        Fits the scalers to the imported data and creates the cqrann model with the hyperparameters in model_params,
+        which tune_model can select for the data
+
+        :param backend: Optional "keras" or "numpy", replacing the backend the SWOT_ML instance was created with
         """
+        if backend is not None:
+            if backend not in ("keras", "numpy"):
+                raise ValueError("Acceptable backends are 'keras' or 'numpy'")
+            self.backend = backend
         self.predictors_scaler = self.predictors_scaler.fit(self.predictors)
         self.targets_scaler = self.targets_scaler.fit(self.targets)
 
-        quantiles = np.arange(0.05, 1, 0.05)
-        quantiles = np.append(0.0001, quantiles)
-        quantiles = np.append(quantiles, 0.9999)
-        self.quantiles=quantiles
+        self.model=self.model_class()(quantiles=self.quantiles, seed=self.seed, **self.model_params)
 
-        Ni=len(self.predictors.columns)
-        Nh=8
-        No=len(quantiles)
+        return
 
+    def tune_model(self, space=None, n_jobs=1, budgets=(50, 150, 500), reduction=3, timeout=None, directory=None):
+        """
+        Searches the hyperparameters of the cqrann model for the imported data by successive halving: every
+        combination of the values in space is trained for budgets[0] epochs, then only the best 1/reduction of the
+        trials are trained again for the next budget, and so on. A trial whose early stopping ended its training
+        before its budget is not trained again, as a larger budget would not change it. Trials are compared by the
+        pinball loss of all the quantiles on the validation samples held out by the model, and the trials of each
+        budget are trained in n_jobs processes. The best trial of the last budget reached replaces the
+        hyperparameters in model_params, which set_up_model then uses.
+
+        :param space: Dictionary mapping hyperparameters of cqrann to the list of their values to try, TUNING_SPACE
+            by default
+        :param n_jobs: Number of processes training the trials, -1 for one per core
+        :param budgets: Increasing maximum numbers of epochs of the successive rounds of trials
+        :param reduction: Fraction (1/reduction) of the trials kept for the next round
+        :param timeout: Optional number of seconds after which no new round is started
+        :param directory: Optional directory to save the results of the search to, as a **tuning.json** file with the
+            selected hyperparameters and the loss and number of epochs of every trial in every round
+        :return: Dictionary of the selected hyperparameters
+        """
+        space = TUNING_SPACE if space is None else space
+        start = time.perf_counter()
+        self.predictors_scaler = self.predictors_scaler.fit(self.predictors)
+        self.targets_scaler = self.targets_scaler.fit(self.targets)
+        x_norm = self.predictors_scaler.transform(self.predictors)
+        t_norm = self.targets_scaler.transform(self.targets).flatten()
+
+        names = list(space.keys())
+        trials = [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+        alive = list(range(len(trials)))
+        losses = {}
+        finished = set()
+        results = []
+        for budget in budgets:
+            jobs = [i for i in alive if i not in finished]
+            args = [
+                (self.model_class(), self.quantiles, dict(self.model_params, seed=self.seed, **trials[i]), x_norm,
+                 t_norm, budget)
+                for i in jobs
+            ]
+            if n_jobs == 1 or len(jobs) <= 1:
+                outcomes = [fit_trial(*arg) for arg in args]
+            else:
+                with self.process_pool(n_jobs, len(jobs)) as executor:
+                    outcomes = list(executor.map(fit_trial, *zip(*args)))
+            for i, (loss, epochs_trained) in zip(jobs, outcomes):
+                losses[i] = loss
+                if epochs_trained is None or epochs_trained < budget:
+                    finished.add(i)
+                results.append(dict(trials[i], budget=budget, loss=loss, epochs=epochs_trained))
+
+            alive = sorted(alive, key=lambda i: losses[i])
+            if budget == budgets[-1] or (timeout is not None and time.perf_counter() - start > timeout):
+                break
+            alive = alive[:max(1, int(np.ceil(len(alive) / reduction)))]
+
+        best = trials[alive[0]]
+        self.model_params = dict(self.model_params, **best)
+        self.tuning_results = pd.DataFrame(results)
+        logging.info(f"Selected {best} in {time.perf_counter() - start:.1f} s")
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, "tuning.json"), "w") as f:
+                json.dump({"selected": best, "trials": results}, f, indent=2)
+        return best
+
+    def model_class(self):
+        """
+        :return: The cqrann class of the backend the SWOT_ML instance was created with
+        """
+        if self.backend == "numpy":
+            return QuantReg_NumPy.cqrann
+        if QuantReg_Models is None:
+            raise ImportError("TensorFlow is required for the 'keras' backend, use SWOT_ML(backend='numpy') instead")
+        return QuantReg_Models.cqrann
 
-        self.model=QuantReg_Models.cqrann(quantiles=self.quantiles,
-                                          loss='smoothed',
-                                          epsilon=10**-32,
-                                          hidden_activation='tanh',
-                                          kernel_initializer='GlorotUniform',
-                                          n_hidden=5,
-                                          hl_size=4,
-                                          left_censor=None)
+    def model_fingerprint(self):
+        """
+        Hash identifying the model that would be trained on the imported data: the cleaned predictors and targets,
+        the quantiles, the hyperparameters (including the seed) and the software version.
 
-        return
+        :return: String containing the hexadecimal SHA-256 hash
+        """
+        settings = {
+            "software_version": self.software_version,
+            "quantiles": self.quantiles.tolist(),
+            "model_params": self.model_params,
+            "seed": self.seed,
+            "backend": self.backend,
+            "predictors": list(self.predictors.columns),
+        }
+        fingerprint = hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+        fingerprint.update(np.ascontiguousarray(self.predictors.to_numpy(dtype=np.float64)).tobytes())
+        fingerprint.update(np.ascontiguousarray(self.targets, dtype=np.float64).tobytes())
+        return fingerprint.hexdigest()
 
     def train_ML_models(self, directory):
         """
@@ -278,67 +518,255 @@ class SWOT_ML(object):
         :param directory: save directory for models and modelling outputs
         :return:
         """
-
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-
-        self.calibration_predictions = []
-
         x_norm = self.predictors_scaler.transform(self.predictors)
         t_norm = self.targets_scaler.transform(self.targets)
 
         self.model.fit(x_norm,t_norm.flatten())
-        self.calibration_predictions = self.model.predict(x_norm)
-        for key in self.calibration_predictions.keys():
-            self.calibration_predictions[key] = self.targets_scaler.inverse_transform(self.calibration_predictions[key].reshape(-1, 1)).flatten()
+        self.predict_calibration()
         return
 
+    def predict_calibration(self):
+        """
+        Predicts all the quantiles for the imported data with the trained model, for calibration_performance_evaluation
+        """
+        x_norm = self.predictors_scaler.transform(self.predictors)
+        self.calibration_predictions = QuantReg_Functions.QuantilePredictions.from_model(self.model, x_norm)
+        self.calibration_predictions.unscale(self.targets_scaler)
+        return
+
+    def save_model(self, directory):
+        """
+        Saves the trained model to a directory, so that it can be reloaded with load_model to make predictions
+        without retraining. The directory will contain:
+        1. A **model.json** file with the version of the layout of the directory, the quantiles, the predictors,
+           the input template, the backend and hyperparameters of the model, the scaling parameters of the inputs
+           and outputs, and the average and worst case water temperature and EC used for the risk tables
+        2. A **network_weights.npz** file with the weights of the trained network
+
+        :param directory: Directory to save the model to, created if it does not exist
+        """
+        os.makedirs(directory, exist_ok=True)
+        manifest = {
+            "bundle_version": MODEL_BUNDLE_VERSION,
+            "software_version": self.software_version,
+            "quantiles": self.quantiles.tolist(),
+            "predictors": list(self.predictors.columns),
+            "template": {
+                "frc_in": self.frc_in,
+                "frc_out": self.frc_out,
+                "wattemp": self.wattemp,
+                "cond": self.cond,
+            },
+            "backend": self.backend,
+            "model": self.model.get_params(),
+            "predictors_scaler": self.scaler_to_dict(self.predictors_scaler),
+            "targets_scaler": self.scaler_to_dict(self.targets_scaler),
+            "avg_time_elapsed": float(self.avg_time_elapsed),
+        }
+        for name in ("average_case_wattemp", "worst_case_wattemp", "average_case_cond", "worst_case_cond"):
+            if hasattr(self, name):
+                manifest[name] = float(getattr(self, name))
+
+        self.model.save_weights(os.path.join(directory, "network_weights.npz"))
+        with open(os.path.join(directory, "model.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+        return
+
+    def load_model(self, directory):
+        """
+        Loads a model saved with save_model. After loading, the risk tables can be made with set_inputs_for_table
+        and risk_eval without importing data or training.
+
+        :param directory: Directory the model was saved to
+        """
+        with open(os.path.join(directory, "model.json")) as f:
+            manifest = json.load(f)
+        if manifest["bundle_version"] != MODEL_BUNDLE_VERSION:
+            raise ValueError(
+                f"Unsupported model version {manifest['bundle_version']}, expected {MODEL_BUNDLE_VERSION}"
+            )
+
+        self.frc_in = manifest["template"]["frc_in"]
+        self.frc_out = manifest["template"]["frc_out"]
+        self.wattemp = manifest["template"]["wattemp"]
+        self.cond = manifest["template"]["cond"]
+        self.quantiles = np.array(manifest["quantiles"])
+        # No data is loaded with the model, only the names of the predictors are needed for the risk tables
+        if self.predictors is None:
+            self.predictors = pd.DataFrame(columns=manifest["predictors"])
+        self.predictors_scaler = self.scaler_from_dict(manifest["predictors_scaler"])
+        self.targets_scaler = self.scaler_from_dict(manifest["targets_scaler"])
+        self.avg_time_elapsed = manifest["avg_time_elapsed"]
+        for name in ("average_case_wattemp", "worst_case_wattemp", "average_case_cond", "worst_case_cond"):
+            if name in manifest:
+                setattr(self, name, manifest[name])
+
+        # Both backends save the same weights, so a model can be loaded with either one, keeping only the
+        # hyperparameters accepted by its class
+        model_class = self.model_class()
+        params = {
+            name: value
+            for name, value in manifest["model"].items()
+            if name in inspect.signature(model_class).parameters
+        }
+        self.model = model_class(quantiles=self.quantiles, **params)
+        self.model.load_weights(os.path.join(directory, "network_weights.npz"))
+        return
+
+    def scaler_to_dict(self, scaler):
+        # Only the range of the data is stored, rather than pickling the scaler, so that saved models can be loaded
+        # with other versions of scikit-learn
+        return {
+            "feature_range": list(scaler.feature_range),
+            "data_min": scaler.data_min_.tolist(),
+            "data_max": scaler.data_max_.tolist(),
+            "columns": list(getattr(scaler, "feature_names_in_", [])),
+        }
+
+    def scaler_from_dict(self, params):
+        # Fitting on the minimum and maximum alone gives the same scaling as the original fit
+        data = np.array([params["data_min"], params["data_max"]])
+        if params["columns"]:
+            data = pd.DataFrame(data, columns=params["columns"])
+        return MinMaxScaler(feature_range=tuple(params["feature_range"])).fit(data)
+
     def calibration_performance_evaluation(self, filename):
 
-        perf_df=pd.DataFrame(self.calibration_predictions)
-        perf_df=perf_df.where(perf_df>0,0)
-        perf_df[FRC_IN]=self.datainputs[FRC_IN].values
-        perf_df[FRC_OUT]=self.targets.flatten()
+        perf_df=self.calibration_predictions.to_frame()
+        perf_df[self.frc_in]=self.datainputs[self.frc_in].values
+        perf_df[self.frc_out]=self.targets.flatten()
 
-        self.scores=QuantReg_Functions.evaluate_model(perf_df,self.quantiles,FRC_OUT,os.path.splitext(filename)[0],save=True)
+        self.scores=QuantReg_Functions.evaluate_model(perf_df,self.quantiles,self.frc_out,os.path.splitext(filename)[0],save=True)
 
         return
 
-    def full_performance_evaluation(self, filename):
-        x_norm = self.predictors_scaler.transform(self.predictors)
-        t_norm = self.targets_scaler.transform(self.targets)
+    def evaluation_folds(self):
+        """
+        :return: List of (training indices, holdout indices) of the samples for full_performance_evaluation, from
+            evaluation_splits folds that are contiguous blocks of the samples in the order of the data ("blocked"),
+            or shuffled with the seed ("kfold")
+        """
+        if self.evaluation_split == "blocked":
+            folds = KFold(n_splits=self.evaluation_splits, shuffle=False)
+        elif self.evaluation_split == "kfold":
+            folds = KFold(n_splits=self.evaluation_splits, shuffle=True, random_state=self.seed)
+        else:
+            raise ValueError("Acceptable evaluation splits are 'blocked' or 'kfold'")
+        return list(folds.split(self.predictors))
 
-        self.eval_model=self.model
+    def submit_evaluation(self, executor=None):
+        """
+        Starts training one new model per fold of evaluation_folds, with the hyperparameters of set_up_model, so that
+        the model of the SWOT_ML instance is left untouched. The inputs and targets are scaled with the scalers fitted
+        by set_up_model.
+
+        :param executor: Optional ProcessPoolExecutor made by evaluation_executor to train the folds in, in parallel
+            with the training of the model of the SWOT_ML instance. Without it, the folds are trained one by one now.
+        :return: List of (holdout indices, future) of every fold (or of its result, without an executor), to pass to
+            collect_evaluation. The folds are drawn once here, as shuffled folds without a seed differ at every draw.
+        """
+        x_norm = self.predictors_scaler.transform(self.predictors)
+        t_norm = self.targets_scaler.transform(self.targets).flatten()
+        params = dict(self.model_params, seed=self.seed)
+        folds = self.evaluation_folds()
+        jobs = [
+            (self.model_class(), self.quantiles, params, x_norm[train], t_norm[train], x_norm[test])
+            for train, test in folds
+        ]
+        if executor is None:
+            return [(test, fit_fold_predictions(*job)) for (train, test), job in zip(folds, jobs)]
+        return [(test, executor.submit(fit_fold_predictions, *job)) for (train, test), job in zip(folds, jobs)]
 
-        x_cal_norm, x_test_norm, t_cal_norm, t_test_norm = train_test_split(
-            x_norm, t_norm, test_size=0.25, shuffle=False, random_state=10
-        )
-        self.verifying_observations = self.targets_scaler.inverse_transform(t_test_norm)
-        self.test_x_data = self.predictors_scaler.inverse_transform(x_test_norm)
+    def evaluation_executor(self):
+        """
+        :return: ProcessPoolExecutor with evaluation_jobs workers (-1 for one per core) for submit_evaluation
+        """
+        return self.process_pool(self.evaluation_jobs, self.evaluation_splits)
 
-        self.verifying_predictions = []
+    def process_pool(self, n_jobs, n_tasks):
+        """
+        :return: ProcessPoolExecutor with n_jobs workers (-1 for one per core), but no more than n_tasks, started
+            with spawn as TensorFlow is not fork-safe, and splitting the cores between the TensorFlow workers
+        """
+        n_jobs = n_jobs if n_jobs > 0 else os.cpu_count()
+        n_jobs = min(n_jobs, n_tasks)
+        if self.backend == "keras":
+            return ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=QuantReg_Models.init_quantile_worker,
+                                       initargs=(max(1, os.cpu_count() // n_jobs),))
+        return ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context("spawn"))
+
+    def collect_evaluation(self, folds, filename):
+        """
+        Scores the holdout predictions of every fold with evaluate_model, and saves the scores of every fold, with
+        their mean and standard deviation across the folds, to a **_holdout_scores.csv** file.
 
-        self.eval_model.fit(x_cal_norm,t_cal_norm.flatten())
-        self.verifying_predictions = self.eval_model.predict(x_test_norm)
-        for key in self.verifying_predictions.keys():
-            self.verifying_predictions[key]=self.targets_scaler.inverse_transform(self.verifying_predictions[key].reshape(-1, 1)).flatten()
+        :param folds: List returned by submit_evaluation
+        :param filename: String containing the filename the results are exported to
+        """
+        scores = []
+        for test, fold in folds:
+            predictions = fold.result() if isinstance(fold, Future) else fold
+            predictions = QuantReg_Functions.QuantilePredictions(predictions, self.quantiles)
+            perf_df = predictions.unscale(self.targets_scaler).to_frame()
+            perf_df[self.frc_in] = self.datainputs[self.frc_in].values[test]
+            perf_df[self.frc_out] = self.targets.flatten()[test]
+            scores.append(QuantReg_Functions.evaluate_model(perf_df, self.quantiles, self.frc_out))
+
+        self.holdout_scores = pd.DataFrame(scores, index=pd.RangeIndex(1, len(scores) + 1, name="fold"))
+        summary = pd.concat([
+            self.holdout_scores,
+            self.holdout_scores.mean().to_frame("mean").T,
+            self.holdout_scores.std().to_frame("std").T,
+        ])
+        summary.to_csv(os.path.splitext(filename)[0] + "_holdout_scores.csv")
+        return
 
-        perf_df = pd.DataFrame(self.verifying_predictions)
-        perf_df = perf_df.where(perf_df > 0, 0)
-        perf_df[FRC_IN] = self.test_x_data[:,0]
-        perf_df[FRC_OUT] = self.verifying_observations.flatten()
+    def full_performance_evaluation(self, filename):
+        """
+        Holdout evaluation of the model set up by set_up_model: trains a new model on each fold of
+        evaluation_folds, in evaluation_jobs processes, and saves the scores of their holdout predictions (see
+        collect_evaluation). run_swot trains the folds in parallel with the model of the SWOT_ML instance when
+        evaluation_splits is set.
 
-        QuantReg_Functions.evaluate_model(perf_df, self.quantiles, FRC_IN,  os.path.splitext(filename)[0], save=True)
+        :param filename: String containing the filename the results are exported to
+        """
+        if self.evaluation_jobs == 1:
+            self.collect_evaluation(self.submit_evaluation(), filename)
+            return
+        with self.evaluation_executor() as executor:
+            self.collect_evaluation(self.submit_evaluation(executor), filename)
         return
 
-    def set_inputs_for_table(self, storage_target):
+    @staticmethod
+    def lag_times(storage_target):
+        """
+        :return: Elapsed times (hours) of the columns of the risk tables for a storage target: every 3 hours up to
+            the target, or up to 24 hours for shorter targets. The lag times of every target are a prefix of those of
+            any longer target.
+        """
+        if storage_target<24:
+            return np.arange(3,24.1,3)
+        return np.arange(3,storage_target+1,3)
+
+    def set_inputs_for_table(self, storage_target, resolution=None):
+        """
+        Sets up the grid of inputs evaluated by risk_eval: FRC from 0.20 to 2.00 mg/L every 0.05 mg/L, crossed with
+        the lag times of the storage target and every AM/PM, water temperature and EC case.
 
+        :param storage_target: Storage duration (hours) to produce the risk tables for
+        :param resolution: Optional FRC step (mg/L) of the risk tables, finer than 0.05 mg/L, which it must divide.
+            risk_eval then evaluates the 0.05 mg/L grid first and only evaluates the model at the finer FRC between
+            two grid points whose probabilities are in different categories of risk_levels, interpolating the others
+        """
         self.frc = np.arange(0.20, 2.05, 0.05)
-        if storage_target<24:
-            self.lag_time=np.arange(3,24.1,3)
-        else:
-            self.lag_time=np.arange(3,storage_target+1,3)
-        if WATTEMP in self.predictors.columns and COND in self.predictors.columns:
+        self.lag_time=self.lag_times(storage_target)
+        if resolution is not None:
+            ratio = int(round(0.05 / resolution))
+            if ratio < 1 or not np.isclose(ratio * resolution, 0.05):
+                raise ValueError("The resolution of the risk tables must divide 0.05 mg/L")
+        self.table_resolution = resolution
+        if self.wattemp in self.predictors.columns and self.cond in self.predictors.columns:
             self.full_pred_array=np.array(
                 np.meshgrid(self.frc,
                             self.lag_time,
@@ -347,14 +775,14 @@ class SWOT_ML(object):
                                       self.worst_case_wattemp]),
                             np.array([self.average_case_cond,
                                       self.worst_case_cond]))).T.reshape(-1,len(self.predictors.columns))
-        elif WATTEMP in self.predictors.columns:
+        elif self.wattemp in self.predictors.columns:
             self.full_pred_array = np.array(
                 np.meshgrid(self.frc,
                             self.lag_time,
                             np.array([0, 1]),
                             np.array([self.average_case_wattemp,
                                       self.worst_case_wattemp]))).T.reshape(-1, len(self.predictors.columns))
-        elif COND in self.predictors.columns:
+        elif self.cond in self.predictors.columns:
             self.full_pred_array = np.array(
                 np.meshgrid(self.frc,
                             self.lag_time,
@@ -392,14 +820,14 @@ class SWOT_ML(object):
             "time of collection (0=AM, 1=PM)": pm_collect,
         }
 
-        if WATTEMP in self.datainputs.columns:
+        if self.wattemp in self.datainputs.columns:
             watt_med = [self.average_case_wattemp for i in range(0, len(frc))]
             watt_95 = [self.worst_case_wattemp for i in range(0, len(frc))]
             temp_med_am.update({"ts_wattemp": watt_med})
             temp_med_pm.update({"ts_wattemp": watt_med})
             temp_95_am.update({"ts_wattemp": watt_95})
             temp_95_pm.update({"ts_wattemp": watt_95})
-        if COND in self.datainputs.columns:
+        if self.cond in self.datainputs.columns:
             cond_med = [self.average_case_cond for i in range(0, len(frc))]
             cond_95 = [self.worst_case_cond for i in range(0, len(frc))]
             temp_med_am.update({"ts_cond": cond_med})
@@ -412,36 +840,114 @@ class SWOT_ML(object):
         self.worst_case_predictors_am = pd.DataFrame(temp_95_am)
         self.worst_case_predictors_pm = pd.DataFrame(temp_95_pm)'''
 
-    def risk_eval(self):
+    @staticmethod
+    def probability_column(threshold):
         """
-        V3 Notes: With QR models, goal is no longer to count number of networks above/below the threshold,
-        but instead to find the lowest quantile beyond which there are no predictions below the threshold
+        :return: Name of the risk_eval results column with the probability for an FRC threshold, e.g.
+            "probability<=0.20", or "probability=0" for a threshold of 0
         """
+        if threshold == 0:
+            return "probability=0"
+        return "probability<=%.2f" % threshold
 
+    def risk_tables(self, storage_targets, resolution=None):
+        """
+        Makes the risk tables of several storage targets from a single prediction: the inputs are set up for the
+        longest target, whose lag times include those of all the others, risk_eval is run once, and the tables of
+        every target are sliced from its min_grid and max_grid. The results of risk_eval (full_results, min_grid,
+        max_grid...) are left as for the longest target.
+
+        :param storage_targets: List of storage durations (hours) to produce the risk tables for
+        :param resolution: Optional FRC resolution (mg/L) of the risk tables, see set_inputs_for_table
+        :return: Dictionary mapping each storage target to a tuple of its min_grid and max_grid DataFrames, the same
+            as set_inputs_for_table and risk_eval would make for that target alone
+        """
+        self.set_inputs_for_table(max(storage_targets), resolution)
+        self.risk_eval()
+
+        tables = {}
+        for storage_target in storage_targets:
+            lag_time = self.lag_times(storage_target)
+            min_grid = self.min_grid.iloc[:, :len(lag_time)].set_axis(lag_time, axis=1)
+            max_grid = self.max_grid.iloc[:, :len(lag_time)].set_axis(lag_time, axis=1)
+            tables[storage_target] = (min_grid, max_grid)
+        return tables
+
+    def predict_frc(self, pred_array):
+        """
+        :param pred_array: Array or DataFrame of unscaled inputs, with the columns of the predictors
+        :return: QuantilePredictions of the household FRC predicted for every quantile, with negative predictions
+            set to 0
+        """
         # Normalize the inputs using the input scaler loaded
-        pred_array_scaled=self.predictors_scaler.transform(self.full_pred_array)
+        pred_array_scaled=self.predictors_scaler.transform(pred_array)
 
-        temp_results = self.model.predict(pred_array_scaled)
-        for key in temp_results.keys():
-            temp_results[key] = self.targets_scaler.inverse_transform(temp_results[key].reshape(-1, 1)).flatten()
+        # All the quantiles are predicted at once and inverse scaled together
+        results = QuantReg_Functions.QuantilePredictions.from_model(self.model, pred_array_scaled)
+        return results.unscale(self.targets_scaler)
 
-        temp_results = pd.DataFrame(temp_results)
-        temp_results = temp_results.where(temp_results > 0, 0)
+    def refine_grids(self):
+        """
+        Refines the 0.05 mg/L grids made by risk_eval to the FRC resolution given to set_inputs_for_table. Between
+        two FRC rows of a grid, the model is only evaluated at the finer FRC for the lag times where the
+        probabilities of the two rows are in different categories of risk_levels, and the probabilities of the other
+        lag times are interpolated linearly. A category crossed and crossed back within 0.05 mg/L is not refined.
+        self.frc, self.grids, self.min_grid and self.max_grid are replaced by the refined ones, while
+        self.full_results keeps the 0.05 mg/L grid.
+        """
+        ratio = int(round(0.05 / self.table_resolution))
+        coarse = self.grids
+        total_grids, n_frc, n_lag = coarse.shape
+        steps = np.arange(ratio)
+        frc = np.round(np.append((self.frc[:-1, None] + steps * self.table_resolution).ravel(), self.frc[-1]), 10)
+
+        # Interpolated fine grids of shape (grids, coarse FRC intervals, fine steps, lag times)
+        fine = coarse[:, :-1, None, :] + (steps / ratio)[:, None] * (coarse[:, 1:, None, :] - coarse[:, :-1, None, :])
+
+        categories = np.digitize(coarse, self.risk_levels)
+        grid, interval, lag = np.nonzero(categories[:, :-1, :] != categories[:, 1:, :])
+        if len(grid) > 0 and ratio > 1:
+            # The inputs of the refined points are those of the first point of their grid, other than FRC and
+            # elapsed time, which are the first two predictors
+            inputs = self.full_pred_array.to_numpy()[grid * n_frc * n_lag]
+            inputs = np.repeat(inputs, ratio - 1, axis=0)
+            inputs[:, 0] = frc[interval[:, None] * ratio + steps[1:]].ravel()
+            inputs[:, 1] = np.repeat(self.lag_time[lag], ratio - 1)
+            probabilities = QuantReg_Functions.exceedance_probabilities(
+                self.predict_frc(pd.DataFrame(inputs, columns=self.predictors.columns)).values, self.quantiles, [0.20]
+            )
+            fine[grid[:, None], interval[:, None], steps[1:], lag[:, None]] = probabilities.reshape(-1, ratio - 1)
+            self.table_evaluations += len(inputs)
+
+        self.frc = frc
+        self.grids = np.concatenate([fine.reshape(total_grids, -1, n_lag), coarse[:, -1:, :]], axis=1)
+        self.max_grid=pd.DataFrame(data=np.max(self.grids,axis=0),index=self.frc,columns=self.lag_time)
+        self.min_grid=pd.DataFrame(data=np.min(self.grids,axis=0),index=self.frc,columns=self.lag_time)
+        return
 
+    def risk_eval(self):
+        """
+        V3 Notes: With QR models, goal is no longer to count number of networks above/below the threshold,
+        but instead to find the lowest quantile beyond which there are no predictions below the threshold
+        """
 
-        proba_0 = 1-self.quantiles[np.argmin(np.array(np.abs(0.0 - temp_results)), axis=1)]
-        proba_20 = 1-self.quantiles[np.argmin(np.array(np.abs(0.20 - temp_results)), axis=1)]
-        proba_25 = 1-self.quantiles[np.argmin(np.array(np.abs(0.25 - temp_results)), axis=1)]
-        proba_30 = 1-self.quantiles[np.argmin(np.array(np.abs(0.30 - temp_results)), axis=1)]
+        predictions = self.predict_frc(self.full_pred_array)
+        self.table_evaluations = len(predictions.values)
 
-        self.full_results = pd.concat([self.full_pred_array, temp_results], axis=1)
-        self.full_results["probability=0"] = proba_0
-        self.full_results["probability<=0.20"] = proba_20
-        self.full_results["probability<=0.25"] = proba_25
-        self.full_results["probability<=0.30"] = proba_30
+
+        # Probabilities of every grid point for all the thresholds at once, one column per threshold
+        probabilities = QuantReg_Functions.exceedance_probabilities(
+            predictions.values, self.quantiles, self.risk_thresholds
+        )
+        probabilities = pd.DataFrame(
+            probabilities, columns=[self.probability_column(threshold) for threshold in self.risk_thresholds]
+        )
+        proba_20 = probabilities[self.probability_column(0.20)].to_numpy()
+
+        self.full_results = pd.concat([self.full_pred_array, predictions.to_frame(), probabilities], axis=1)
 
         grid_size =len(self.frc) * len(self.lag_time)
-        total_grids=int(len(pred_array_scaled)/grid_size)
+        total_grids=int(len(self.full_pred_array)/grid_size)
         grids=[]
 
         for i in range(total_grids):
@@ -452,6 +958,9 @@ class SWOT_ML(object):
         self.max_grid=pd.DataFrame(data=np.max(self.grids,axis=0),index=self.frc,columns=self.lag_time)
         self.min_grid=pd.DataFrame(data=np.min(self.grids,axis=0),index=self.frc,columns=self.lag_time)
 
+        if self.table_resolution is not None:
+            self.refine_grids()
+
         '''avg_case_inputs_norm_am = self.predictors_scaler.transform(self.avg_case_predictors_am)
         avg_case_inputs_norm_pm = self.predictors_scaler.transform(self.avg_case_predictors_pm)
         worst_case_inputs_norm_am = self.predictors_scaler.transform(
@@ -513,7 +1022,7 @@ class SWOT_ML(object):
         self.avg_case_results_pm = temp_results
 
 
-        if WATTEMP in self.datainputs.columns or COND in self.datainputs.columns:
+        if self.wattemp in self.datainputs.columns or self.cond in self.datainputs.columns:
             ##WORST CASE TARGET w AM COLLECTION
 
             temp_results = self.model.predict(worst_case_inputs_norm_am)
@@ -571,7 +1080,7 @@ class SWOT_ML(object):
             ub=bands.max(axis=1)
             bands["Lower Bound"]=lb
             bands["Upper Bound"]=ub
-            bands.index=self.avg_case_predictors_am[FRC_IN]
+            bands.index=self.avg_case_predictors_am[self.frc_in]
             bands=bands[["Lower Bound","Upper Bound"]]
             self.risk_bands_20=bands
 
@@ -583,7 +1092,7 @@ class SWOT_ML(object):
             ub = bands.max(axis=1)
             bands["Lower Bound"] = lb
             bands["Upper Bound"] = ub
-            bands.index = self.avg_case_predictors_am[FRC_IN]
+            bands.index = self.avg_case_predictors_am[self.frc_in]
             bands = bands[["Lower Bound", "Upper Bound"]]
             self.risk_bands_0 = bands
         else:
@@ -595,7 +1104,7 @@ class SWOT_ML(object):
             ub = bands.max(axis=1)
             bands["Lower Bound"] = lb
             bands["Upper Bound"] = ub
-            bands.index = self.avg_case_predictors_am[FRC_IN]
+            bands.index = self.avg_case_predictors_am[self.frc_in]
             bands = bands[["Lower Bound", "Upper Bound"]]
             self.risk_bands_20 = bands
 
@@ -606,7 +1115,7 @@ class SWOT_ML(object):
             ub = bands.max(axis=1)
             bands["Lower Bound"] = lb
             bands["Upper Bound"] = ub
-            bands.index = self.avg_case_predictors_am[FRC_IN]
+            bands.index = self.avg_case_predictors_am[self.frc_in]
             bands = bands[["Lower Bound", "Upper Bound"]]
             self.risk_bands_0 = bands'''
 
@@ -615,8 +1124,25 @@ class SWOT_ML(object):
     def generate_metadata(self):
         metadata = {}
         metadata["average_time"] = self.avg_time_elapsed  # in seconds
+        metadata["parse_time"] = self.parse_time  # in seconds
+        metadata["peak_rss"] = self.job_peak_rss  # in MB, see RSSSampler
+        metadata["process_peak_rss"] = self.peak_memory_usage()  # in MB
         return metadata
 
+    def peak_memory_usage(self):
+        """
+        Returns the peak resident set size of the process so far in MB, or None where the resource module is not
+        available (Windows). This is a high-water mark for the whole process, so it includes any earlier jobs run by
+        the same worker; the memory used by the current job alone is measured by RSSSampler.
+        """
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+        if sys.platform == "darwin":
+            return round(peak / 2**20, 1)
+        return round(peak / 2**10, 1)
+
     def display_results(self):
         """
         Display the results of the predictions as a console output.
@@ -646,87 +1172,178 @@ class SWOT_ML(object):
         )
         return
 
+    def utc_offsets(self, series):
+        """
+        Reads the UTC offsets at the end of the Kobo date/times of a column (e.g. "+06:00" in
+        "2019-12-28T08:54:00.000+06:00").
+
+        :param series: Pandas Series containing the date/times
+        :return: Series of the offsets in minutes, holding NaN for every entry without an offset (including Excel
+            numbers)
+        """
+        offset = pd.Series(np.nan, index=series.index)
+        is_kobo = pd.to_numeric(series, errors="coerce").isnull() & series.notnull()
+        tz = series[is_kobo].astype(str).str[16:].str.extract(r"([+-])(\d{2}):?(\d{2})$")
+        offset[is_kobo] = (
+            np.where(tz[0] == "-", -1, 1) * (tz[1].astype(float) * 60 + tz[2].astype(float))
+        )
+        return offset
+
+    def parse_dates(self, series, default_offset=None):
+        """
+        Parses a column of date/times in a single vectorized pass.
+
+        Each entry can either be a number, as formatted in Excel (1900 date system), or the standard Kobo output
+        (e.g. "2019-12-28T08:54:00.000+06:00"). Kobo times are read to the minute, and the UTC offset at the
+        end of the string is used to convert them to UTC. Times without an offset use default_offset, e.g. the
+        offset of the other date/time of the same row, and are otherwise assumed to be in UTC.
+
+        :param series: Pandas Series containing the date/times to parse
+        :param default_offset: Optional Series of UTC offsets in minutes with the same index, as returned by
+            utc_offsets, for the entries without an offset of their own
+        :return: A tuple (local, utc) of datetime64 Series, holding NaT for every entry that could not be parsed
+        """
+        local = pd.Series(pd.NaT, index=series.index, dtype="datetime64[ns]")
+
+        # excel type, matching xlrd.xldate_as_datetime down to the rounding to milliseconds
+        serial = pd.to_numeric(series, errors="coerce")
+        serial = serial.where((serial >= 0) & (serial < 2958466))
+        is_excel = serial.notnull()
+        days = np.floor(serial[is_excel])
+        epoch = np.where(days < 60, np.datetime64("1899-12-31", "ns"), np.datetime64("1899-12-30", "ns"))
+        local[is_excel] = (
+            epoch
+            + pd.to_timedelta(days, unit="D")
+            + pd.to_timedelta(np.round((serial[is_excel] - days) * 86400000.0), unit="ms")
+        )
+
+        # kobo type
+        is_kobo = ~is_excel & series.notnull()
+        local[is_kobo] = pd.to_datetime(
+            series[is_kobo].astype(str).str[:16].str.replace("/", "-"), format=self.xl_dateformat, errors="coerce"
+        )
+        offset = self.utc_offsets(series)
+        if default_offset is not None:
+            offset = offset.fillna(default_offset)
+        offset = offset.fillna(0.0)
+
+        return local, local - pd.to_timedelta(offset, unit="min")
+
     def valid_dates(self, series):
-        mask = []
-        for i in series.index.to_numpy():
-            row = series[i]
-            if row == None:
-                mask.append(True)
-                continue
-            if isinstance(row, str) and not row.replace(".", "", 1).isdigit():
-                try:
-                    datetime.datetime.strptime(
-                        row[:16].replace("/", "-"), self.xl_dateformat
-                    )
-                    mask.append(False)
-                except:
-                    mask.append(True)
-            else:
-                try:
-                    start = float(row)
-                    start = xldate_as_datetime(start, datemode=0)
-                    mask.append(False)
-                except:
-                    mask.append(True)
-        return mask
+        return self.parse_dates(series)[1].isnull()
 
     def execute_rule(self, description, column, matches):
         rule = (description, column, sum(matches))
         self.ruleset.append(rule)
         if sum(matches):
-            self.file.drop(self.file.loc[matches].index, inplace=True)
+            self.file = self.file.drop(self.file.loc[matches].index)
 
     def run_swot(
         self, input_file, results_file, storage_target, usetmpdir=False
     ):
-        global FRC_IN
-        global FRC_OUT
-        global WATTEMP
-        global COND
-        
-        storage_target = int(storage_target)
-        now = datetime.datetime.now()
-        if usetmpdir:
-            tmp_dirpath = tempfile.gettempdir()
-        else:
-            tmp_dirpath = ""
-        directory = os.path.join(
-            tmp_dirpath,
-            "model_retraining",
-            f'{now.strftime(r"%m%d%Y_%H%M%S")}_{os.path.basename(input_file)}',
-        )
+        """
+        Runs the full analysis on an input file: imports the data, trains the model, evaluates it and exports the
+        risk tables.
 
-        # Uncommentfor Excel processing
-        # file = pd.read_excel(input_file)
+        All the state of an analysis, including the names of the columns of the input template, is kept on the
+        SWOT_ML instance, so run_swot is thread-safe as long as every job uses its own instance and its own
+        results_file, e.g.:
 
-        file = pd.read_csv(input_file)
+            with ThreadPoolExecutor() as executor:
+                executor.map(lambda job: SWOT_ML().run_swot(*job), jobs)
 
-        # Support from 3 different input templates se1_frc, ts_frc, and ts frc1
-        if "se1_frc" in file.columns:
-            FRC_IN = "se1_frc"
-            WATTEMP = "se1_wattemp"
-            COND = "se1_cond"
-            FRC_OUT = "se4_frc"
-        elif "ts_frc1" in file.columns:
-            FRC_IN = "ts_frc1"
-            WATTEMP = "ts_wattemp"
-            COND = "ts_cond"
-            FRC_OUT = "hh_frc1"
-        elif "ts_frc" in file.columns:
-            FRC_IN = "ts_frc"
-            WATTEMP = "ts_wattemp"
-            COND = "ts_cond"
-            FRC_OUT = "hh_frc"
-
-        self.import_data_from_csv(input_file)
-        self.set_up_model()
-        #self.full_performance_evaluation(directory)
-        self.train_ML_models(directory)
-        self.calibration_performance_evaluation(results_file)
-        self.set_inputs_for_table(storage_target)
-        self.risk_eval()
-        self.display_results()
-        self.export_results_to_csv(results_file)
-        metadata = self.generate_metadata()
-        return metadata
+        For results that do not depend on the order in which concurrent jobs run, set the TensorFlow global seed once
+        with tf.random.set_seed and give each SWOT_ML a seed (the "numpy" backend only needs the seed).
+
+        :param input_file: String containing the filename of the .csv file containing the input data
+        :param results_file: String containing the filename the results are exported to
+        :param storage_target: Storage duration (hours) to produce the risk tables for
+        :param usetmpdir: Whether to create the model_retraining directory in the system temporary directory
+        :return: Dictionary of metadata about the analysis
+        """
+        sampler = RSSSampler()
+        try:
+            storage_target = int(storage_target)
+            now = datetime.datetime.now()
+            if usetmpdir:
+                tmp_dirpath = tempfile.gettempdir()
+            else:
+                tmp_dirpath = ""
+            retraining_directory = os.path.join(tmp_dirpath, "model_retraining")
+            # Prefix of the directory the model is saved to, made unique with a random suffix when it is created, so
+            # that jobs started in the same second on the same file do not overwrite each other's model
+            directory_prefix = f'{now.strftime(r"%m%d%Y_%H%M%S")}_{os.path.basename(input_file)}_'
+
+            # For Excel processing, read the file with pd.read_excel and pass it to import_data instead
+            start = time.perf_counter()
+            self.import_data_from_csv(input_file)
+            self.parse_time = time.perf_counter() - start
+            logging.info(f"Parsed {input_file} in {self.parse_time:.3f} s")
+
+            cache_hit = False
+            if self.model_cache is not None:
+                # If the same data was already used to train a model, load it instead of retraining
+                key = self.model_fingerprint()
+                cached_directory = self.model_cache.load(key, self)
+                cache_hit = cached_directory is not None
+            if cache_hit:
+                logging.info(f"Using cached model {cached_directory}")
+                directory = cached_directory
+                self.predict_calibration()
+            else:
+                directory = None
+                if self.model_cache is None:
+                    os.makedirs(retraining_directory, exist_ok=True)
+                    directory = tempfile.mkdtemp(prefix=directory_prefix, dir=retraining_directory)
+                self.set_up_model()
+                if self.evaluation_splits:
+                    # The folds of the holdout evaluation are trained in other processes while this one trains the model
+                    with self.evaluation_executor() as executor:
+                        folds = self.submit_evaluation(executor)
+                        self.train_ML_models(directory)
+                        self.collect_evaluation(folds, results_file)
+                else:
+                    self.train_ML_models(directory)
+                if self.model_cache is not None:
+                    directory = self.model_cache.store(key, self)
+                else:
+                    self.save_model(directory)
+
+            self.calibration_performance_evaluation(results_file)
+            self.set_inputs_for_table(storage_target)
+            self.risk_eval()
+            self.display_results()
+            self.export_results_to_csv(results_file)
+            self.job_peak_rss = sampler.stop()
+            metadata = self.generate_metadata()
+            metadata["model_directory"] = directory
+            if self.model_cache is not None:
+                metadata["cache_hit"] = cache_hit
+                metadata.update(self.model_cache.stats())
+            return metadata
+        finally:
+            sampler.stop()
+
+    def run_swot_pretrained(self, model_directory, results_file, storage_target):
+        """
+        Makes and exports the risk tables for a model saved by run_swot (in the model_directory of its metadata) or
+        save_model, skipping the import of the data and the training.
 
+        :param model_directory: Directory the model was saved to
+        :param results_file: String containing the filename the results are exported to
+        :param storage_target: Storage duration (hours) to produce the risk tables for
+        :return: Dictionary of metadata about the analysis
+        """
+        sampler = RSSSampler()
+        try:
+            self.load_model(model_directory)
+            self.set_inputs_for_table(int(storage_target))
+            self.risk_eval()
+            self.display_results()
+            self.export_results_to_csv(results_file)
+            self.job_peak_rss = sampler.stop()
+            metadata = self.generate_metadata()
+            metadata["model_directory"] = model_directory
+            return metadata
+        finally:
+            sampler.stop()
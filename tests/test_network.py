@@ -1,7 +1,9 @@
 import glob
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
+import tensorflow as tf
 
 # Import the Network and instantiate
 from swotann.swot_ml import SWOT_ML
@@ -33,4 +35,26 @@ def test_run_harness():
             os.remove(f)
 
 
+def test_concurrent_run_swot(tmp_path):
+    # Seeded jobs must give the same results whether they run one after the other or at the same time
+    tf.random.set_seed(0)
+    jobs = list(enumerate(sorted(test_files)))
+
+    def run(job, prefix):
+        seed, file = job
+        results_file = os.path.join(tmp_path, f"{prefix}{seed}.csv")
+        SWOT_ML(seed=seed).run_swot(file, results_file, STORAGE_TARGET)
+        outputs = []
+        for name in output_names:
+            with open(os.path.join(tmp_path, name.replace(output_prefix, f"{prefix}{seed}"))) as f:
+                outputs.append(f.read())
+        return outputs
+
+    serial = [run(job, "serial") for job in jobs]
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        concurrent = list(executor.map(lambda job: run(job, "concurrent"), jobs))
+
+    assert concurrent == serial
+
+
 pytest.main()
@@ -0,0 +1,408 @@
+import numpy as np
+import pytest
+
+from swotann import QuantReg_Models
+from swotann import QuantReg_NumPy
+
+QUANTILES = np.append(np.append(0.0001, np.arange(0.05, 1, 0.05)), 0.9999)
+
+
+@pytest.mark.parametrize("left_censor", [None, 0.1])
+def test_cqrann_predict_array_matches_keras(left_censor):
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, (500, 5))
+
+    net = QuantReg_Models.cqrann(quantiles=QUANTILES, n_hidden=5, hl_size=4, left_censor=left_censor)
+    net.build_model()
+    net.model = net.base_model
+    net.model.build((None, 5))
+    net.model.set_weights([rng.normal(0, 1, w.shape) for w in net.model.get_weights()])
+    net.extract_weights()
+    net.train_status = 1
+
+    expected = net.model.predict(X, verbose=0)
+    predictions = net.predict_array(X)
+
+    assert predictions.shape == (500, len(QUANTILES))
+    np.testing.assert_allclose(predictions, expected, atol=1e-5)
+
+
+def test_qrann_parallel_fit():
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, (200, 3))
+    y = X.sum(axis=1) + rng.normal(0, 0.1, 200)
+    quantiles = [0.05, 0.5, 0.95]
+
+    net = QuantReg_Models.qrann(quantiles=quantiles, n_hidden=1, hl_size=4, n_jobs=2)
+    net.fit(X, y)
+
+    assert list(net.models) == [str(q) for q in quantiles]
+    predictions = net.predict(X)
+    assert np.all(np.isfinite(predictions["0.5"]))
+    assert np.mean(predictions["0.05"]) < np.mean(predictions["0.5"]) < np.mean(predictions["0.95"])
+
+
+def test_monotone_hidden_is_increasing_in_monotone_inputs():
+    rng = np.random.default_rng(0)
+    layer = QuantReg_Models.QuantReg_Functions.MonotoneHidden(units=4, activation="tanh", monotone=2)
+    layer.build((None, 3))
+    layer.set_weights([rng.normal(0, 1, (3, 4)), rng.normal(0, 1, 4)])
+    X = rng.uniform(-1, 1, (100, 3)).astype(np.float32)
+
+    for i in range(2):
+        shifted = X.copy()
+        shifted[:, i] += 0.1
+        assert np.all(layer(shifted).numpy() > layer(X).numpy())
+    config = layer.get_config()
+    assert config["monotone"] == 2 and config["activation"] == "tanh"
+
+
+def test_mqrann_parallel_fit():
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, (200, 3))
+    y = X.sum(axis=1) + rng.normal(0, 0.1, 200)
+    quantiles = [0.05, 0.5, 0.95]
+
+    net = QuantReg_Models.mqrann(quantiles=quantiles, hl_size=4, monotone_indices=[1], n_jobs=2)
+    net.fit(X, y)
+
+    assert list(net.models) == [str(q) for q in quantiles]
+    predictions = net.predict(X)
+    assert np.all(np.isfinite(predictions["0.5"]))
+    assert np.mean(predictions["0.05"]) < np.mean(predictions["0.5"]) < np.mean(predictions["0.95"])
+
+
+def test_qrann_stacked_fit():
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, (200, 3))
+    y = X.sum(axis=1) + rng.normal(0, 0.1, 200)
+    quantiles = [0.05, 0.5, 0.95]
+
+    net = QuantReg_Models.qrann(quantiles=quantiles, n_hidden=1, hl_size=4, engine="stacked")
+    net.fit(X, y)
+
+    assert list(net.models) == [str(q) for q in quantiles]
+    predictions = net.predict(X)
+    assert predictions["0.5"].shape == (200, 1)
+    assert np.mean(predictions["0.05"]) < np.mean(predictions["0.5"]) < np.mean(predictions["0.95"])
+
+
+def test_mqrann_stacked_fit():
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, (200, 3))
+    y = X.sum(axis=1) + rng.normal(0, 0.1, 200)
+    quantiles = [0.05, 0.5, 0.95]
+
+    net = QuantReg_Models.mqrann(quantiles=quantiles, hl_size=4, monotone_indices=[1], engine="stacked")
+    net.fit(X, y)
+
+    assert list(net.models) == [str(q) for q in quantiles]
+    assert isinstance(net.models["0.5"].layers[0], QuantReg_Models.QuantReg_Functions.MonotoneHidden)
+    predictions = net.predict(X)
+    assert predictions["0.5"].shape == (200, 1)
+    assert np.mean(predictions["0.05"]) < np.mean(predictions["0.5"]) < np.mean(predictions["0.95"])
+
+
+def test_qrann_stacked_early_stopping_restores_best_weights(monkeypatch):
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, (200, 3))
+    y = X.sum(axis=1) + rng.normal(0, 0.1, 200)
+    callbacks = []
+
+    class ShortPatience(QuantReg_Models.StackedEarlyStopping):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs, patience=3)
+            callbacks.append(self)
+
+    monkeypatch.setattr(QuantReg_Models, "StackedEarlyStopping", ShortPatience)
+    net = QuantReg_Models.qrann(quantiles=[0.05, 0.5, 0.95], n_hidden=1, hl_size=4, engine="stacked")
+    net.fit(X, y)
+
+    callback = callbacks[0]
+    assert callback.stopped.any()
+    for i, branch in enumerate(callback.branches):
+        if callback.stopped[i]:
+            for weights, best in zip(branch.get_weights(), callback.best_weights[i]):
+                np.testing.assert_array_equal(weights, best)
+
+
+@pytest.mark.parametrize("kernel", ["linear", "rbf", "polynomial", "sigmoid"])
+def test_svqr_kernel_matrix_matches_pairwise(kernel):
+    rng = np.random.default_rng(0)
+    x_mat = rng.uniform(-1, 1, (50, 4))
+    y_mat = rng.uniform(-1, 1, (30, 4))
+    net = QuantReg_Models.svqr(quantiles=QUANTILES, kernel=kernel, gamma=0.5, chunk_size=16)
+
+    pairwise = {
+        "linear": lambda x, y: np.dot(x, y),
+        "rbf": lambda x, y: np.exp(-1 * net.gamma * (np.linalg.norm(x - y) ** 2)),
+        "polynomial": lambda x, y: (net.gamma * np.dot(x, y) + net.c0) ** net.degree,
+        "sigmoid": lambda x, y: np.tanh(net.gamma * np.dot(x, y) + net.c0),
+    }[kernel]
+    expected = np.array([[pairwise(x, y) for y in y_mat] for x in x_mat])
+
+    np.testing.assert_allclose(net.kernel_dict[kernel](x_mat, y_mat), expected, rtol=1e-12, atol=1e-14)
+
+
+def test_svqr_nystrom_matches_exact():
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, (200, 2))
+    y = np.sin(3 * X[:, 0]) + rng.normal(0, 0.2, 200)
+    quantiles = [0.05, 0.5, 0.95]
+
+    exact = QuantReg_Models.svqr(quantiles=quantiles, kernel="rbf")
+    exact.fit(X, y)
+    approximate = QuantReg_Models.svqr(quantiles=quantiles, kernel="rbf", n_landmarks=50, random_state=0)
+    approximate.fit(X, y)
+
+    exact_predictions = exact.predict(X)
+    approximate_predictions = approximate.predict(X)
+    for q in quantiles:
+        np.testing.assert_allclose(approximate_predictions[str(q)], exact_predictions[str(q)], atol=0.02)
+
+
+@pytest.mark.parametrize("kernel", ["linear", "rbf"])
+def test_svqr_active_set_matches_quadprog(kernel):
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, (150, 2))
+    y = np.sin(3 * X[:, 0]) + rng.normal(0, 0.2, 150)
+
+    exact = QuantReg_Models.svqr(quantiles=QUANTILES, kernel=kernel)
+    exact.fit(X, y)
+    active_set = QuantReg_Models.svqr(quantiles=QUANTILES, kernel=kernel, solver="active_set")
+    active_set.fit(X, y)
+
+    exact_predictions = exact.predict(X)
+    active_set_predictions = active_set.predict(X)
+    for q in QUANTILES:
+        alpha = active_set.models[str(q)]["alpha"]
+        assert abs(np.sum(alpha)) < 1e-10
+        assert np.all(alpha >= q - 1) and np.all(alpha <= q)
+        np.testing.assert_allclose(active_set_predictions[str(np.round(q, 4))],
+                                   exact_predictions[str(np.round(q, 4))], atol=1e-3)
+
+
+def test_rf_qrf_matches_weighted_quantiles():
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, (300, 3))
+    y = X[:, 0] + rng.normal(0, 0.3, 300)
+    X_test = rng.uniform(-1, 1, (20, 3))
+
+    net = QuantReg_Models.rf(quantiles=QUANTILES, trees=10, min_samples_leaf=5, method="qrf")
+    net.fit(X, y)
+    predictions = net.predict(X_test)
+
+    train_leaves = net.models.apply(X)
+    test_leaves = net.models.apply(X_test)
+    order = np.argsort(y)
+    for i in range(len(X_test)):
+        same_leaf = train_leaves == test_leaves[i]
+        weights = np.mean(same_leaf / same_leaf.sum(axis=0), axis=1)
+        cumulative = np.cumsum(weights[order])
+        for q in QUANTILES:
+            expected = y[order][np.searchsorted(cumulative, q - 1e-9)]
+            assert predictions[str(np.round(q, 4))][i] == expected
+
+
+@pytest.mark.parametrize("backend, n_jobs", [("exact", 1), ("hist", 1), ("exact", 2)])
+def test_gbm_fit(backend, n_jobs):
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, (300, 3))
+    y = X[:, 0] + rng.normal(0, 0.3, 300)
+    quantiles = [0.05, 0.5, 0.95]
+
+    net = QuantReg_Models.gbm(quantiles=quantiles, trees=20, max_depth=3, backend=backend, n_jobs=n_jobs)
+    net.fit(X, y)
+    predictions = net.predict(X)
+
+    assert list(predictions) == ["0.05", "0.5", "0.95"]
+    assert np.mean(y < predictions["0.05"]) < np.mean(y < predictions["0.5"]) < np.mean(y < predictions["0.95"])
+
+
+def test_lm_matches_linear_program():
+    from scipy.optimize import linprog
+
+    rng = np.random.default_rng(0)
+    n = 200
+    X = rng.uniform(-1, 1, (n, 2))
+    y = X @ [1, -2] + rng.normal(0, 0.3, n)
+
+    net = QuantReg_Models.lm(quantiles=QUANTILES)
+    net.fit(X, y)
+    predictions = net.predict(X)
+
+    design = np.hstack((np.ones((n, 1)), X))
+    for q in QUANTILES:
+        # min q*sum(u+) + (1-q)*sum(u-) subject to design*beta + u+ - u- = y
+        c = np.concatenate([np.zeros(3), np.full(n, q), np.full(n, 1 - q)])
+        A = np.hstack([design, np.eye(n), -np.eye(n)])
+        res = linprog(c, A_eq=A, b_eq=y, bounds=[(None, None)] * 3 + [(0, None)] * (2 * n), method="highs")
+        e = y - predictions[str(np.round(q, 4))]
+        assert np.sum(np.maximum(q * e, (q - 1) * e)) == pytest.approx(res.fun, rel=1e-6, abs=1e-6)
+
+
+def test_mcqrann_quantile_dataset():
+    quantiles = [0.1, 0.5, 0.9]
+    net = QuantReg_Models.mcqrann(quantiles=quantiles)
+    X = np.arange(8, dtype=float).reshape(4, 2)
+    y = np.array([10.0, 11.0, 12.0, 13.0])
+
+    batches = list(net.quantile_dataset(X, y, batch_size=5))
+    inputs = np.vstack([batch[0].numpy() for batch in batches])
+    targets = np.vstack([batch[1].numpy() for batch in batches])
+
+    np.testing.assert_allclose(inputs[:, 0], np.repeat(quantiles, 4), rtol=1e-6)
+    np.testing.assert_allclose(inputs[:, 1:], np.tile(X, (3, 1)))
+    np.testing.assert_allclose(targets[:, 0], np.tile(y, 3))
+    np.testing.assert_allclose(targets[:, 1], inputs[:, 0])
+
+
+def test_mcqrann_quantile_dataset_shuffles_all_pairs():
+    net = QuantReg_Models.mcqrann(quantiles=QUANTILES)
+    X = np.arange(1000, dtype=float).reshape(-1, 1)
+    y = np.arange(1000, dtype=float)
+
+    epochs = []
+    dataset = net.quantile_dataset(X, y, batch_size=32, shuffle=True, seed=0)
+    for epoch in range(2):
+        inputs = np.vstack([batch[0].numpy() for batch in dataset])
+        # Every pair of the 21000 is read once per epoch
+        pairs = np.round(inputs[:, 0], 4) * 10**6 + inputs[:, 1]
+        assert len(np.unique(pairs)) == len(pairs) == 1000 * len(QUANTILES)
+        epochs.append(inputs)
+
+    # Even though there are more pairs than a shuffle buffer would hold, a batch mixes most of the quantiles
+    assert len(np.unique(epochs[0][:32, 0])) >= 10
+    assert not np.array_equal(epochs[0], epochs[1])
+
+
+@pytest.mark.parametrize("optimizer, jit_compile", [("Nadam", True), ("Nadam", False), ("Adam", True)])
+def test_cqrann_compiled_fit(optimizer, jit_compile):
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, (200, 3))
+    y = (X.sum(axis=1) + rng.normal(0, 0.1, 200)).reshape(-1, 1)
+
+    predictions = []
+    for i in range(2):
+        net = QuantReg_Models.cqrann(quantiles=QUANTILES, loss="smoothed", epsilon=10**-32, n_hidden=2, seed=0,
+                                     engine="compiled", epochs_per_call=50, optimizer=optimizer,
+                                     jit_compile=jit_compile)
+        net.fit(X, y)
+        predictions.append(net.predict_array(X))
+
+    np.testing.assert_array_equal(predictions[0], predictions[1])
+    assert 0 < net.epochs_trained <= 500
+    # Creating the optimizer slots before tracing (with _create_all_weights on the OptimizerV2 of tensorflow 2.9)
+    # must not take a step: the 180 training samples make 6 batches per epoch
+    assert int(net.model.optimizer.iterations.numpy()) == 6 * net.epochs_trained
+    means = predictions[0].mean(axis=0)
+    assert means[1] < means[10] < means[19]
+
+
+def test_cqrann_lbfgs_fit():
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, (200, 3))
+    y = (X.sum(axis=1) + rng.normal(0, 0.1, 200)).reshape(-1, 1)
+
+    net = QuantReg_Models.cqrann(quantiles=QUANTILES, loss="smoothed", epsilon=10**-32, n_hidden=2, seed=0,
+                                 optimizer="L-BFGS")
+    net.fit(X, y)
+    predictions = net.predict_array(X)
+
+    assert np.all(np.isfinite(predictions))
+    means = predictions.mean(axis=0)
+    assert means[1] < means[10] < means[19]
+
+
+def test_fit_lbfgs_early_stopping():
+    tf = pytest.importorskip("tensorflow")
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, (40, 3))
+    y = rng.normal(0, 1, (40, 1))
+    model = tf.keras.models.Sequential([tf.keras.layers.Dense(16, activation="tanh"), tf.keras.layers.Dense(1)])
+    loss = tf.keras.losses.MeanSquaredError()
+
+    # Fitting noise, the validation loss soon stops improving. The early stop must not escape from minimize, on any
+    # version of scipy
+    evaluations = QuantReg_Models.fit_lbfgs(model, loss, X, y, 0.25, max_iter=1000, patience=5)
+
+    assert 0 < evaluations < 1000
+    assert np.all(np.isfinite(model(X.astype(np.float32)).numpy()))
+
+
+def test_mqrann_lbfgs_fit():
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, (200, 3))
+    y = X.sum(axis=1) + rng.normal(0, 0.1, 200)
+    quantiles = [0.05, 0.5, 0.95]
+
+    net = QuantReg_Models.mqrann(quantiles=quantiles, hl_size=4, optimizer="L-BFGS")
+    net.fit(X, y)
+
+    predictions = net.predict(X)
+    assert np.mean(predictions["0.05"]) < np.mean(predictions["0.5"]) < np.mean(predictions["0.95"])
+
+
+@pytest.mark.parametrize("optimizer", ["Adam", "Nadam"])
+def test_numpy_optimizers_match_keras(optimizer):
+    tf = pytest.importorskip("tensorflow")
+    rng = np.random.default_rng(0)
+    start = rng.normal(0, 1, 10)
+    gradients = rng.normal(0, 1, (20, 10))
+
+    # The optimizer that cqrann gets from Keras for the same name, i.e. OptimizerV2 on the pinned tensorflow 2.9
+    keras_optimizer = tf.keras.optimizers.get(optimizer)
+    variable = tf.Variable(start)
+    numpy_optimizer = getattr(QuantReg_NumPy, optimizer)(10)
+    weights = start.copy()
+    for gradient in gradients:
+        keras_optimizer.apply_gradients([(tf.constant(gradient), variable)])
+        numpy_optimizer.apply_gradients(gradient, weights)
+        np.testing.assert_allclose(weights, variable.numpy(), rtol=1e-7)
+
+
+@pytest.mark.parametrize("left_censor", [None, 0.01])
+def test_numpy_cqrann_gradients(left_censor):
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, (50, 3))
+    y = (X.sum(axis=1) + rng.normal(0, 0.1, 50)).reshape(-1, 1)
+
+    net = QuantReg_NumPy.cqrann(quantiles=QUANTILES, loss="smoothed", epsilon=0.05, n_hidden=3,
+                                left_censor=left_censor)
+    weights, gradients = net.build_model(3, rng)
+    weights[:] = rng.normal(0, 0.5, weights.shape)
+    cost = QuantReg_NumPy.simultaneous_loss_numpy(QUANTILES, 0.05)
+    outputs = net.forward(X)
+    loss, delta = cost(y, net.censor(outputs[-1]))
+    net.backward(outputs, delta)
+
+    numerical = np.zeros_like(weights)
+    for i in range(len(weights)):
+        losses = []
+        for step in (1e-6, -1e-6):
+            weights[i] += step
+            losses.append(cost(y, net.censor(net.forward(X)[-1]))[0])
+            weights[i] -= step
+        numerical[i] = (losses[0] - losses[1]) / 2e-6
+    np.testing.assert_allclose(gradients, numerical, atol=1e-8)
+
+
+def test_numpy_cqrann_fit(tmp_path):
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, (200, 3))
+    y = X.sum(axis=1) + rng.normal(0, 0.1, 200)
+
+    predictions = []
+    for i in range(2):
+        net = QuantReg_NumPy.cqrann(quantiles=QUANTILES, loss="smoothed", epsilon=10**-32, n_hidden=2, seed=0)
+        net.fit(X, y)
+        predictions.append(net.predict_array(X))
+
+    np.testing.assert_array_equal(predictions[0], predictions[1])
+    means = predictions[0].mean(axis=0)
+    assert means[1] < means[10] < means[19]
+
+    net.save_weights(tmp_path / "weights.npz")
+    keras_net = QuantReg_Models.cqrann(quantiles=QUANTILES, **net.get_params())
+    keras_net.load_weights(tmp_path / "weights.npz")
+    np.testing.assert_array_equal(keras_net.predict_array(X), predictions[0])
@@ -0,0 +1,413 @@
+import datetime
+import json
+import os
+import time
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from swotann import QuantReg_Functions
+from swotann import swot_ml
+from swotann.model_cache import ModelCache
+from swotann.swot_ml import SWOT_ML
+
+
+def test_parse_dates():
+    net = SWOT_ML()
+    series = pd.Series(
+        [
+            "2019-12-28T08:54:00.000+06:00",
+            "2019-12-28T16:00:00.000-03:30",
+            "2020/02/20T12:42",
+            "43874.436111111114",
+            43874.583333333336,
+            "not a date",
+            None,
+        ]
+    )
+    local, utc = net.parse_dates(series)
+
+    assert local[0] == pd.Timestamp("2019-12-28 08:54")
+    assert utc[0] == pd.Timestamp("2019-12-28 02:54")
+    assert utc[1] == pd.Timestamp("2019-12-28 19:30")
+    assert utc[2] == local[2] == pd.Timestamp("2020-02-20 12:42")
+    assert local[3] == pd.Timestamp("2020-02-13 10:28")
+    assert local[4] == pd.Timestamp("2020-02-13 14:00")
+    assert np.all(utc[5:].isnull())
+
+
+def test_parse_dates_mixed_offsets():
+    net = SWOT_ML()
+    df = pd.DataFrame(
+        {
+            "ts_datetime": ["2020-02-13T10:28:00.000+06:00", "43874.436111111114", "43874.436111111114"],
+            "ts_frc1": [0.4, 0.5, 0.6],
+            "hh_datetime": ["43874.583333333336", "2020-02-13T14:00:00.000-03:30", "43874.583333333336"],
+            "hh_frc1": [0.2, 0.3, 0.4],
+            "ts_cond": [267.0, 260.0, 255.0],
+            "ts_wattemp": [30.5, 29.8, 30.1],
+        }
+    )
+    assert net.utc_offsets(df["ts_datetime"]).tolist()[0] == 360.0
+    assert np.all(net.utc_offsets(df["ts_datetime"])[1:].isnull())
+
+    net.import_data(df)
+
+    # The offset recorded on one side of the row applies to the Excel date/time on the other side, so every row
+    # goes from 10:28 to 14:00 local time
+    assert np.allclose(net.durations, 3 * 3600 + 32 * 60)
+    assert net.file["formatted_date"].tolist() == ["2020-02-13T10:28"] * 3
+
+
+def test_read_input_file(tmp_path):
+    filename = tmp_path / "input.csv"
+    filename.write_text(
+        "ts_datetime,ts_frc1,hh_datetime,hh_frc1,ts_cond,ts_wattemp,comments\n"
+        "43874.436111111114,0.4,43874.583333333336,0.2,267,30.5,ok\n"
+        "2020-02-20T12:42,0.6,2020-02-20T15:42,,260,29.8,\n"
+    )
+    net = SWOT_ML()
+    df = net.read_input_file(filename)
+
+    assert list(df.columns) == ["ts_datetime", "ts_frc1", "hh_datetime", "hh_frc1", "ts_cond", "ts_wattemp"]
+    assert df["ts_datetime"].dtype == object
+    assert (df[["ts_frc1", "hh_frc1", "ts_cond", "ts_wattemp"]].dtypes == "float64").all()
+
+    net.import_data(df)
+    assert len(net.file) == 1
+    assert net.ruleset[1] == ("Invalid household FRC", "hh_frc1", 1)
+
+
+def test_quantile_predictions():
+    net = SWOT_ML()
+    rng = np.random.default_rng(0)
+    scaled = rng.uniform(-1, 1, (50, len(net.quantiles)))
+    net.targets_scaler.fit(np.array([[0.0], [2.0]]))
+
+    predictions = QuantReg_Functions.QuantilePredictions(scaled, net.quantiles)
+    legacy = predictions.to_dict()
+    assert list(legacy.keys())[:3] == ["0.0001", "0.05", "0.1"]
+    np.testing.assert_array_equal(
+        QuantReg_Functions.QuantilePredictions.from_dict(legacy, net.quantiles).values, scaled
+    )
+
+    predictions = QuantReg_Functions.QuantilePredictions(scaled, net.quantiles).unscale(net.targets_scaler)
+    expected = pd.DataFrame(
+        {key: net.targets_scaler.inverse_transform(value.reshape(-1, 1)).flatten() for key, value in legacy.items()}
+    )
+    pd.testing.assert_frame_equal(predictions.to_frame(), expected.where(expected > 0, 0))
+
+
+def test_evaluate_model(tmp_path):
+    net = SWOT_ML()
+    rng = np.random.default_rng(0)
+    y = rng.uniform(0, 1, 300)
+    df = pd.DataFrame(
+        np.sort(rng.uniform(-0.2, 1.2, (300, len(net.quantiles))), axis=1),
+        columns=[str(np.round(q, decimals=4)) for q in net.quantiles],
+    )
+    df["observed"] = y
+
+    scores = QuantReg_Functions.evaluate_model(df, net.quantiles, "observed", str(tmp_path / "out"), save=True)
+    inside = (y >= df["0.0001"]) & (y <= df["0.9999"])
+    assert scores["Percent Capture"] == pytest.approx(np.mean(inside))
+    assert scores["Percent Capture (HH FRC < 0.2 mg/L)"] == pytest.approx(np.sum(inside & (y < 0.2)) / np.sum(y < 0.2))
+    q_loss = [QuantReg_Functions.q_loss(q, y, df[str(np.round(q, decimals=4))]) for q in net.quantiles]
+    assert scores["Average Quantile Error"] == pytest.approx(np.mean(q_loss))
+    # quantile_scores normalizes the widths of the intervals by the range of the observations, and evaluate_model
+    # keeps its legacy division by the length of the name of the observed column
+    widths = [np.mean(df["0.9999"] - df["0.0001"])] + [
+        np.mean(df[str(np.round(1 - i / 2, 2))] - df[str(np.round(i / 2, 2))]) for i in np.arange(0.1, 1, 0.1)
+    ]
+    pinaw = np.mean(widths) / (y.max() - y.min())
+    unscaled = QuantReg_Functions.quantile_scores(df[df.columns[:-1]].to_numpy(), y, net.quantiles)
+    assert unscaled["Average Prediction Interval Normalized Average Width"] == pytest.approx(pinaw)
+    assert scores["Average Prediction Interval Normalized Average Width"] == pytest.approx(pinaw / len("observed"))
+    saved = pd.read_csv(tmp_path / "out_calibration_scores.csv", index_col=0).iloc[:, 0]
+    np.testing.assert_allclose(saved.to_numpy(), list(scores.values()))
+
+    bootstrap = [
+        QuantReg_Functions.evaluate_model(df, net.quantiles, "observed", n_bootstrap=250, seed=0, n_jobs=n_jobs)
+        for n_jobs in (1, 2)
+    ]
+    assert bootstrap[0] == bootstrap[1]
+    for key, value in scores.items():
+        assert bootstrap[0][key] == value
+        assert bootstrap[0][key + " (CI low)"] <= value <= bootstrap[0][key + " (CI high)"]
+
+
+def test_exceedance_probabilities():
+    net = SWOT_ML()
+    rng = np.random.default_rng(0)
+    predictions = np.sort(rng.uniform(-0.2, 0.6, (200, len(net.quantiles))), axis=1)
+    predictions = np.where(predictions > 0, predictions, 0)
+    thresholds = [0.0, 0.20, 0.25, 0.30, 1.0]
+
+    probabilities = QuantReg_Functions.exceedance_probabilities(predictions, net.quantiles, thresholds)
+    expected = np.stack(
+        [1 - net.quantiles[np.argmin(np.abs(t - predictions), axis=1)] for t in thresholds], axis=1
+    )
+    np.testing.assert_array_equal(probabilities, expected)
+
+    interpolated = QuantReg_Functions.exceedance_probabilities(
+        predictions, net.quantiles, thresholds, interpolate=True
+    )
+    for i in range(20):
+        row = predictions[i]
+        for j, t in enumerate(thresholds[1:], 1):
+            np.testing.assert_allclose(interpolated[i, j], 1 - np.interp(t, row, net.quantiles))
+
+
+def test_save_and_load_model(tmp_path):
+    testspath = os.path.dirname(__file__)
+    net = SWOT_ML(seed=0)
+    net.import_data_from_csv(os.path.join(testspath, "test4.csv"))
+    net.set_up_model()
+    net.train_ML_models(tmp_path)
+    net.save_model(tmp_path)
+    net.set_inputs_for_table(24)
+    net.risk_eval()
+
+    loaded = SWOT_ML()
+    loaded.load_model(tmp_path)
+    loaded.set_inputs_for_table(24)
+    loaded.risk_eval()
+
+    pd.testing.assert_frame_equal(loaded.full_results, net.full_results)
+    pd.testing.assert_frame_equal(loaded.min_grid, net.min_grid)
+    pd.testing.assert_frame_equal(loaded.max_grid, net.max_grid)
+
+
+def test_risk_tables(tmp_path):
+    testspath = os.path.dirname(__file__)
+    net = SWOT_ML(seed=0, backend="numpy")
+    net.import_data_from_csv(os.path.join(testspath, "test4.csv"))
+    net.set_up_model()
+    net.train_ML_models(tmp_path)
+
+    tables = net.risk_tables([12, 24, 36, 48])
+    assert list(tables.keys()) == [12, 24, 36, 48]
+    for storage_target, (min_grid, max_grid) in tables.items():
+        net.set_inputs_for_table(storage_target)
+        net.risk_eval()
+        pd.testing.assert_frame_equal(min_grid, net.min_grid)
+        pd.testing.assert_frame_equal(max_grid, net.max_grid)
+
+
+def test_refined_risk_tables(tmp_path):
+    testspath = os.path.dirname(__file__)
+    net = SWOT_ML(seed=0, backend="numpy")
+    net.import_data_from_csv(os.path.join(testspath, "test4.csv"))
+    net.set_up_model()
+    net.train_ML_models(tmp_path)
+
+    net.set_inputs_for_table(24)
+    net.risk_eval()
+    coarse_grids = net.grids
+    coarse_evaluations = net.table_evaluations
+
+    net.set_inputs_for_table(24, resolution=0.01)
+    net.risk_eval()
+    assert net.grids.shape == (coarse_grids.shape[0], 181, coarse_grids.shape[2])
+    np.testing.assert_array_equal(net.grids[:, ::5, :], coarse_grids)
+    np.testing.assert_allclose(net.max_grid.index, np.round(np.arange(0.20, 2.005, 0.01), 10))
+    assert coarse_evaluations < net.table_evaluations < 5 * coarse_evaluations
+
+    # Between two 0.05 mg/L points of the same category, the interpolated points stay in that category
+    categories = np.digitize(net.grids, net.risk_levels)
+    for i in range(0, 180, 5):
+        same = categories[:, i, :] == categories[:, i + 5, :]
+        for step in range(1, 5):
+            np.testing.assert_array_equal(categories[:, i + step, :][same], categories[:, i, :][same])
+
+    with pytest.raises(ValueError):
+        net.set_inputs_for_table(24, resolution=0.03)
+
+
+@pytest.mark.parametrize(
+    "evaluation_jobs, evaluation_split, seed", [(1, "blocked", 0), (2, "blocked", 0), (1, "kfold", None)]
+)
+def test_full_performance_evaluation(tmp_path, evaluation_jobs, evaluation_split, seed):
+    testspath = os.path.dirname(__file__)
+    net = SWOT_ML(seed=seed, backend="numpy")
+    net.evaluation_splits = 3
+    net.evaluation_split = evaluation_split
+    net.evaluation_jobs = evaluation_jobs
+    net.import_data_from_csv(os.path.join(testspath, "test4.csv"))
+    net.set_up_model()
+    model = net.model
+    net.full_performance_evaluation(os.path.join(tmp_path, "out.csv"))
+
+    assert net.model is model and net.model.train_status == 0
+    assert list(net.holdout_scores.index) == [1, 2, 3]
+
+    saved = pd.read_csv(os.path.join(tmp_path, "out_holdout_scores.csv"), index_col=0)
+    assert list(saved.index) == ["1", "2", "3", "mean", "std"]
+    np.testing.assert_allclose(saved.loc["mean"], net.holdout_scores.mean())
+
+    # Predictions equal to the observations of the samples each fold held out score no quantile error, which
+    # fails if the folds are drawn again when they are collected
+    t_norm = net.targets_scaler.transform(net.targets).flatten()
+    folds = [
+        (test, np.repeat(t_norm[test, None], len(net.quantiles), axis=1)) for train, test in net.evaluation_folds()
+    ]
+    net.collect_evaluation(folds, os.path.join(tmp_path, "exact.csv"))
+    np.testing.assert_allclose(net.holdout_scores["Average Quantile Error"], 0, atol=1e-12)
+
+
+def test_tune_model(tmp_path):
+    testspath = os.path.dirname(__file__)
+    net = SWOT_ML(seed=0, backend="numpy")
+    net.import_data_from_csv(os.path.join(testspath, "test4.csv"))
+    space = {"n_hidden": [1, 2], "hl_size": [2, 4], "optimizer": ["Adam", "Nadam"]}
+    best = net.tune_model(space, n_jobs=2, budgets=(5, 20), reduction=4, directory=tmp_path)
+
+    rounds = net.tuning_results.groupby("budget").size()
+    assert rounds[5] == 8 and rounds[20] <= 2
+    assert {name: net.model_params[name] for name in space} == best
+    with open(os.path.join(tmp_path, "tuning.json")) as f:
+        assert json.load(f)["selected"] == best
+
+    net.set_up_model()
+    assert net.model.n_hidden == best["n_hidden"] and net.model.Nh == best["hl_size"]
+
+
+def test_numpy_backend_model_loads_with_keras(tmp_path):
+    testspath = os.path.dirname(__file__)
+    net = SWOT_ML(seed=0, backend="numpy")
+    net.import_data_from_csv(os.path.join(testspath, "test4.csv"))
+    net.set_up_model()
+    net.train_ML_models(tmp_path)
+    net.save_model(tmp_path)
+    net.set_inputs_for_table(24)
+    net.risk_eval()
+
+    loaded = SWOT_ML(backend="keras")
+    loaded.load_model(tmp_path)
+    loaded.set_inputs_for_table(24)
+    loaded.risk_eval()
+
+    pd.testing.assert_frame_equal(loaded.full_results, net.full_results)
+
+
+@pytest.mark.skipif(swot_ml.current_rss() is None, reason="RSS can only be sampled on Linux")
+def test_rss_sampler():
+    sampler = swot_ml.RSSSampler(interval=0.01)
+    data = np.ones(50 * 2**20 // 8)
+    time.sleep(0.05)
+    del data
+    # The peak includes the 50 MB allocated during the job, even though the job freed them
+    assert 45 <= sampler.stop() < 100
+
+
+def test_run_swot_model_directories_are_unique(tmp_path, monkeypatch):
+    testspath = os.path.dirname(__file__)
+    monkeypatch.chdir(tmp_path)
+    input_file = os.path.join(testspath, "test4.csv")
+
+    # Both jobs start in the same second on the same file
+    class FrozenDatetime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return cls(2020, 2, 20, 12, 42)
+
+    monkeypatch.setattr(swot_ml, "datetime", types.SimpleNamespace(datetime=FrozenDatetime, date=datetime.date))
+    first = SWOT_ML(seed=0, backend="numpy").run_swot(input_file, os.path.join(tmp_path, "first.csv"), 24)
+    second = SWOT_ML(seed=0, backend="numpy").run_swot(input_file, os.path.join(tmp_path, "second.csv"), 24)
+
+    assert first["model_directory"] != second["model_directory"]
+    for metadata in (first, second):
+        assert os.path.basename(metadata["model_directory"]).startswith("02202020_124200_test4.csv_")
+        assert os.path.exists(os.path.join(metadata["model_directory"], "model.json"))
+
+
+def test_run_swot_model_cache(tmp_path):
+    testspath = os.path.dirname(__file__)
+    cache = ModelCache(os.path.join(tmp_path, "cache"))
+    results_file = os.path.join(tmp_path, "out.csv")
+
+    first = SWOT_ML(seed=0, model_cache=cache).run_swot(os.path.join(testspath, "test4.csv"), results_file, 24)
+    second = SWOT_ML(seed=0, model_cache=cache).run_swot(os.path.join(testspath, "test4.csv"), results_file, 48)
+
+    assert not first["cache_hit"]
+    assert second["cache_hit"]
+    assert (second["cache_hits"], second["cache_misses"]) == (1, 1)
+    assert second["model_directory"] == first["model_directory"]
+
+
+def test_model_cache_load_pins_model(tmp_path):
+    cache = ModelCache(tmp_path, max_size=1000)
+    for key in ("a", "b"):
+        os.makedirs(os.path.join(tmp_path, key))
+        with open(os.path.join(tmp_path, key, "model.json"), "w") as f:
+            f.write("x" * 1000)
+        os.utime(os.path.join(tmp_path, key), (0, {"a": 1, "b": 2}[key]))
+
+    class Net:
+        def load_model(self, directory):
+            # Another thread stores a model while this one is loading "a", the least recently used model
+            with cache.lock:
+                cache.evict(keep=os.path.join(tmp_path, "b"))
+            with open(os.path.join(directory, "model.json")) as f:
+                f.read()
+
+        def save_model(self, directory):
+            pass
+
+    assert cache.load("a", Net()) == os.path.join(tmp_path, "a")
+    assert os.path.isdir(os.path.join(tmp_path, "a"))
+
+    class MissingBundle:
+        def load_model(self, directory):
+            raise FileNotFoundError(directory)
+
+    assert cache.load("b", MissingBundle()) is None
+    assert cache.load("c", Net()) is None
+    assert cache.stats() == {"cache_hits": 1, "cache_misses": 2}
+    assert cache.pinned == {}
+
+
+@pytest.mark.parametrize(
+    "error", [ValueError("corrupt bundle"), KeyError("template"), json.JSONDecodeError("Expecting value", "", 0)]
+)
+def test_model_cache_load_invalid_bundle(tmp_path, error):
+    cache = ModelCache(tmp_path)
+    os.makedirs(os.path.join(tmp_path, "a"))
+
+    class InvalidBundle:
+        def load_model(self, directory):
+            raise error
+
+    # An invalid bundle is a miss, and is deleted so that the retrained model can be stored in its place
+    assert cache.load("a", InvalidBundle()) is None
+    assert not os.path.exists(os.path.join(tmp_path, "a"))
+    assert cache.stats() == {"cache_hits": 0, "cache_misses": 1}
+    assert cache.pinned == {}
+
+    class Interrupted:
+        def load_model(self, directory):
+            raise KeyboardInterrupt
+
+    os.makedirs(os.path.join(tmp_path, "b"))
+    with pytest.raises(KeyboardInterrupt):
+        cache.load("b", Interrupted())
+    assert os.path.isdir(os.path.join(tmp_path, "b"))
+    assert cache.stats() == {"cache_hits": 0, "cache_misses": 2}
+    assert cache.pinned == {}
+
+
+def test_model_cache_eviction(tmp_path):
+    cache = ModelCache(tmp_path, max_size=2048)
+    for key in ("a", "b", "c"):
+        os.makedirs(os.path.join(tmp_path, key))
+        with open(os.path.join(tmp_path, key, "model.json"), "w") as f:
+            f.write("x" * 1000)
+        os.utime(os.path.join(tmp_path, key), (0, {"a": 1, "b": 3, "c": 2}[key]))
+
+    cache.evict()
+
+    assert sorted(os.listdir(tmp_path)) == ["b", "c"]
+    assert cache.lookup("a") is None
+    assert cache.lookup("b") == os.path.join(tmp_path, "b")